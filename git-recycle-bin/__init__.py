@@ -1,5 +1,6 @@
 from .commands.push import (
     push,
+    push_artifact,
     push_branch,
     push_tag,
     note_append_push,
@@ -13,8 +14,10 @@ from .commands.list import (
     remote_artifacts,
     remote_artifacts_unfiltered,
     filter_artifacts,
+    format_artifact,
+    print_artifacts,
 )
-from .commands.download import download, download_refs, download_single
+from .commands.download import download, download_refs, download_single, download_to_stdout
 
 from .commands.cat_meta import cat_metas, metas_for_commits
 
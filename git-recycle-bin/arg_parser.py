@@ -2,7 +2,11 @@ import argparse
 import os
 
 from .query import NameQuery, PathQuery, RelPathQuery, JqQuery, AndQuery
-from git_recycle_bin.utils.string import str2bool
+from git_recycle_bin.utils.string import str2bool, positive_int
+from git_recycle_bin.meta_cache import default_cache_dir
+from git_recycle_bin.commands.list import SORT_KEYS
+from git_recycle_bin.materialize import LINK_MODES
+from git_recycle_bin.commands.download import ARCHIVE_FORMATS
 
 from .printer import printer
 
@@ -37,6 +41,12 @@ def parse_args(args=None):
     dv = 'False';  g.add_argument("--flush-meta",      metavar='bool', type=str2bool, nargs='?', const=True, default=os.getenv('GITRB_RM_FLUSH_META', dv), help=f"Delete expired meta-for-commit refs. Default {dv}.")
     dv = 'origin'; g.add_argument("--src-remote-name", metavar='name',     required=False, type=str, default=os.getenv('GITRB_SRC_REMOTE', dv), help=f"Name of src repo's remote. Defaults {dv}.")
     dv = 'True' ;  g.add_argument("--rm-tmp",          metavar='bool', type=str2bool, nargs='?', const=True, default=os.getenv('GITRB_RM_TMP', dv), help=f"Remove local bin-repo. Default {dv}.")
+    dv = default_cache_dir(); g.add_argument("--cache-dir", metavar='dir',      required=False, type=str, default=os.getenv('GITRB_CACHE_DIR', dv), help=f"Directory for caches shared between invocations. Default {dv}.")
+    dv = 'True' ;  g.add_argument("--meta-cache",      metavar='bool', type=str2bool, nargs='?', const=True, default=os.getenv('GITRB_META_CACHE', dv), help=f"Cache meta-data on disk between invocations. Default {dv}.")
+    dv = '10000';  g.add_argument("--meta-cache-max",  metavar='count',    required=False, type=int, default=os.getenv('GITRB_META_CACHE_MAX', dv), help=f"Max number of cached meta-data entries. Default {dv}.")
+    dv = '1';      g.add_argument("--jobs",            metavar='N',        required=False, type=int, default=os.getenv('GITRB_JOBS', dv), help=f"Concurrent fetches of meta-data and artifacts. Default {dv}.")
+    g.add_argument(               "--stats-json",      metavar='file',     required=False, type=str, default=os.getenv('GITRB_STATS_JSON'), help="Write time per phase and per git command, and objects and bytes transferred, as JSON to file. Printed with -vv.")
+    dv = '0';      g.add_argument("--ref-snapshot-ttl", metavar='seconds', required=False, type=float, default=os.getenv('GITRB_REF_SNAPSHOT_TTL', dv), help=f"Reuse remote's refs listed by an invocation less than this long ago. Default {dv}, disabled.")
 
 
     g = top_parser.add_argument_group('terminal output style')
@@ -55,10 +65,14 @@ def parse_args(args=None):
     g.add_argument(                   "--name",                   metavar='string',   required=True,  type=str, default=os.getenv('GITRB_NAME'),       help="Name to assign to the artifact. Will be sanitized.")
     dv = 'in 30 days'; g.add_argument("--expire",                 metavar='fuzz',     required=False, type=str, default=os.getenv('GITRB_EXPIRE', dv), help=f"Expiry of artifact's branch. Fuzzy date. Default '{dv}'.")
     dv = 'False';      g.add_argument("--tag",  dest='push_tag',  metavar='bool', type=str2bool, nargs='?', const=True, default=os.getenv('GITRB_PUSH_TAG', dv), help=f"Push tag to artifact to remote. Default {dv}.")
+    dv = 'False';      g.add_argument("--index",                  metavar='bool', type=str2bool, nargs='?', const=True, default=os.getenv('GITRB_INDEX', dv), help=f"Add meta-data to the remote's artifact index, speeding up list. Default {dv}.")
     dv = 'False';      g.add_argument("--note", dest='push_note', metavar='bool', type=str2bool, nargs='?', const=True, default=os.getenv('GITRB_PUSH_NOTE', dv),     help=f"Push note to src remote. Default {dv}.")
     dv = 'False';      g.add_argument("--add-ignored",            metavar='bool', type=str2bool, nargs='?', const=True, default=os.getenv('GITRB_ADD_IGNORED', dv), help=f"Add despite gitignore. Default {dv}.")
     dv = 'False';      g.add_argument("--force-branch",           metavar='bool', type=str2bool, nargs='?', const=True, default=os.getenv('GITRB_FORCE_BRANCH', dv), help=f"Force push of branch. Default {dv}.")
     dv = 'False';      g.add_argument("--force-tag",              metavar='bool', type=str2bool, nargs='?', const=True, default=os.getenv('GITRB_FORCE_TAG', dv), help=f"Force push of tag. Default {dv}.")
+    dv = '0';          g.add_argument("--chunk-size",             metavar='MiB', type=int, default=os.getenv('GITRB_CHUNK_SIZE', dv), help=f"Push artifact in chunks of about this size, each retried on failure, so an interrupted transfer resumes. Downloads fetch it chunk by chunk too. Default {dv}, no chunks.")
+    dv = '1';          g.add_argument("--hash-jobs",              metavar='N', type=int, default=os.getenv('GITRB_HASH_JOBS', dv), help=f"Processes hashing and packing the artifact's files. 1 leaves it to git, one file at a time. 0 for one per CPU. Default {dv}.")
+    dv = 'False';      g.add_argument("--delta-base",             metavar='bool', type=str2bool, nargs='?', const=True, default=os.getenv('GITRB_DELTA_BASE', dv), help=f"Fetch the trees of the remote's previous artifact of the same path, so only files it lacks are pushed. Costs an extra round trip to the remote. Default {dv}.")
     dv = 'False';       g.add_argument("--no-print-commit",       metavar='bool', type=str2bool, nargs='?', const=True, default=os.getenv('GITRB_NO_PRINT_COMMIT', dv), help=f"Do not print commit sha at the end.")
     g.add_argument("--trailer", nargs=2, metavar=('key', 'value'), dest='trailers', action=keyvalue, default={}, help="Add trailer to commit. Can be specified multiple times.")
 
@@ -69,6 +83,10 @@ def parse_args(args=None):
     add_remote_arg(g)
 
     g.add_argument("--all", action='store_true', dest='list_all_shas', default=False, help="List all artifacts, regardless of HEAD sha")
+    g.add_argument("--limit", metavar='N', required=False, type=positive_int, default=os.getenv('GITRB_LIMIT'), help="Stop after N matching artifacts, without fetching meta-data of the rest.")
+    g.add_argument("--sort", metavar='|'.join(SORT_KEYS), choices=SORT_KEYS, default=os.getenv('GITRB_SORT'), help="List newest first by this key.")
+    g.add_argument("--latest", metavar='N', required=False, type=positive_int, default=os.getenv('GITRB_LATEST'), help="List only the N newest artifacts. Sorts by src-commit-time unless --sort is given.")
+    dv = 'sha'; g.add_argument("--format", metavar='sha|jsonl', choices=['sha', 'jsonl'], default=os.getenv('GITRB_FORMAT', dv), help=f"Print artifact SHA, or JSON of SHAs and meta-data, per line. Default {dv}.")
     g = g.add_argument_group('query options (multiple allowed, combined with AND)')
     JqQuery.add_parser(g)
     NameQuery.add_parser(g)
@@ -79,6 +97,14 @@ def parse_args(args=None):
     add_remote_arg(g)
     g.add_argument("artifacts", metavar='artifact', nargs='+', type=str, help="Artifact SHA(s) to download")
     g.add_argument("--force", "-f", action='store_true', help="Force download, even if local files ")
+    dv = 'False'; g.add_argument("--object-store", metavar='bool', type=str2bool, nargs='?', const=True, default=os.getenv('GITRB_OBJECT_STORE', dv), help=f"Keep downloaded artifacts in a persistent store below --cache-dir, so they are fetched only once. Default {dv}.")
+    dv = 'False'; g.add_argument("--incremental", metavar='bool', type=str2bool, nargs='?', const=True, default=os.getenv('GITRB_INCREMENTAL', dv), help=f"Only write files which differ from those on disk, tracked in --cache-dir. Default {dv}.")
+    dv = 'False'; g.add_argument("--prune", metavar='bool', type=str2bool, nargs='?', const=True, default=os.getenv('GITRB_PRUNE', dv), help=f"Delete files an earlier --incremental download wrote, which the artifact no longer has. Default {dv}.")
+    dv = 'copy'; g.add_argument("--link", choices=LINK_MODES, default=os.getenv('GITRB_LINK', dv), help=f"Link files from a blob cache below --cache-dir, shared by all downloads on this host, instead of writing copies. Hardlinked files are read-only. Falls back to copy where unsupported. Default {dv}.")
+    dv = '10240'; g.add_argument("--blob-cache-max", metavar='MiB', type=int, default=os.getenv('GITRB_BLOB_CACHE_MAX', dv), help=f"Max size of the blob cache of --link. Default {dv}.")
+    dv = 'False'; g.add_argument("--to-stdout", metavar='bool', type=str2bool, nargs='?', const=True, default=os.getenv('GITRB_TO_STDOUT', dv), help=f"Stream the artifact to stdout as an archive, instead of writing its files. Nothing is written next to the source tree. Default {dv}.")
+    dv = 'tar'; g.add_argument("--format", metavar='|'.join(ARCHIVE_FORMATS), choices=list(ARCHIVE_FORMATS), default=os.getenv('GITRB_ARCHIVE_FORMAT', dv), help=f"Archive format of --to-stdout. tar.zst needs zstd installed. Default {dv}.")
+    g.add_argument("--include", metavar='glob', action='append', default=None, help="Only fetch and check out files matching glob, relative to the artifact's root. Repeatable. Default from GITRB_INCLUDE, whitespace-separated.")
 
     g = commands.add_parser("cat-meta", parents=[top_parser], add_help=False, help="cat meta-data for artifact")
     add_remote_arg(g)
@@ -101,7 +127,7 @@ def parse_args(args=None):
             queries.append(RelPathQuery(args.relpath))
 
         if len(queries) > 1:
-            args.query = AndQuery(queries)
+            args.query = AndQuery(*queries)
         else:
             args.query = queries[0] if queries else None
 
@@ -109,6 +135,21 @@ def parse_args(args=None):
 
     ignore_attr_except(patch_query, args)
 
+    def patch_latest(args):
+        if args.command != "list" or args.latest is None:
+            return
+        args.sort = args.sort or "src-commit-time"
+        args.limit = args.latest if args.limit is None else min(args.limit, args.latest)
+
+    ignore_attr_except(patch_latest, args)
+
+    def patch_include(args):
+        # Not an argparse default, as `append` would add given globs to it, rather than replacing it
+        if args.command == "download" and args.include is None:
+            args.include = os.getenv('GITRB_INCLUDE', '').split() or None
+
+    ignore_attr_except(patch_include, args)
+
     printer.verbosity = args.verbosity
     printer.colorize = args.color
 
@@ -120,6 +161,23 @@ def parse_args(args=None):
     except AttributeError:
         pass
 
+    try:
+        if args.prune and not args.incremental:
+            printer.error("Error: `--prune` requires `--incremental`")
+            return None
+    except AttributeError:
+        pass
+
+    try:
+        if args.to_stdout and len(args.artifacts) > 1:
+            printer.error("Error: `--to-stdout` streams one artifact, not several")
+            return None
+        if args.to_stdout and args.include:
+            printer.error("Error: `--to-stdout` streams whole artifacts, it can't be combined with `--include`")
+            return None
+    except AttributeError:
+        pass
+
     try:
         args.remote
     except AttributeError:
@@ -1,8 +1,9 @@
 import os
 import sys
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass, field
 
-from .utils.string import sanitize_branch_name, trim_all_lines
+from .utils.string import sanitize_branch_name, sanitize_ref_component, trim_all_lines
 from .utils.date import (
     date_fuzzy2expiryformat,
     DATE_FMT_GIT,
@@ -48,9 +49,22 @@ class ArtifactCommitInfo:
     bin_time_commit: str
     bin_sha_only_metadata: str
     bin_ref_only_metadata: str
+    bin_ref_name_metadata: str
     custom_trailers: dict[str, str] = field(default_factory=dict)
 
 
+META_FOR_NAME_PREFIX = "refs/artifact/meta-for-name/"
+
+def meta_for_name_ref(artifact_name: str, tree_prefix: str, src_sha: str, bin_sha: str) -> str:
+    """
+        Ref to [meta data]-only, named by artifact name and tree prefix, so listing can skip non-matching artifacts
+        without fetching their meta-data. Always exactly four components after the prefix, so it parses unambiguously.
+        Name and tree-prefix are lossy-encoded to single components: Equal encoding does not imply equal values.
+        E.g.: 'refs/artifact/meta-for-name/doc/{obj_doc_html}/{src_sha}/{bin_sha}'
+    """
+    return f"{META_FOR_NAME_PREFIX}{sanitize_ref_component(artifact_name)}/{sanitize_ref_component(f'{{{tree_prefix}}}')}/{src_sha}/{bin_sha}"
+
+
 def create_artifact_commit(rbgit,
                            artifact_name: str,
                            binpath: str,
@@ -58,9 +72,13 @@ def create_artifact_commit(rbgit,
                            add_ignored: bool = False,
                            src_remote_name: str = "origin",
                            cwd: str | None = None,
-                           custom_trailers: dict[str, str] = {}
+                           custom_trailers: dict[str, str] = {},
+                           hash_jobs: int = 1
                            ) -> ArtifactCommitInfo:
-    """ Create Artifact: A binary commit, with builtin traceability and expiry """
+    """
+    Create Artifact: A binary commit, with builtin traceability and expiry.
+    hash_jobs other than 1 hashes and packs the artifact's files in that many processes, 0 for one per CPU.
+    """
     if not os.path.exists(binpath):
         raise RuntimeError(f"Artifact '{binpath}' does not exist!")
 
@@ -72,22 +90,22 @@ def create_artifact_commit(rbgit,
     bin_branch_expire = date_fuzzy2expiryformat(expire_branch)
 
     artifact_mime = classify_path(binpath)
-    src_sha = exec(["git", "rev-parse", "HEAD"], cwd=cwd)  # Sample the full SHA once
-    src_sha_msg = exec(["git", "show", "--no-patch", "--format=%B", src_sha], cwd=cwd)
+    src = src_snapshot(src_remote_name, cwd)  # Sample the full SHA once
+    src_sha = src.sha
+    src_sha_msg = src.msg
     src_sha_title = src_sha_msg.split('\n')[0]  # title is first line of commit-msg
 
-    src_repo_url = exec(["git", "config", "--get", f"remote.{src_remote_name}.url"])
+    src_repo_url = src.repo_url
     src_repo = os.path.basename(src_repo_url)
 
     # Source of artifact relative to source and NCA dir
-    src_tree_root = exec(["git", "rev-parse", "--show-toplevel"], cwd=cwd)
+    src_tree_root = src.tree_root
     nca_dir = nca_path(src_tree_root, binpath)                        # Longest shared path between gitroot and artifact. Is either {gitroot, something outside gitroot}
     artifact_relpath_nca = rel_dir(pto=binpath, pfrom=nca_dir)        # Artifact is always within nca_dir
     artifact_relpath_src = rel_dir(pto=binpath, pfrom=src_tree_root)  # Relative path to artifact from src-git-root. Artifact might be outside of source git.
 
-    src_branch, src_status, src_ahead, src_behind = src_branch_status(cwd)
-
-    src_time_author, src_time_commit = src_time_info(src_sha, cwd)
+    src_branch, src_status, src_ahead, src_behind = src.branch, src.status, src.commits_ahead, src.commits_behind
+    src_time_author, src_time_commit = src.time_author, src.time_commit
 
     # Commit Message
     commmit_info = {
@@ -119,20 +137,12 @@ def create_artifact_commit(rbgit,
     # E.g.: 'artifact/latest/project.git@main/{obj/doc/html}'
     bin_tag_name = f"artifact/latest/{src_repo}@{src_branch}/{{{artifact_relpath_nca}}}" if src_branch != "HEAD" else None
 
-    rbgit.checkout_orphan_idempotent(bin_branch_name)
-
     printer.high_level(f"Adding '{binpath}' as '{artifact_relpath_nca}' ...", file=sys.stderr)
-    changes = rbgit.add(binpath, force=add_ignored)
-    if changes:
-        # Set {author,committer}-dates: Make our new commit reproducible by copying from the source; do not sample the current time.
-        # Sampling the current time would lead to new commit SHA every time, thus not idempotent.
-        os.environ['GIT_AUTHOR_DATE'] = src_time_author
-        os.environ['GIT_COMMITTER_DATE'] = src_time_commit
-        rbgit.cmd("commit", "--file", "-", "--quiet", "--no-status", "--untracked-files=no", input=bin_commit_msg)
-        bin_sha_commit = rbgit.cmd("rev-parse", "HEAD").strip()
+    tree = rbgit.write_tree_of(binpath, force=add_ignored, jobs=hash_jobs)
+    if tree is None:
+        bin_sha_commit = commit_via_index(rbgit, binpath, bin_branch_name, bin_commit_msg, add_ignored, src_time_author, src_time_commit)
     else:
-        bin_sha_commit = rbgit.cmd("rev-parse", "HEAD").strip()  # We already checked-out idempotently
-        printer.high_level(f"No changes for the next commit. Already at {bin_sha_commit}", file=sys.stderr)
+        bin_sha_commit = commit_tree(rbgit, tree, bin_branch_name, bin_commit_msg, src_time_author, src_time_commit)
     bin_time_commit = rbgit.cmd("show", "-s", "--format=%cd", f"--date=format:{DATE_FMT_EXPIRE}", bin_sha_commit).strip()
 
     printer.high_level(f"Artifact commit: {bin_sha_commit}", file=sys.stderr)
@@ -150,8 +160,12 @@ def create_artifact_commit(rbgit,
     # Create new ref for the artifact-commit, pointing to [Meta data]-only.
     bin_ref_only_metadata = f"refs/artifact/meta-for-commit/{src_sha}/{bin_sha_commit}"
     rbgit.cmd("update-ref", bin_ref_only_metadata, bin_sha_only_metadata)
+    # Same meta-data, but under a ref that also tells the artifact's name and tree-prefix.
+    bin_ref_name_metadata = meta_for_name_ref(artifact_name, artifact_relpath_nca, src_sha, bin_sha_commit)
+    rbgit.cmd("update-ref", bin_ref_name_metadata, bin_sha_only_metadata)
 
     printer.high_level(f"Artifact [meta data]-only ref: {bin_ref_only_metadata}", file=sys.stderr)
+    printer.high_level(f"Artifact [meta data]-only ref: {bin_ref_name_metadata}", file=sys.stderr)
     printer.high_level(f"Artifact [meta data]-only obj: {bin_sha_only_metadata}", file=sys.stderr)
 
     return ArtifactCommitInfo(
@@ -183,40 +197,115 @@ def create_artifact_commit(rbgit,
         bin_time_commit=bin_time_commit,
         bin_sha_only_metadata=bin_sha_only_metadata,
         bin_ref_only_metadata=bin_ref_only_metadata,
+        bin_ref_name_metadata=bin_ref_name_metadata,
         custom_trailers=custom_trailers
     )
 
-def src_branch_status(cwd):
-    src_status = exec(["git", "status", "--porcelain=1", "--untracked-files=no"], cwd=cwd)
-    if src_status == "":
-        src_status = "clean"
+def set_commit_dates(time_author: str, time_commit: str):
+    # Set {author,committer}-dates: Make our new commit reproducible by copying from the source; do not sample the current time.
+    # Sampling the current time would lead to new commit SHA every time, thus not idempotent.
+    os.environ['GIT_AUTHOR_DATE'] = time_author
+    os.environ['GIT_COMMITTER_DATE'] = time_commit
+
+
+def commit_tree(rbgit, tree: str, branch_name: str, commit_msg: str, time_author: str, time_commit: str) -> str:
+    """
+    Commit tree on branch, as `commit` would after adding the same files to the branch checked out, so with same SHA.
+    Unless the branch has that tree already, keeping idempotency.
+    """
+    branch_ref = f"refs/heads/{branch_name}"
+    try:
+        parent = rbgit.cmd("rev-parse", "--verify", "--quiet", branch_ref).strip()
+    except RuntimeError:
+        parent = None  # New branch, so an orphan commit
+    if parent and rbgit.cmd("rev-parse", f"{parent}^{{tree}}").strip() == tree:
+        printer.high_level(f"No changes for the next commit. Already at {parent}", file=sys.stderr)
+        bin_sha_commit = parent
     else:
-        src_status = trim_all_lines(src_status)
-    src_branch = exec(["git", "rev-parse", "--abbrev-ref", "HEAD"], cwd=cwd)
-    if src_branch == "HEAD":
-        # We are in detached HEAD and thus can't determine the upstream tracking branch
-        src_commits_ahead   = ""
-        src_commits_behind  = ""
+        set_commit_dates(time_author, time_commit)
+        msg = rbgit.cmd("stripspace", input=commit_msg)  # Cleaned up like `commit` does
+        # Unlike `commit`, `commit-tree` ignores commit.gpgSign
+        sign = ["-S"] if rbgit.cmd("config", "--type=bool", "--default=false", "commit.gpgSign").strip() == "true" else []
+        bin_sha_commit = rbgit.cmd("commit-tree", tree, *(["-p", parent] if parent else []), *sign, input=msg).strip()
+        rbgit.cmd("update-ref", branch_ref, bin_sha_commit)
+    rbgit.cmd("symbolic-ref", "HEAD", branch_ref)  # Where checkout would have left it
+    return bin_sha_commit
+
+
+def commit_via_index(rbgit, binpath: str, branch_name: str, commit_msg: str, add_ignored: bool, time_author: str, time_commit: str) -> str:
+    """ Check out branch, add binpath and commit. For what only an index can record, see RbGit.write_tree_of """
+    rbgit.checkout_orphan_idempotent(branch_name)
+    changes = rbgit.add(binpath, force=add_ignored)
+    if changes:
+        set_commit_dates(time_author, time_commit)
+        rbgit.cmd("commit", "--file", "-", "--quiet", "--no-status", "--untracked-files=no", input=commit_msg)
+        bin_sha_commit = rbgit.cmd("rev-parse", "HEAD").strip()
     else:
-        src_branch_upstream = exec(["git", "for-each-ref", "--format=%(upstream:short)", f"refs/heads/{src_branch}"], cwd=cwd)
-        if src_branch_upstream == "":
-            src_commits_ahead = ""
-            src_commits_behind = ""
-        else:
-            src_commits_ahead = exec(["git", "rev-list", "--count", f"{src_branch_upstream}..{src_branch}"], cwd=cwd)
-            src_commits_behind = exec(["git", "rev-list", "--count", f"{src_branch}..{src_branch_upstream}"], cwd=cwd)
-    src_commits_ahead = src_commits_ahead if src_commits_ahead != "" else "?"
-    src_commits_behind = src_commits_behind if src_commits_behind != "" else "?"
-    return src_branch, src_status, src_commits_ahead, src_commits_behind
-
-def src_time_info(src_sha, cwd):
+        bin_sha_commit = rbgit.cmd("rev-parse", "HEAD").strip()  # We already checked-out idempotently
+        printer.high_level(f"No changes for the next commit. Already at {bin_sha_commit}", file=sys.stderr)
+    return bin_sha_commit
+
+
+@dataclass
+class SrcSnapshot:
+    """ State of the source repo, as recorded in an artifact's meta-data """
+    sha: str
+    msg: str
+    time_author: str
+    time_commit: str
+    tree_root: str
+    repo_url: str
+    branch: str          # "HEAD" when detached
+    status: str          # "clean", or one line per changed tracked file, like `git status --porcelain=1`
+    commits_ahead: str   # Of upstream. "?" if unknown, e.g. detached or without upstream
+    commits_behind: str
+
+
+def src_snapshot(src_remote_name: str, cwd: str | None = None) -> SrcSnapshot:
+    """
+    Sample the source repo in four git calls. Status, the slow one on big work trees, runs meanwhile the others.
+    It skips untracked files, so costs only a refresh of the index, which git speeds up by fsmonitor if configured.
+    """
     # Author time is when the commit was first committed.
     # Author time is easily set with `git commit --date`.
-    src_time_author = exec(["git", "show", "-s", "--format=%ad", f"--date=format:{DATE_FMT_GIT}", src_sha], cwd=cwd)
-
     # Committer time changes every time the commit-SHA changes, for example {rebasing, amending, ...}.
     # Committer time can be set with $GIT_COMMITTER_DATE or `git rebase --committer-date-is-author-date`.
     # Committer time is monotonically increasing but sampled locally, so graph could still be non-monotonic if a collaborator has a very wrong clock.
-    src_time_commit = exec(["git", "show", "-s", "--format=%cd", f"--date=format:{DATE_FMT_GIT}", src_sha], cwd=cwd)
+    log_cmd = ["git", "log", "-1", "--format=%H%x00%ad%x00%cd%x00%B", f"--date=format:{DATE_FMT_GIT}", "HEAD"]
+    status_cmd = ["git", "status", "--porcelain=2", "--branch", "--ahead-behind", "--untracked-files=no"]
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        status = pool.submit(exec, status_cmd, cwd=cwd)
+        sha, time_author, time_commit, msg = exec(log_cmd, cwd=cwd).split("\0", 3)
+        tree_root = exec(["git", "rev-parse", "--show-toplevel"], cwd=cwd)
+        repo_url = exec(["git", "config", "--get", f"remote.{src_remote_name}.url"], cwd=cwd)
+        branch, changes, ahead, behind = parse_status_v2(status.result())
+
+    return SrcSnapshot(sha=sha, msg=msg.strip(), time_author=time_author, time_commit=time_commit,
+                       tree_root=tree_root, repo_url=repo_url, branch=branch,
+                       status=trim_all_lines(changes) if changes else "clean",
+                       commits_ahead=ahead, commits_behind=behind)
+
 
-    return src_time_author, src_time_commit
+def parse_status_v2(output: str) -> tuple[str, str, str, str]:
+    """
+    Branch, changes, and commits ahead and behind upstream, from `git status --porcelain=2 --branch`.
+    Changes are formatted like `--porcelain=1`, as meta-data has always had them.
+    """
+    branch, ahead, behind = "HEAD", "?", "?"
+    changes = []
+    for line in output.splitlines():
+        if line.startswith("# branch.head "):
+            head = line[len("# branch.head "):]
+            branch = "HEAD" if head == "(detached)" else head
+        elif line.startswith("# branch.ab "):
+            # Only given for an upstream which exists
+            plus_ahead, minus_behind = line[len("# branch.ab "):].split()
+            ahead, behind = plus_ahead[1:], minus_behind[1:]
+        elif line[:2] in ("1 ", "u "):
+            fields = line.split(" ", 8 if line[0] == "1" else 10)
+            changes.append(f"{fields[1].replace('.', ' ')} {fields[-1]}")
+        elif line.startswith("2 "):
+            fields = line.split(" ", 9)
+            path, orig_path = fields[-1].split("\t")
+            changes.append(f"{fields[1].replace('.', ' ')} {orig_path} -> {path}")
+    return branch, "\n".join(changes), ahead, behind
@@ -0,0 +1,107 @@
+import sys
+import json
+import hashlib
+from typing import Callable
+
+from .printer import printer
+from .rbgit import LEASE_REJECTIONS
+
+# Single ref holding a blob with the meta-data of all live artifacts, so listing needs one fetch instead of N.
+# The index only accelerates: meta-for-commit refs stay authoritative for which artifacts exist.
+INDEX_REF = "refs/artifact/index"
+INDEX_HEADER = "# git-recycle-bin artifact index v1"
+
+
+def blob_sha(content: str) -> str:
+    """ Git object name of a blob with content, i.e. what `git hash-object --stdin` yields """
+    data = content.encode()
+    return hashlib.sha1(b"blob %d\0" % len(data) + data).hexdigest()
+
+
+def index_emit(entries: dict[str, str]) -> str:
+    """ Serialize {meta_sha: meta-data content} as one line per artifact, sorted by meta_sha """
+    lines = [INDEX_HEADER]
+    lines += [f"{meta_sha} {json.dumps(content)}" for meta_sha, content in sorted(entries.items())]
+    return "\n".join(lines) + "\n"
+
+
+def index_parse(text: str) -> dict[str, str]:
+    """
+    Inverse of index_emit.
+    Entries whose content does not hash to their meta_sha are dropped, so a corrupt index can't lie.
+    """
+    entries = {}
+    for line in text.splitlines():
+        if not line or line.startswith("#"):
+            continue
+        meta_sha, content = line.split(" ", maxsplit=1)
+        content = json.loads(content)
+        if len(meta_sha) == 40 and blob_sha(content) != meta_sha:
+            printer.debug(f"Index entry {meta_sha} does not match its content, ignoring it", file=sys.stderr)
+            continue
+        entries[meta_sha] = content
+    return entries
+
+
+def remote_index_sha(rbgit, remote_bin_name: str) -> str | None:
+    return rbgit.ref_snapshot(remote_bin_name).get(INDEX_REF)
+
+
+# Blobs never change, so the parsed index of a SHA can be reused by later lookups in the same invocation
+_loaded_index: dict[str, dict[str, str]] = {}
+
+
+def remote_index_load(rbgit, remote_bin_name: str, index_sha: str | None) -> dict[str, str]:
+    if index_sha is None:
+        return {}
+    if index_sha not in _loaded_index:
+        _loaded_index.clear()
+        _loaded_index[index_sha] = index_parse(rbgit.fetch_cat_batch(remote_bin_name, [index_sha])[index_sha])
+    return dict(_loaded_index[index_sha])
+
+
+def remote_index_update(rbgit, remote_bin_name: str,
+                        update: Callable[[dict[str, str]], dict[str, str]],
+                        tries: int = 10) -> bool:
+    """
+        Read-modify-write of the remote index, as a compare-and-swap:
+        The push only succeeds with --force-with-lease if nobody updated the index since we read it.
+        On losing a race against a concurrent pusher, re-read their index and apply update again.
+        Other failures, e.g. an unreachable remote, aren't tried again.
+        The index is an accelerator only, so failure is reported but not fatal.
+    """
+    while tries > 0:
+        tries -= 1
+        old_sha = remote_index_sha(rbgit, remote_bin_name)
+        old_entries = remote_index_load(rbgit, remote_bin_name, old_sha)
+        new_entries = update(dict(old_entries))
+        if new_entries == old_entries:
+            return True
+
+        new_sha = rbgit.cmd("hash-object", "-w", "--stdin", input=index_emit(new_entries)).strip()
+        try:
+            # Empty expected value means the index ref must not exist yet
+            rbgit.cmd("push", f"--force-with-lease={INDEX_REF}:{old_sha or ''}", remote_bin_name, f"{new_sha}:{INDEX_REF}")
+            printer.detail(f"Updated {INDEX_REF} with {len(new_entries)} artifacts", file=sys.stderr)
+            return True
+        except RuntimeError as e:
+            if not any(reason in str(e) for reason in LEASE_REJECTIONS):
+                printer.error(f"Warning: Could not update {INDEX_REF}, listing will be slower until it is updated: {e}", file=sys.stderr)
+                return False
+            printer.debug(f"Lost race updating {INDEX_REF}, retrying: {e}", file=sys.stderr)
+
+    printer.error(f"Warning: Could not update {INDEX_REF}, listing will be slower until it is updated.", file=sys.stderr)
+    return False
+
+
+def remote_index_add(rbgit, remote_bin_name: str, entries: dict[str, str]) -> bool:
+    """ Add {meta_sha: meta-data content} to the remote index """
+    return remote_index_update(rbgit, remote_bin_name, lambda index: index | entries)
+
+
+def remote_index_remove(rbgit, remote_bin_name: str, meta_shas: set[str]) -> bool:
+    """ Remove meta_shas from the remote index, if the remote has an index at all """
+    if not meta_shas or remote_index_sha(rbgit, remote_bin_name) is None:
+        return True
+    return remote_index_update(rbgit, remote_bin_name,
+                               lambda index: {sha: content for sha, content in index.items() if sha not in meta_shas})
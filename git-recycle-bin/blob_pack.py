@@ -0,0 +1,166 @@
+import os
+import sys
+import mmap
+import zlib
+import struct
+import hashlib
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+from .printer import printer
+
+# Blobs of an artifact may be written straight into packs, rather than by `hash-object` as loose objects:
+#   1. Files are hashed in a process pool, as git would hash them, giving the blobs' SHAs.
+#   2. Blobs the repo lacks are split by size between the processes, each writing one pack and its index.
+# Packs are as `pack-objects` would write them without deltas, so pushes send them without a loose-object phase.
+# Hashing is as `hash-object --no-filters`, so callers keep to `hash-object` where attributes could filter files.
+MMAP_THRESHOLD = 1 << 20  # Bytes. Smaller files are read whole
+BLOCK = 1 << 20           # Bytes compressed at a time
+OBJ_BLOB = 3
+
+
+def blob_content(path: str) -> tuple[memoryview | bytes, object]:
+    """ What git stores as blob of path: Its bytes, or a symlink's target. Returns it and what to close after """
+    if os.path.islink(path):
+        return os.readlink(os.fsencode(path)), None
+    with open(path, "rb") as file:
+        if os.fstat(file.fileno()).st_size < MMAP_THRESHOLD:
+            return file.read(), None
+        mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        return memoryview(mapped), mapped
+
+
+def blob_sha(path: str) -> tuple[str, int]:
+    """ Git SHA and size of the blob of path """
+    content, mapped = blob_content(path)
+    try:
+        sha = hashlib.sha1(b"blob %d\0" % len(content))
+        sha.update(content)
+        return sha.hexdigest(), len(content)
+    finally:
+        content = None
+        if mapped:
+            mapped.close()
+
+
+def entry_header(size: int) -> bytes:
+    """ Pack entry header of a blob: Type and size, 7 bits per byte with the high bit telling more follow """
+    header = bytearray([(OBJ_BLOB << 4) | (size & 0x0f)])
+    size >>= 4
+    while size:
+        header[-1] |= 0x80
+        header.append(size & 0x7f)
+        size >>= 7
+    return bytes(header)
+
+
+def write_pack(pack_dir: str, blobs: list[tuple[str, str]]) -> str:
+    """
+    Write blobs, [(sha, path)] of distinct SHAs, as one pack with index (v2) into pack_dir. Returns the pack's name.
+    Raises if a file no longer hashes to its SHA, e.g. as it was changed meanwhile.
+    """
+    fd, tmp_pack = tempfile.mkstemp(dir=pack_dir, prefix="tmp_pack_")
+    entries = []  # (sha, crc32, offset)
+    checksum = hashlib.sha1()
+    with os.fdopen(fd, "wb") as pack:
+        def write(data):
+            checksum.update(data)
+            pack.write(data)
+
+        write(b"PACK" + struct.pack(">II", 2, len(blobs)))
+        offset = 12
+        for expected, path in blobs:
+            content, mapped = blob_content(path)
+            try:
+                sha = hashlib.sha1(b"blob %d\0" % len(content))
+                header = entry_header(len(content))
+                crc = zlib.crc32(header)
+                write(header)
+                size = len(header)
+                compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION)
+                for start in range(0, len(content), BLOCK):
+                    block = content[start:start + BLOCK]
+                    sha.update(block)
+                    data = compressor.compress(block)
+                    crc = zlib.crc32(data, crc)
+                    write(data)
+                    size += len(data)
+                data = compressor.flush()
+                crc = zlib.crc32(data, crc)
+                write(data)
+                size += len(data)
+            finally:
+                block = content = None
+                if mapped:
+                    mapped.close()
+            if sha.hexdigest() != expected:
+                os.unlink(tmp_pack)
+                raise RuntimeError(f"Artifact file '{path}' changed while being added")
+            entries.append((bytes.fromhex(expected), crc, offset))
+            offset += size
+        pack_sha = checksum.digest()
+        pack.write(pack_sha)
+
+    entries.sort()
+    small, large = [], []  # Offsets beyond 31 bits go in a table of 64 bit ones, referred to by index
+    for _, _, entry_offset in entries:
+        if entry_offset < 0x80000000:
+            small.append(entry_offset)
+        else:
+            small.append(0x80000000 | len(large))
+            large.append(entry_offset)
+    fanout = [0] * 256
+    for sha, _, _ in entries:
+        fanout[sha[0]] += 1
+    for i in range(1, 256):
+        fanout[i] += fanout[i - 1]
+    index = b"".join([
+        b"\377tOc" + struct.pack(">I", 2),
+        struct.pack(">256I", *fanout),
+        *(sha for sha, _, _ in entries),
+        struct.pack(f">{len(entries)}I", *(crc for _, crc, _ in entries)),
+        struct.pack(f">{len(small)}I", *small),
+        struct.pack(f">{len(large)}Q", *large),
+        pack_sha,
+    ])
+    name = f"pack-{pack_sha.hex()}"
+    fd, tmp_index = tempfile.mkstemp(dir=pack_dir, prefix="tmp_idx_")
+    with os.fdopen(fd, "wb") as file:
+        file.write(index + hashlib.sha1(index).digest())
+    # Git finds packs by their index, so the pack goes in place first
+    for tmp, ext in ((tmp_pack, "pack"), (tmp_index, "idx")):
+        os.chmod(tmp, 0o444)
+        os.replace(tmp, os.path.join(pack_dir, f"{name}.{ext}"))
+    return name
+
+
+def split_by_size(blobs: list[tuple[str, str, int]], parts: int) -> list[list[tuple[str, str]]]:
+    """ Split blobs, [(sha, path, size)], into at most parts lists of about equal total size. Biggest first """
+    bins = [(0, i, []) for i in range(min(parts, len(blobs)))]
+    for sha, path, size in sorted(blobs, key=lambda blob: blob[2], reverse=True):
+        total, i, part = min(bins)
+        part.append((sha, path))
+        bins[i] = (total + size, i, part)
+    return [part for _, _, part in bins]
+
+
+def write_blobs(rbgit, paths: list[str], jobs: int) -> dict[str, str]:
+    """
+    Write blobs of paths, relative to rbgit's work tree, into packs by jobs processes. Returns their SHAs by path.
+    Blobs rbgit has already, e.g. from an earlier artifact, are not written again.
+    """
+    files = [os.path.join(rbgit.rbgit_work_tree, path) for path in paths]
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        hashed = list(pool.map(blob_sha, files, chunksize=max(1, min(256, len(files) // (jobs * 4)))))
+        blobs = {sha: (file, size) for file, (sha, size) in zip(files, hashed)}
+
+        # Objects present are echoed by sha only, missing ones with " missing" after
+        checked = rbgit.cmd("cat-file", "--batch-check=%(objectname)", input="".join(f"{sha}\n" for sha in blobs))
+        missing = [(sha, *blobs[sha]) for sha, _, state in (line.partition(" ") for line in checked.splitlines()) if state]
+
+        pack_dir = os.path.join(rbgit.rbgit_dir, "objects", "pack")
+        os.makedirs(pack_dir, exist_ok=True)
+        parts = split_by_size(missing, jobs)
+        printer.detail(f"Packing {len(missing)} of {len(blobs)} blobs in {len(parts)} packs", file=sys.stderr)
+        list(pool.map(write_pack, [pack_dir] * len(parts), parts))
+    return {path: sha for path, (sha, _) in zip(paths, hashed)}
@@ -0,0 +1,156 @@
+import sys
+import time
+from typing import Callable
+
+from .printer import printer
+
+# Artifact commit X may be published in chunks, for transfers which resume after failure instead of starting over:
+#   refs/artifact/chunks/X/1..N   Chunk commits, each with the blobs of the previous chunk plus about chunk-size more
+#   refs/artifact/chunks/X/manifest   Commit with parents chunk N and X. Pushed last, so tells all chunks are there
+#   refs/artifact/chunks/X/started-T   Empty tree, pushed with the first chunk. Tells clean the push began at unix time T
+# A fetch or push of chunk k only transfers what chunk k-1 lacks, as git leaves out objects of parents the other
+# side has. Likewise the manifest brings only X's commit and trees, all blobs being in chunk N, its other parent.
+CHUNKS_REF_PREFIX = "refs/artifact/chunks/"
+CHUNK_TRIES = 5
+STARTED = "started-"
+RETRY_DELAY = 2  # Seconds, doubled per retry
+
+# Chunk commits are a function of the artifact's blobs only, so an interrupted push, which makes a new artifact
+# commit when run again, still finds its chunks on the remote
+CHUNK_ENV = {
+    "GIT_AUTHOR_NAME": "git-recycle-bin", "GIT_AUTHOR_EMAIL": "git-recycle-bin", "GIT_AUTHOR_DATE": "@0 +0000",
+    "GIT_COMMITTER_NAME": "git-recycle-bin", "GIT_COMMITTER_EMAIL": "git-recycle-bin", "GIT_COMMITTER_DATE": "@0 +0000",
+}
+EMPTY_TREE = "4b825dc642cb6eb9a060e54bf8d69288fbee4904"
+
+
+def chunk_ref(commit: str, name: str | int) -> str:
+    return f"{CHUNKS_REF_PREFIX}{commit}/{name}"
+
+
+def plan_chunks(blobs: list[tuple[str, int]], chunk_size: int) -> list[list[str]]:
+    """ Split blobs, [(sha, size)], in order into chunks of at most chunk_size bytes. Bigger blobs get a chunk each """
+    chunks = []
+    size = 0
+    for sha, blob_size in blobs:
+        if not chunks or size + blob_size > chunk_size:
+            chunks.append([])
+            size = 0
+        chunks[-1].append(sha)
+        size += blob_size
+    return chunks
+
+
+def artifact_blobs(rbgit, commit: str) -> list[tuple[str, int]]:
+    """ Distinct blobs of commit as [(sha, size)], in tree order """
+    blobs = {}
+    for record in rbgit.cmd("ls-tree", "-r", "-l", "-z", "--full-tree", commit).split("\0"):
+        if not record:
+            continue
+        meta, _ = record.split("\t", 1)
+        _, obj_type, sha, size = meta.split()
+        if obj_type == "blob":
+            blobs[sha] = int(size)
+    return list(blobs.items())
+
+
+def make_chunks(rbgit, commit: str, chunk_size: int) -> list[str]:
+    """
+    Make the chunk commits of commit, and return them in order. Their trees hold blobs named by SHA, fanned out by
+    the first two digits, so consecutive chunks share all subtrees they don't add to.
+    """
+    fanout: dict[str, list[str]] = {}
+    subtrees: dict[str, str] = {}
+    chunks = []
+    for shas in plan_chunks(artifact_blobs(rbgit, commit), chunk_size):
+        for sha in shas:
+            fanout.setdefault(sha[:2], []).append(f"100644 blob {sha}\t{sha[2:]}\n")
+        for prefix in {sha[:2] for sha in shas}:
+            subtrees[prefix] = rbgit.cmd("mktree", input="".join(fanout[prefix])).strip()
+        tree = rbgit.cmd("mktree", input="".join(f"040000 tree {sub}\t{prefix}\n" for prefix, sub in subtrees.items())).strip()
+        parent = ["-p", chunks[-1]] if chunks else []
+        chunks.append(rbgit.cmd("commit-tree", tree, *parent, "-m", f"Artifact chunk {len(chunks) + 1}", env=CHUNK_ENV).strip())
+    return chunks
+
+
+def retry(action: Callable[[], object], what: str, tries: int = CHUNK_TRIES):
+    """ Run action until it succeeds, at most tries times. Raises the last failure """
+    for attempt in range(tries):
+        try:
+            return action()
+        except RuntimeError as e:
+            if attempt + 1 == tries:
+                raise RuntimeError(f"{what} failed {tries} times, giving up: {e}")
+            delay = RETRY_DELAY * 2 ** attempt
+            printer.error(f"Warning: {what} failed, retrying in {delay}s: {e}", file=sys.stderr)
+            time.sleep(delay)
+
+
+def push_chunked(rbgit, remote_bin_name: str, commit: str, chunk_size: int, tries: int = CHUNK_TRIES) -> bool:
+    """
+    Push commit chunk by chunk, each of about chunk_size bytes and retried on failure, then its manifest.
+    Chunks the remote has, e.g. from an interrupted earlier push, are not sent again.
+    Afterwards pushing commit itself sends nothing. Returns False for an artifact without files, which has no chunks.
+    """
+    remote_has = set(rbgit.ref_snapshot(remote_bin_name).refs.values())
+    if commit in remote_has:
+        printer.detail(f"Remote artifact-repo already has {commit}, no need for chunks", file=sys.stderr)
+        return True
+
+    chunks = make_chunks(rbgit, commit, chunk_size)
+    if not chunks:
+        return False
+    manifest = rbgit.cmd("commit-tree", EMPTY_TREE, "-p", chunks[-1], "-p", commit,
+                         "-m", f"Manifest of {len(chunks)} chunks of artifact {commit}", env=CHUNK_ENV).strip()
+
+    # Chunks of a push in progress look like those of an abandoned one, but for how long ago the push began
+    started = [f"{EMPTY_TREE}:{chunk_ref(commit, f'{STARTED}{int(time.time())}')}"]
+    known = []
+    for number, chunk in enumerate(chunks, start=1):
+        refspec = f"{chunk}:{chunk_ref(commit, number)}"
+        if chunk in remote_has:
+            printer.detail(f"Remote artifact-repo already has chunk {number} of {len(chunks)}", file=sys.stderr)
+            known.append(refspec)
+            continue
+        printer.high_level(f"Pushing to remote artifact-repo: Chunk {number} of {len(chunks)}", file=sys.stderr)
+        retry(lambda: rbgit.cmd("push", remote_bin_name, refspec, *started), f"Push of chunk {number}", tries)
+        started = []
+    if known or started:
+        retry(lambda: rbgit.cmd("push", remote_bin_name, *known, *started), "Push of known chunks", tries)  # Refs only, no objects
+    retry(lambda: rbgit.cmd("push", remote_bin_name, f"{manifest}:{chunk_ref(commit, 'manifest')}"), "Push of manifest", tries)
+    return True
+
+
+def remote_chunks(snapshot, commit: str) -> list[tuple[str, str]] | None:
+    """ Refs and SHAs of commit's chunks, in order and ending with its manifest. None unless all were pushed """
+    prefix = chunk_ref(commit, "")
+    refs = {ref[len(prefix):]: (ref, sha) for sha, ref in snapshot.prefix(prefix)}
+    manifest = refs.pop("manifest", None)
+    if manifest is None:
+        return None
+    return [refs[name] for name in sorted((name for name in refs if name.isdigit()), key=int)] + [manifest]
+
+
+def fetch_chunked(git: Callable[..., str], remote: str, commit: str, chunks: list[tuple[str, str]],
+                  tries: int = CHUNK_TRIES):
+    """
+    Fetch commit by its chunks, see remote_chunks, each retried on failure. Every fetched chunk is kept under its
+    ref, both to tell the remote what we have and so chunks fetched by an earlier, failed, invocation are skipped.
+    git is e.g. RbGit.cmd, of the repo to fetch into.
+    """
+    for number, (ref, sha) in enumerate(chunks, start=1):
+        what = f"chunk {number} of {len(chunks) - 1}" if number < len(chunks) else "manifest"
+        try:
+            if git("rev-parse", "--verify", "--quiet", ref).strip() == sha:
+                printer.detail(f"Already have {what} of {commit}", file=sys.stderr)
+                continue
+        except RuntimeError:
+            pass  # Not fetched yet
+        printer.high_level(f"Fetching {what} of {commit}", file=sys.stderr)
+        retry(lambda: git("fetch", "--no-tags", "--no-write-fetch-head", remote, f"+{ref}:{ref}"),
+              f"Fetch of {what} of {commit}", tries)
+
+    # git verified each object's content against its SHA. What remains is that the manifest was for commit
+    manifest_ref, _ = chunks[-1]
+    if git("rev-parse", f"{manifest_ref}^2").strip() != commit:
+        raise RuntimeError(f"Manifest {manifest_ref} is not for artifact {commit}")
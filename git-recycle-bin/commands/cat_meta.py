@@ -1,16 +1,19 @@
 from git_recycle_bin.rbgit import RbGit
+from git_recycle_bin.meta_cache import MetaCache, fetch_metas
 
 def cat_metas(rbgit: RbGit,
               remote_bin_name: str,
-              commits: list[str]) -> dict[str, str]:
-    for sha, content in metas_for_commits(rbgit, remote_bin_name, commits).items():
+              commits: list[str],
+              cache: MetaCache | None = None,
+              jobs: int = 1) -> dict[str, str]:
+    for sha, content in metas_for_commits(rbgit, remote_bin_name, commits, cache, jobs).items():
         print(f"--- {sha} ---")
         print(content)
 
 def metas_for_commits(rbgit: RbGit,
                       remote_bin_name: str,
-                      commits: list[str]) -> dict[str, str]:
-    meta_datas = {}
-    for commit in commits:
-        content = rbgit.fetch_cat_pretty(remote_bin_name, commit)
-        meta_datas[commit] = content
+                      commits: list[str],
+                      cache: MetaCache | None = None,
+                      jobs: int = 1) -> dict[str, str]:
+    entries = fetch_metas(rbgit, remote_bin_name, commits, cache, jobs=jobs)
+    return {commit: entries[commit]["content"] for commit in commits}
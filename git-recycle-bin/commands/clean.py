@@ -1,17 +1,22 @@
+import time
 import datetime
 from dateutil.tz import tzlocal
 
 from git_recycle_bin.utils.date import (
-    parse_expire_date,
-    date_parse_formatted,
+    date_expire_from_branch,
     format_timespan,
-    DATE_FMT_EXPIRE,
 )
 from git_recycle_bin.printer import printer
+from git_recycle_bin.artifact_index import remote_index_remove
+from git_recycle_bin.chunked_transfer import CHUNKS_REF_PREFIX, STARTED
+
+# Seconds a chunked push may take, including its resumption after failure, before clean deems it abandoned
+CHUNKS_GRACE = 7 * 24 * 3600
 
 def clean(rbgit, remote_bin_name):
     remote_delete_expired_branches(rbgit, remote_bin_name)
     remote_flush_meta_for_commit(rbgit, remote_bin_name)
+    remote_flush_chunks(rbgit, remote_bin_name)
 
 
 def remote_delete_expired_branches(rbgit, remote_bin_name):
@@ -21,22 +26,13 @@ def remote_delete_expired_branches(rbgit, remote_bin_name):
         See https://docs.gitlab.com/ee/administration/housekeeping.html
     """
     branch_prefix = "artifact/expire/"
-    lines = rbgit.cmd("ls-remote", "--heads", remote_bin_name, f"refs/heads/{branch_prefix}*").splitlines()
+    refs = rbgit.ref_snapshot(remote_bin_name).prefix(f"refs/heads/{branch_prefix}")
 
     now = datetime.datetime.now(tzlocal())
 
-    for line in lines:
-        _, branch = line.split(maxsplit=1)
-
-        # Timezone may be absent, but we insist on date and time
-        date_time_tz = parse_expire_date(branch)
-        if date_time_tz['date'] == None: continue
-        if date_time_tz['time'] == None: continue
-        if date_time_tz['tzoffset'] == None:
-            date_time_tz['tzoffset'] = datetime.datetime.strftime(now, "%z")
-
-        compliant_expire_string = f"{date_time_tz['date']}/{date_time_tz['time']}{date_time_tz['tzoffset']}"
-        expiry = date_parse_formatted(date_string=compliant_expire_string, date_format=DATE_FMT_EXPIRE)
+    for _, branch in refs:
+        expiry = date_expire_from_branch(branch, now)
+        if expiry is None: continue
         delta_formatted = format_timespan(dt_from=now, dt_to=expiry)
 
         if expiry.timestamp() > now.timestamp():
@@ -50,25 +46,55 @@ def remote_delete_expired_branches(rbgit, remote_bin_name):
 def remote_flush_meta_for_commit(rbgit, remote_bin_name):
     """
         Every artifact has traceability metadata in the commit message. However we can not fetch the commit
-        message without fetching the whole artifact too. Hence we have meta-for-commit refs, which point to
-        blobs of only metadata. This way we can obtain metadata without downloading potentially big artifacts.
+        message without fetching the whole artifact too. Hence we have meta-for-commit and meta-for-name refs,
+        which point to blobs of only metadata. This way we can obtain metadata without downloading potentially big artifacts.
 
         The artifacts are kept clean either by their built-in expiry-dates or by whoever creating the artifact
         maintaining it, but there is no hook to clean the corresponding meta-for-commit ref.
 
         This subroutine will scan all existing meta-for-commit references and determine if an artifact is still
-        available. If not, the metadata commit will be removed.
+        available. If not, the metadata commit will be removed - and so will its entry in the artifact index.
     """
-    meta_set = rbgit.meta_for_commit_refs(remote_bin_name)
-    heads    = rbgit.cmd("ls-remote", "--heads", remote_bin_name, "refs/heads/*").splitlines()
-    tags     = rbgit.cmd("ls-remote", "--tags", remote_bin_name, "refs/tags/*").splitlines()
+    # All from one ref snapshot: a single ls-remote
+    meta_set = rbgit.meta_for_commit_refs(remote_bin_name) + rbgit.meta_for_name_refs(remote_bin_name)
+    snapshot = rbgit.ref_snapshot(remote_bin_name)
 
     sha_len = 40
-    commits = { l[-sha_len:]: l[sha_len+1:] for l in meta_set }
-    heads = { l[:sha_len] for l in heads }
-    tags  = { l[:sha_len] for l in tags }
-    branches = [ refspec for commit_sha, refspec in commits.items()
+    # Both meta-for-commit and meta-for-name refs end with the artifact commit SHA
+    commits = [ (l[-sha_len:], l[sha_len+1:]) for l in meta_set ]
+    heads = { sha for sha, _ in snapshot.prefix("refs/heads/") }
+    tags  = { sha for sha, _ in snapshot.prefix("refs/tags/") }
+    branches = [ refspec for commit_sha, refspec in commits
                  if commit_sha not in heads and commit_sha not in tags
                 ]
     if branches:
         rbgit.cmd("push", remote_bin_name, "--delete", *branches)
+
+        # Meta-data blobs still referenced by a surviving meta ref stay in the index
+        metas = [ l.split() for l in meta_set ]
+        deleted = { meta_sha for meta_sha, refspec in metas if refspec in branches }
+        alive   = { meta_sha for meta_sha, refspec in metas if refspec not in branches }
+        remote_index_remove(rbgit, remote_bin_name, deleted - alive)
+
+
+def remote_flush_chunks(rbgit, remote_bin_name, grace: int = CHUNKS_GRACE):
+    """
+        Artifacts pushed with --chunk-size have chunk refs, see chunked_transfer, which keep their objects alive.
+        Delete those of artifacts no longer available, and those left by pushes which failed before the artifact
+        itself was pushed. Unless the push began less than grace seconds ago, as it may still be in progress, or
+        be resumed. Chunk refs of older versions tell no start, so are deleted regardless.
+    """
+    snapshot = rbgit.ref_snapshot(remote_bin_name)
+    heads = { sha for sha, _ in snapshot.prefix("refs/heads/") }
+    tags  = { sha for sha, _ in snapshot.prefix("refs/tags/") }
+    started = {}
+    for _, ref in snapshot.prefix(CHUNKS_REF_PREFIX):
+        commit, name = ref[len(CHUNKS_REF_PREFIX):].split("/")
+        if name.startswith(STARTED):
+            started[commit] = max(int(name[len(STARTED):]), started.get(commit, 0))
+    recent = { commit for commit, since in started.items() if since > time.time() - grace }
+    refs = [ ref for _, ref in snapshot.prefix(CHUNKS_REF_PREFIX)
+             if ref[len(CHUNKS_REF_PREFIX):].split("/")[0] not in heads | tags | recent
+            ]
+    if refs:
+        rbgit.cmd("push", remote_bin_name, "--delete", *refs)
@@ -1,10 +1,20 @@
+import os
 import re
+import fnmatch
+import shutil
+import sys
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor
 
 from git_recycle_bin.printer import printer
-from git_recycle_bin.commands.list import remote_artifacts, ListResult
+from git_recycle_bin.commands.list import ListResult
+from git_recycle_bin.chunked_transfer import fetch_chunked, remote_chunks
+from git_recycle_bin.materialize import BlobCache, StatCache, TreeEntry, materialize, parse_ls_tree
+from git_recycle_bin.meta_cache import MetaCache, fetch_metas
+from git_recycle_bin.object_store import ObjectStore
 from git_recycle_bin.rbgit import create_rbgit, RbGit
+from git_recycle_bin.telemetry import telemetry
 from git_recycle_bin.utils.extern import exec
-from git_recycle_bin.utils.string import sanitize_slashes
 
 
 def download_refs(rbgit: RbGit,
@@ -12,19 +22,65 @@ def download_refs(rbgit: RbGit,
              artifacts: list[str],
              force: bool = False,
              rm_tmp: bool = True,
+             cache: MetaCache | None = None,
+             jobs: int = 1,
+             store_dir: str | None = None,
+             include: list[str] | None = None,
+             stat_cache: StatCache | None = None,
+             prune: bool = False,
+             blob_cache: BlobCache | None = None,
              ):
-    """Download artifacts by their refspecs, i.e <src_sha>/<artifact_sha> or <artifact_sha>"""
+    """
+    Download artifacts by their refspecs, i.e <src_sha>/<artifact_sha> or <artifact_sha>, or unique prefixes thereof.
+    If store_dir is given, artifacts are kept in a persistent object store there, see ObjectStore.
+    If include globs are given, only matching files are fetched and checked out.
+    If stat_cache is given, only changed files are written, see materialize.
+    If blob_cache is given, files are linked from there, and only blobs it lacks are fetched, see BlobCache.
+    """
+
+    with telemetry.phase("resolve"):
+        artifact_data = resolve_artifacts(rbgit, remote_bin_name, artifacts, cache=cache, jobs=jobs)
+    store = ObjectStore(store_dir, rbgit.get_remote_url(remote_bin_name)) if store_dir else None
+    err = download(rbgit, remote_bin_name, artifact_data, force=force, rm_tmp=rm_tmp, store=store, jobs=jobs, include=include,
+                   stat_cache=stat_cache, prune=prune, blob_cache=blob_cache)
+    if len(artifact_data) < len(artifacts):
+        return 1  # Those not found were reported by resolve_artifacts
+    return err
+
+
+def resolve_artifacts(rbgit: RbGit,
+                      remote_bin_name: str,
+                      artifacts: list[str],
+                      cache: MetaCache | None = None,
+                      jobs: int = 1,
+                      ) -> list[ListResult]:
+    """
+    Find the artifacts given as <src_sha>/<artifact_sha> or <artifact_sha>, where each SHA may be a unique prefix.
+    Matched by the names of meta-for-commit refs, so only the matching artifacts' meta-data is fetched.
+    Artifacts which are not found, or are ambiguous, are reported and skipped.
+    """
+    prefix = "refs/artifact/meta-for-commit/"
+    refs = [(meta_sha, ref[len(prefix):].split("/")) for meta_sha, ref in rbgit.ref_snapshot(remote_bin_name).prefix(prefix)]
 
-    artifact_metas = remote_artifacts(rbgit, remote_bin_name, query=None, all_shas=True)
-    metas = refspec_map(artifact_metas)
-    artifact_data = []
+    resolved = []
     for artifact in artifacts:
-        try:
-            artifact_data.append(metas[artifact])
-        except KeyError:
-            printer.error(f"Artifact {artifact} not found in remote.")
-            continue
-    return download(rbgit, remote_bin_name, artifact_data, force=force, rm_tmp=rm_tmp)
+        src_query, _, bin_query = artifact.strip().rpartition("/")
+        matches = {}
+        for meta_sha, (src_sha, bin_sha) in (refs if bin_query else []):
+            if bin_sha.startswith(bin_query) and src_sha.startswith(src_query):
+                matches.setdefault(bin_sha, meta_sha)  # Same artifact is the same, whichever src commit refers it
+        if not matches:
+            printer.error(f"Artifact {artifact} not found in remote.", file=sys.stderr)
+        elif len(matches) > 1:
+            printer.error(f"Artifact {artifact} is ambiguous, it matches: {' '.join(sorted(matches))}", file=sys.stderr)
+        else:
+            resolved.append(next(iter(matches.items())))
+
+    metas = fetch_metas(rbgit, remote_bin_name, [meta_sha for _, meta_sha in resolved], cache, jobs=jobs)
+    return [
+        ListResult(meta_sha=meta_sha, artifact_sha=bin_sha, meta_data=metas[meta_sha]["meta_data"])
+        for bin_sha, meta_sha in resolved
+    ]
 
 
 def download(rbgit: RbGit,
@@ -32,71 +88,240 @@ def download(rbgit: RbGit,
              artifacts: list[ListResult],
              force: bool = False,
              rm_tmp: bool = True,
+             store: ObjectStore | None = None,
+             jobs: int = 1,
+             include: list[str] | None = None,
+             stat_cache: StatCache | None = None,
+             prune: bool = False,
+             blob_cache: BlobCache | None = None,
              ):
+    """
+    Download artifacts, each into the source tree at its src-git-relpath.
+
+    All artifact commits are fetched at once, into store if given, else into rbgit. Download repos read them
+    from there, and write their files concurrently, see materialize. Artifacts sharing a download repo, which
+    may overlap, are written one after the other.
 
+    With include globs, artifacts are fetched without blobs. Then only the blobs of matching files are fetched,
+    and only those files are written. With a blob_cache likewise, but only blobs it lacks are fetched.
+    Artifacts already in store are read from there, but partial artifacts are never added to it, as the store
+    holds complete artifacts only.
+
+    Otherwise, artifacts pushed in chunks are fetched chunk by chunk, see chunked_transfer, so a failed fetch
+    resumes from the last chunk fetched.
+
+    With a stat_cache, files already up to date are not rewritten, and with prune, files earlier downloads wrote,
+    which the artifacts no longer have, are deleted.
+
+    A failing artifact doesn't stop the others. Ends with a summary, and returns 1 if any artifact failed.
+    """
+    if not artifacts:
+        return None
+
+    shas = list(dict.fromkeys(artifact.artifact_sha for artifact in artifacts))
+    errors: dict[str, str | None] = {}
+    partial = include or blob_cache is not None
+
+    # Group by download repo, as artifacts of the same src-git-relpath may share one
+    groups: dict[str, list[ListResult]] = {}
     rbgits = {}
-    url = rbgit.get_remote_url(remote_bin_name)
+    for artifact in artifacts:
+        tmp_rbgit = create_rbgit(artifact_path=artifact.meta_data['src-git-relpath'], clean=False)
+        if tmp_rbgit.rbgit_work_tree not in rbgits:
+            rbgits[tmp_rbgit.rbgit_work_tree] = tmp_rbgit
+            if store:
+                store.link(tmp_rbgit)
+            if partial or not store:
+                tmp_rbgit.add_alternate(os.path.join(rbgit.rbgit_dir, "objects"))
+        groups.setdefault(tmp_rbgit.rbgit_work_tree, []).append(artifact)
+
+    def fetch_all(objs_of: dict[str, list[str]], fetch):
+        """ Fetch objects of all artifacts, {artifact_sha: objs}, at once """
+        try:
+            fetch([obj for objs in objs_of.values() for obj in objs])
+        except RuntimeError as e:
+            # E.g. one artifact was deleted meanwhile. Fetch each on its own, so only that one fails
+            printer.detail(f"Fetching all artifacts at once failed, fetching one by one: {e}", file=sys.stderr)
+            for sha, objs in objs_of.items():
+                try:
+                    fetch(objs)
+                except RuntimeError as e:
+                    errors[sha] = str(e).strip()
+
+    paths: dict[str, list[str] | None] = {sha: None for sha in shas}
+
+    def download_group(work_tree: str):
+        tmp_rbgit = rbgits[work_tree]
+        for artifact in groups[work_tree]:
+            if artifact.artifact_sha in errors:
+                continue
+            try:
+                materialize(tmp_rbgit, artifact.artifact_sha, prefix=artifact.meta_data['artifact-tree-prefix'],
+                            paths=paths[artifact.artifact_sha], force=force, stat_cache=stat_cache, prune=prune,
+                            blob_cache=blob_cache)
+                errors[artifact.artifact_sha] = None
+            except RuntimeError as e:
+                errors[artifact.artifact_sha] = str(e).strip()
 
-    err = None
     try:
-        for artifact in artifacts:
-            rel_path = artifact.meta_data['src-git-relpath']
-            tree_prefix = artifact.meta_data['artifact-tree-prefix']
-            name = sanitize_slashes(tree_prefix)
+        # Blobs the blob cache has are not fetched, so keep it from evicting them until they are placed
+        with blob_cache.lock() if blob_cache else nullcontext():
+            with telemetry.phase("fetch"):
+                if partial:
+                    stored = set(shas) - set(store.missing(shas)) if store else set()
+                    rbgit.make_partial_clone(remote_bin_name)
+                    fetch_all({sha: [sha] for sha in shas if sha not in stored},
+                              lambda objs: rbgit.fetch_batch(remote_bin_name, objs, jobs=jobs, filter="blob:none"))
 
-            tmp_rbgit = create_rbgit(artifact_path=rel_path, clean=False)
-            rbgits[tmp_rbgit.rbgit_work_tree] = tmp_rbgit
-            tmp_rbgit.add_remote_idempotent(name=name, url=url)
-            err = download_single(tmp_rbgit, name, artifact.artifact_sha, path=tree_prefix, force=force)
-            if err is not None:
-                break
+                    blobs = {}
+                    for work_tree, group in groups.items():
+                        for artifact in group:
+                            sha = artifact.artifact_sha
+                            if sha in errors or sha in blobs:
+                                continue
+                            selected = select_paths(rbgits[work_tree].cmd("ls-tree", "-r", "-z", "--full-tree", sha),
+                                                    artifact.meta_data['artifact-tree-prefix'], include)
+                            if not selected:
+                                errors[sha] = f"No files match --include {' '.join(include)}" if include else "No files"
+                                continue
+                            if include:
+                                paths[sha] = [entry.path for entry in selected]
+                            blobs[sha] = [entry.sha for entry in selected if sha not in stored and not (
+                                blob_cache and entry.mode != "120000" and blob_cache.has(entry.sha))]
+                    fetch_all(blobs, lambda objs: rbgit.fetch_batch(remote_bin_name, objs, jobs=jobs))
+                elif store:
+                    chunks = all_remote_chunks(rbgit, remote_bin_name, shas)
+                    fetch_all({sha: [sha] for sha in shas}, lambda objs: store.fetch(objs, ssh_command=rbgit.ssh_command, chunks=chunks))
+                else:
+                    chunks = all_remote_chunks(rbgit, remote_bin_name, shas)
+
+                    def fetch(objs: list[str]):
+                        for sha in objs:
+                            if sha in chunks:
+                                fetch_chunked(rbgit.cmd, remote_bin_name, sha, chunks[sha])
+                        rbgit.fetch_batch(remote_bin_name, [sha for sha in objs if sha not in chunks], jobs=jobs)
+                    fetch_all({sha: [sha] for sha in shas}, fetch)
+
+            # Writing files is local disk work, so use all cores, regardless of how many concurrent fetches the remote takes
+            with telemetry.phase("write"), ThreadPoolExecutor(max_workers=min(len(groups), os.cpu_count() or 1)) as pool:
+                list(pool.map(download_group, groups))
     finally:
-        if rm_tmp:
-            for path, tmp_rbgit in rbgits.items():
-                if path != rbgit.rbgit_work_tree:
-                    tmp_rbgit.cleanup()
-    return err
+        with telemetry.phase("cleanup"):
+            if rm_tmp:
+                for path, tmp_rbgit in rbgits.items():
+                    if path != rbgit.rbgit_work_tree:
+                        tmp_rbgit.cleanup()
+            if blob_cache:
+                blob_cache.evict()
+
+    for artifact in artifacts:
+        err = errors[artifact.artifact_sha]
+        path = artifact.meta_data['artifact-tree-prefix']
+        if err is None:
+            printer.high_level(f"Downloaded {artifact.artifact_sha} to {path}", file=sys.stderr)
+        else:
+            printer.error(f"Failed to download {artifact.artifact_sha} to {path}: {err}", file=sys.stderr)
+    failed = [sha for sha, err in errors.items() if err is not None]
+    if failed:
+        printer.error(f"{len(failed)} of {len(errors)} artifacts failed to download.", file=sys.stderr)
+        return 1
+    return None
+
+
+def all_remote_chunks(rbgit: RbGit, remote_bin_name: str, shas: list[str]) -> dict[str, list[tuple[str, str]]]:
+    """ Chunks of those artifacts which were pushed in chunks, see remote_chunks """
+    snapshot = rbgit.ref_snapshot(remote_bin_name)
+    chunks = {sha: remote_chunks(snapshot, sha) for sha in shas}
+    return {sha: refs for sha, refs in chunks.items() if refs}
+
+
+def select_paths(ls_tree_output: str, tree_prefix: str, include: list[str] | None) -> list[TreeEntry]:
+    """
+    Files of an artifact matching any include glob, from `ls-tree -r -z --full-tree` of its commit. All if include
+    is None. Globs are relative to the artifact's root, tree_prefix, and match a file or any directory it is in.
+    """
+    selected = []
+    for entry in parse_ls_tree(ls_tree_output):
+        if entry.path == tree_prefix:
+            rel_path = os.path.basename(entry.path)  # Artifact is a single file
+        elif entry.path.startswith(tree_prefix + "/"):
+            rel_path = entry.path[len(tree_prefix) + 1:]
+        else:
+            continue
+        parts = rel_path.split("/")
+        candidates = ["/".join(parts[:i]) for i in range(1, len(parts) + 1)]
+        if include is None or any(fnmatch.fnmatchcase(candidate, glob.rstrip("/"))
+                                  for candidate in candidates for glob in include):
+            selected.append(entry)
+    return selected
 
 
 def download_single(rbgit: RbGit, remote_bin_name: str, artifact_sha: str,
                     path: str | None = None,
-                    force: bool = False):
-    rbgit.cmd("fetch", remote_bin_name, artifact_sha)
-    if force:
-        if path:
-            rbgit.cmd("checkout", "-f", artifact_sha, path)
-        else:
-            rbgit.cmd("checkout", "-f", artifact_sha)
+                    force: bool = False,
+                    fetch: bool = True,
+                    paths: list[str] | None = None):
+    """
+    Write the files of artifact_sha at path into rbgit's work tree, or only those in paths if given.
+    Files are written directly, see materialize, so no index or HEAD is involved.
+    """
+    if fetch:
+        fetch_artifact(rbgit, remote_bin_name, artifact_sha)
+    # dont fail with python stack trace if file already exists
+    try:
+        materialize(rbgit, artifact_sha, prefix=path or "", paths=paths, force=force)
+    except RuntimeError as e:
+        printer.error(e)
+        return 1
+
+
+def fetch_artifact(rbgit: RbGit, remote_bin_name: str, artifact_sha: str):
+    """ Fetch artifact_sha, chunk by chunk if it was pushed in chunks """
+    chunks = remote_chunks(rbgit.ref_snapshot(remote_bin_name), artifact_sha)
+    if chunks:
+        fetch_chunked(rbgit.cmd, remote_bin_name, artifact_sha, chunks)
     else:
-        # dont fail with python stack trace if file already exists
-        try:
-            if path:
-                rbgit.cmd("checkout", artifact_sha, path)
-            else:
-                rbgit.cmd("checkout", artifact_sha)
-        except RuntimeError as e:
-            printer.error(e)
-            printer.error("Use --force to overwrite local files.")
-            return 1
+        rbgit.cmd("fetch", "--no-tags", remote_bin_name, artifact_sha)
+
+
+# Formats of download --to-stdout, with the git config making `git archive` produce them
+ARCHIVE_FORMATS = {
+    "tar": [],
+    "tar.zst": ["-c", "tar.tar.zst.command=zstd -c -T0"],
+}
 
 
-def refspec_map(artifacts: list[ListResult]) -> dict[str, ListResult]:
+def download_to_stdout(rbgit: RbGit,
+                       remote_bin_name: str,
+                       artifact: str,
+                       format: str = "tar",
+                       cache: MetaCache | None = None,
+                       store_dir: str | None = None):
     """
-    Given an iterable of tuples (meta_sha, refspec), convert into a map of
-    {
-        "<src_sha>/<artifact_sha>": (meta_sha_blob, artifact_sha),
-        "artifact_sha": (meta_sha_blob, artifact_sha),
-    }
+    Stream the files of an artifact to stdout as an archive of format, with paths as in the artifact commit,
+    i.e. below its artifact-tree-prefix. Read straight from the fetched commit by `git archive`, so no file is
+    written, and rbgit needs no work tree.
     """
-    map = {}
-    for artifact in artifacts:
-        artifact_sha_commit = artifact.artifact_sha.strip()
-        _src_sha, artifact_sha = artifact_sha_commit.split('/')
-        res = ListResult(
-            meta_sha=artifact.meta_sha,
-            artifact_sha=artifact_sha,
-            meta_data=artifact.meta_data
-        )
-        map[artifact_sha_commit] = res
-        map[artifact_sha] = res
-    return map
+    with telemetry.phase("resolve"):
+        resolved = resolve_artifacts(rbgit, remote_bin_name, [artifact], cache=cache)
+    if not resolved:
+        return 1
+    sha = resolved[0].artifact_sha
+    try:
+        if format == "tar.zst" and shutil.which("zstd") is None:
+            raise RuntimeError("Format tar.zst needs the zstd command, which is not installed")
+        with telemetry.phase("fetch"):
+            if store_dir:
+                store = ObjectStore(store_dir, rbgit.get_remote_url(remote_bin_name))
+                store.fetch([sha], ssh_command=rbgit.ssh_command, chunks=all_remote_chunks(rbgit, remote_bin_name, [sha]))
+                store.link(rbgit)
+            else:
+                fetch_artifact(rbgit, remote_bin_name, sha)
+        sys.stdout.flush()  # git writes to our stdout directly, after anything we wrote
+        with telemetry.phase("archive"):
+            rbgit.cmd(*ARCHIVE_FORMATS[format], "archive", f"--format={format}", sha, capture_output=False)
+    except RuntimeError as e:
+        printer.error(f"Failed to stream {sha}: {str(e).strip()}", file=sys.stderr)
+        return 1
+    printer.high_level(f"Streamed {sha} as {format}", file=sys.stderr)
+    return None
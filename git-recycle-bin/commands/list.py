@@ -1,13 +1,29 @@
+import os
+import sys
 import json
-from dataclasses import dataclass
+import heapq
+import datetime
+import itertools
+import subprocess
+from dateutil.tz import tzlocal
+from dataclasses import dataclass, asdict
+from typing import Iterable, Iterator
 
 from git_recycle_bin.rbgit import RbGit
 from git_recycle_bin.printer import printer
-from git_recycle_bin.utils.extern import exec, jq
-from git_recycle_bin.utils.string import sanitize_branch_name
-from git_recycle_bin.utils.string import sanitize_branch_name
+from git_recycle_bin.utils.extern import exec, JqStream, JqError
+from git_recycle_bin.utils.string import sanitize_branch_name, sanitize_ref_component
 from git_recycle_bin.query import Query, RelPathQuery, PathQuery, NameQuery, JqQuery, AndQuery
+from git_recycle_bin.meta_cache import MetaCache, fetch_metas
+from git_recycle_bin.artifact_index import INDEX_REF
+from git_recycle_bin.artifact_commit import META_FOR_NAME_PREFIX
 from git_recycle_bin.commit_msg import parse_commit_msg
+from git_recycle_bin.utils.date import date_expire_from_branch, date_formatted2unix, DATE_FMT_GIT
+
+# Orders of `list --sort`, newest first. Artifact commits get their source commit's committer time, to be
+# reproducible, so bin-commit-time orders the same as src-commit-time.
+SORT_KEYS = ["src-commit-time", "bin-commit-time", "expiry"]
+META_FOR_COMMIT_PREFIX = "refs/artifact/meta-for-commit/"
 
 
 @dataclass
@@ -22,72 +38,188 @@ def remote_artifacts(rbgit: RbGit,
                      remote_bin_name: str,
                      query: Query | None,
                      sha: str | None = None,
-                     all_shas: bool = False) -> list[str, str]:
+                     all_shas: bool = False,
+                     cache: MetaCache | None = None,
+                     limit: int | None = None,
+                     jobs: int = 1,
+                     sort: str | None = None) -> Iterator[ListResult]:
     """
-    Returns a list of all of pairs of (metadata sha, artifact sha) for which
-    query is valid
+    Yields artifacts for which query is valid, as soon as their meta-data is fetched.
+    If limit is given, stops after that many artifacts, without fetching meta-data for the rest.
+    If sort is given, yields newest first by that key of SORT_KEYS.
     """
 
-    artifacts = remote_artifacts_unfiltered(rbgit, remote_bin_name, sha=sha, all_shas=all_shas)
-
-    if query is None:
-        return artifacts
+    # First fetch is sized to satisfy limit if all its artifacts match. Without limit all are needed, so fetched at once
+    artifacts = remote_artifacts_unfiltered(rbgit, remote_bin_name, sha=sha, all_shas=all_shas, cache=cache,
+                                            prefilter=query, chunk=limit, jobs=jobs, sort=sort)
 
-    printer.debug(f"Filtering artifacts by {query.__class__.name} with {{ {query.query()} }}")
+    if query is not None:
+        printer.debug(f"Filtering artifacts by {query.__class__.__name__} with {{ {query.query()} }}")
+        artifacts = filter_artifacts(artifacts, query)
 
-    return filter_artifacts(artifacts, query)
+    return itertools.islice(artifacts, limit)
 
-def filter_artifacts(artifacts: list[ListResult], query) -> list[ListResult]:
+def filter_artifacts(artifacts: Iterable[ListResult], query) -> Iterator[ListResult]:
+    # A generator, so a failing query is raised while listing, like any later failure of it
     filter_func = query_to_fun(query)
-    return [
-        artifact
-        for artifact in artifacts
-        if filter_func(artifact)
-    ]
+    for artifact in artifacts:
+        if filter_func(artifact):
+            yield artifact
 
 def remote_artifacts_unfiltered(rbgit: RbGit,
                                 remote_bin_name: str,
                                 all_shas: bool = False,
-                                sha: str | None = None
-                                ) -> list[str, str]:
+                                sha: str | None = None,
+                                cache: MetaCache | None = None,
+                                prefilter: Query | None = None,
+                                chunk: int | None = None,
+                                jobs: int = 1,
+                                sort: str | None = None,
+                                ) -> Iterator[ListResult]:
     """
-    Fetch all artifacts from the remote repository.
+    Yield all artifacts from the remote repository.
     artifacts is a pair of the meta_data_sha and the artifact sha it references
     If all_shas is True, fetch all artifacts artifact sha will be <src_sha>/<artifact_sha>
     O.w. <artifact_sha>.
     If sha is given, only fetch artifacts for that specific commit sha.
+    If cache is given, only meta-data not already in cache is fetched.
+    If prefilter is given, artifacts whose meta-for-name ref shows they can't match it are skipped without
+    fetching their meta-data. The remaining artifacts still need filtering. If prefilter requires a name, only
+    its meta-for-name refs are fetched, with their meta-data. Artifacts of older versions, without meta-for-name
+    refs, are still found by their meta-for-commit refs.
+    Meta-data is fetched in batches of chunk, doubling in size for every batch, or all in one batch if chunk is
+    None. Each batch is split between jobs concurrent fetches.
+    If sort is given, artifacts are yielded newest first by that key, see sort_pairs.
     """
     refs = refs_path(sha=sha, all_shas=all_shas)
-    lines = rbgit.cmd("ls-remote", "--refs", remote_bin_name, f"{refs}*").splitlines()
-    printer.debug(f"{lines}")
-    artifacts = []
-    for line in lines:
-        meta_sha, artifact_sha = line.split()
-        artifact_sha = artifact_sha.strip()[len(refs):]
-        artifacts.append(ListResult(
-            meta_sha=meta_sha,
-            artifact_sha=artifact_sha,
-            meta_data=meta_data(rbgit, remote_bin_name, meta_sha)
-        ))
-    return artifacts
+    excluded = name_prefilter(prefilter) if prefilter is not None else None
+
+    # Meta refs, meta-for-name refs and the artifact index all come from the same ref snapshot
+    snapshot = rbgit.ref_snapshot(remote_bin_name)
+    index_sha = snapshot.get(INDEX_REF)
+    pairs = [(meta_sha, ref[len(refs):], ref.split("/", 3)[3]) for meta_sha, ref in snapshot.prefix(refs)]
+    printer.debug(f"{pairs}")
+    names = {}
+    if excluded is not None:
+        for _, ref in snapshot.prefix(META_FOR_NAME_PREFIX):
+            ref_name, tree_prefix, src_sha, bin_sha = ref[len(META_FOR_NAME_PREFIX):].split("/")
+            names[f"{src_sha}/{bin_sha}"] = (ref_name, tree_prefix)
+    metas = {}
+
+    name = required_name(prefilter) if prefilter is not None else None
+    if name:
+        # Of a name, its meta-for-name refs are fetched, and the meta-data they point to comes along
+        named = []
+        for meta_sha, ref in rbgit.fetch_refs(remote_bin_name, f"{META_FOR_NAME_PREFIX}{name}/").prefix(META_FOR_NAME_PREFIX):
+            ref_name, tree_prefix, src_sha, bin_sha = ref[len(META_FOR_NAME_PREFIX):].split("/")
+            if f"{META_FOR_COMMIT_PREFIX}{src_sha}/".startswith(refs) and not excluded(ref_name, tree_prefix):
+                named.append((meta_sha, f"{src_sha}/{bin_sha}" if all_shas else bin_sha, f"{src_sha}/{bin_sha}"))
+        printer.debug(f"Artifacts named {name} by their meta-for-name refs: {named}")
+        contents = rbgit.cat_file_batch(list(dict.fromkeys(meta_sha for meta_sha, _, _ in named))) if named else {}
+        metas = {meta_sha: {"content": content, "meta_data": parse_commit_msg(content)} for meta_sha, content in contents.items()}
+        # Artifacts pushed by older versions have no meta-for-name ref, so are found by their meta-for-commit ref
+        keys = {key for _, _, key in named}
+        pairs = named + [pair for pair in pairs if pair[2] not in names and pair[2] not in keys]
+    elif names:
+        # Artifacts pushed by older versions have no meta-for-name ref, those are never skipped
+        kept = [pair for pair in pairs if pair[2] not in names or not excluded(*names[pair[2]])]
+        printer.debug(f"Skipping meta-data of {len(pairs) - len(kept)} artifacts by their meta-for-name refs")
+        pairs = kept
+
+    if sort is not None:
+        pairs, sort_metas = sort_pairs(rbgit, remote_bin_name, snapshot, pairs, sort, cache, index_sha, jobs, metas)
+        metas |= sort_metas
+
+    # Batched fetch and cat-file of uncached meta-data blobs, not a round trip per artifact.
+    # With chunk, batches double in size: The first artifacts are yielded after one small fetch and a consumer
+    # that stops early saves fetching the rest, while needing more takes only log2(N) round trips.
+    pairs = iter(pairs)
+    while batch := list(itertools.islice(pairs, chunk)):
+        missing = [meta_sha for meta_sha, _, _ in batch if meta_sha not in metas]
+        if missing:
+            metas |= fetch_metas(rbgit, remote_bin_name, missing, cache, index_sha, jobs)
+        for meta_sha, artifact_sha, _ in batch:
+            yield ListResult(
+                meta_sha=meta_sha,
+                artifact_sha=artifact_sha,
+                meta_data=metas[meta_sha]["meta_data"]
+            )
+        if chunk is not None:
+            chunk *= 2
+
+def sort_pairs(rbgit: RbGit, remote_bin_name: str, snapshot, pairs: list, sort: str,
+               cache: MetaCache | None, index_sha: str | None, jobs: int, metas: dict | None = None):
+    """
+    Order pairs of (meta_sha, artifact_sha, "src_sha/bin_sha") newest first by sort key.
+    Returns an iterator of the ordered pairs, and the meta-data which had to be fetched to learn keys.
+    metas is meta-data at hand already, by meta_sha.
+
+    Keys are learnt without fetching meta-data where possible: Expiry is in branch names of the ref snapshot.
+    Commit times are in the local source repo, if it has the artifact's source commit. Only the rest needs
+    meta-data, which may be cached. Pairs are popped from a heap, so only as many are ordered as are consumed.
+    """
+    known = metas or {}
+    metas = {}
+    if sort == "expiry":
+        expiries = branch_expiries(snapshot)
+        keys = [expiries.get(key.split("/")[1], float("-inf")) for _, _, key in pairs]  # Expired and deleted
+    else:
+        times = src_commit_times({key.split("/")[0] for _, _, key in pairs})
+        unknown = [meta_sha for meta_sha, _, key in pairs if key.split("/")[0] not in times]
+        printer.debug(f"Commit time of {len(pairs) - len(unknown)} artifacts known locally, {len(unknown)} need meta-data")
+        metas = {meta_sha: known[meta_sha] for meta_sha in unknown if meta_sha in known}
+        metas |= fetch_metas(rbgit, remote_bin_name, [meta_sha for meta_sha in unknown if meta_sha not in known], cache, index_sha, jobs)
+        keys = [
+            times[key.split("/")[0]] if meta_sha not in metas else
+            date_formatted2unix(metas[meta_sha]["meta_data"]["src-git-commit-time-commit"], DATE_FMT_GIT)
+            for meta_sha, _, key in pairs
+        ]
+
+    # Ties are broken by artifact sha, so order is deterministic
+    heap = [(-key, pair[1], pair) for key, pair in zip(keys, pairs)]
+    heapq.heapify(heap)
+    def pop():
+        while heap:
+            yield heapq.heappop(heap)[2]
+    return pop(), metas
+
+def branch_expiries(snapshot) -> dict[str, float]:
+    """ Latest expiry of every artifact commit, as unix time, from its expire branches """
+    now = datetime.datetime.now(tzlocal())
+    expiries = {}
+    for bin_sha, branch in snapshot.prefix("refs/heads/artifact/expire/"):
+        expiry = date_expire_from_branch(branch, now)
+        if expiry is not None:
+            expiries[bin_sha] = max(expiry.timestamp(), expiries.get(bin_sha, float("-inf")))
+    return expiries
+
+def src_commit_times(src_shas: set[str]) -> dict[str, float]:
+    """ Committer time of those src_shas which the local source repo has """
+    try:
+        lines = exec(["git", "log", "--no-walk=unsorted", "--ignore-missing", "--stdin", "--format=%H %ct"],
+                     input="\n".join(src_shas) + "\n")
+    except (subprocess.CalledProcessError, OSError):
+        return {}  # Not in a source repo
+    return {sha: float(time) for sha, time in (line.split() for line in lines.splitlines())}
 
 def refs_path(sha: str | None = None, all_shas: bool = False):
     """
-    Return appropriate refs path based on the given parameters. I.e. the prefix for the
-    glob used in ls-remote. if all_shas is set we want all meta-for-commit refs. if sha is specified
+    Return appropriate refs path based on the given parameters. I.e. the prefix of the
+    refs to list. if all_shas is set we want all meta-for-commit refs. if sha is specified
     we want only that specific commit. Otherwise we want the current HEAD commit.
     Meta-data is stored at: refs/artifact/meta-for-commit/{src_sha}/{artifact_sha}
     So we either search for refs/artifact/meta-for-commit/ or refs/artifact/meta-for-commit/{sha}/
     """
     if all_shas:
-        return "refs/artifact/meta-for-commit/"
+        return META_FOR_COMMIT_PREFIX
     if sha is not None:
-        return f"refs/artifact/meta-for-commit/{sha}/"
+        return f"{META_FOR_COMMIT_PREFIX}{sha}/"
 
     src_sha = exec(["git", "rev-parse", "HEAD"])
-    return f"refs/artifact/meta-for-commit/{src_sha}/"
+    return f"{META_FOR_COMMIT_PREFIX}{src_sha}/"
 
 def query_to_fun(query: Query):
+    """ Predicate of a ListResult for query. Raises JqError, see JqStream, for a jq query that can't be run """
     if isinstance(query, PathQuery):
         return lambda m: filter_artifact_by_path(m, query.query())
     if isinstance(query, RelPathQuery):
@@ -95,13 +227,41 @@ def query_to_fun(query: Query):
     if isinstance(query, NameQuery):
         return lambda m: filter_artifact_by_name(m, query.query())
     if isinstance(query, JqQuery):
-        return lambda m: jq_filter(m, query.query())
+        # One jq process serves all artifacts
+        jq_stream = JqStream(query.query())
+        return lambda m: jq_filter(m, jq_stream)
     if isinstance(query, AndQuery):
         queries = [query_to_fun(q) for q in query.queries]
         def _and(meta_data):
             return all(q(meta_data) for q in queries)
         return _and
 
+def required_name(query: Query) -> str | None:
+    """ Name every artifact matching query has, as encoded in meta-for-name refs. None if query has no name part """
+    if isinstance(query, NameQuery):
+        return sanitize_ref_component(sanitize_branch_name(query.query()))
+    if isinstance(query, AndQuery):
+        return next((name for name in map(required_name, query.queries) if name is not None), None)
+    return None
+
+def name_prefilter(query: Query):
+    """
+    Returns a function of the name and tree-prefix components of a meta-for-name ref, which is True if query
+    certainly rejects that artifact. Components are encoded lossily, so only unequal encodings are certain.
+    Returns None if query has no name or path part to decide on.
+    """
+    if isinstance(query, NameQuery):
+        name = sanitize_ref_component(sanitize_branch_name(query.query()))
+        return lambda ref_name, ref_tree_prefix: ref_name != name
+    if isinstance(query, PathQuery):
+        tree_prefix = sanitize_ref_component(f"{{{query.query()}}}")
+        return lambda ref_name, ref_tree_prefix: ref_tree_prefix != tree_prefix
+    if isinstance(query, AndQuery):
+        excluders = [e for e in (name_prefilter(q) for q in query.queries) if e is not None]
+        if excluders:
+            return lambda *components: any(e(*components) for e in excluders)
+    return None
+
 def filter_artifact_by_name(result: ListResult, query: str):
     return result.meta_data['artifact-name'] == sanitize_branch_name(query)
 
@@ -111,14 +271,26 @@ def filter_artifact_by_path(result: ListResult, query: str):
 def filter_artifact_by_relpath(result: ListResult, query: str):
     return result.meta_data['src-git-relpath'] == query
 
-def jq_filter(result: ListResult, query: str):
-    meta_data_json = json.dumps(result.meta_data)
-    jq_res = jq([query], input=meta_data_json)
+def jq_filter(result: ListResult, jq_stream: JqStream):
+    jq_res = jq_stream(json.dumps(result.meta_data))
     printer.debug(f"jq result: {jq_res}")
-    json_value = js.loads(meta_data_json)
-    return bool(json_value)
+    return jq_res
 
+def format_artifact(artifact: ListResult, format: str = "sha") -> str:
+    """ One line of list output. jsonl lines are self-contained, so consumers can act on each as it arrives """
+    if format == "jsonl":
+        return json.dumps(asdict(artifact))
+    return artifact.artifact_sha
 
-def meta_data(rbgit, remote_bin_name, meta_data_commit):
-    data = rbgit.fetch_cat_pretty(remote_bin_name, meta_data_commit)
-    return parse_commit_msg(data)
+def print_artifacts(artifacts: Iterable[ListResult], format: str = "sha") -> int:
+    """ Print artifacts, flushing each so a pipeline like `| head -n 1` can act without waiting. Returns exit code """
+    try:
+        for artifact in artifacts:
+            print(format_artifact(artifact, format), flush=True)
+    except BrokenPipeError:
+        # Reader has seen enough. Point stdout at devnull, so the interpreter's final flush doesn't fail too
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+    except JqError as e:
+        printer.error(f"Error: {e}", file=sys.stderr)
+        return 1
+    return 0
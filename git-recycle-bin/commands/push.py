@@ -2,12 +2,14 @@ import sys
 import subprocess
 import json
 from collections import OrderedDict
+from typing import Callable
 
-from git_recycle_bin.rbgit import RbGit
+from git_recycle_bin.rbgit import LEASE_REJECTIONS, RbGit, RefSnapshot
 from git_recycle_bin.printer import printer
 from git_recycle_bin.artifact_commit import (
     create_artifact_commit,
-    ArtifactCommitInfo
+    ArtifactCommitInfo,
+    META_FOR_NAME_PREFIX,
 )
 from git_recycle_bin.commit_msg import parse_commit_msg
 from git_recycle_bin.utils.extern import exec, exec_nostderr
@@ -17,95 +19,247 @@ from git_recycle_bin.utils.date import (
     DATE_FMT_EXPIRE,
 )
 from git_recycle_bin.utils.sysinfo import get_user, get_hostname
-from git_recycle_bin.utils.string import sanitize_branch_name, sanitize_slashes
+from git_recycle_bin.utils.string import sanitize_branch_name, sanitize_slashes, sanitize_ref_component
+from git_recycle_bin.artifact_index import remote_index_add
+from git_recycle_bin.chunked_transfer import push_chunked
+from git_recycle_bin.telemetry import telemetry
 from .clean import remote_delete_expired_branches, remote_flush_meta_for_commit
 
 
 def push(rbgit, remote_bin_name, path, args) -> ArtifactCommitInfo:
     printer.high_level(f"Making local commit of artifact {path} in artifact-repo at {rbgit.rbgit_dir}", file=sys.stderr)
-    commit_info = create_artifact_commit(rbgit,
-                                         args.name,
-                                         path,
-                                         args.expire,
-                                         args.add_ignored,
-                                         args.src_remote_name,
-                                         custom_trailers=args.trailers)
+    with telemetry.phase("commit"):
+        commit_info = create_artifact_commit(rbgit,
+                                             args.name,
+                                             path,
+                                             args.expire,
+                                             args.add_ignored,
+                                             args.src_remote_name,
+                                             custom_trailers=args.trailers,
+                                             hash_jobs=args.hash_jobs)
     printer.detail(rbgit.cmd("branch", "-vv"), file=sys.stderr)
     printer.detail(rbgit.cmd("log", "-1", commit_info.bin_branch_name), file=sys.stderr)
 
     rbgit.add_remote_idempotent(name=remote_bin_name, url=args.remote)
-    push_branch(rbgit, remote_bin_name, commit_info, args.force_branch)
-    if args.push_tag:
-        push_tag(rbgit, remote_bin_name, commit_info, args.force_tag)
+    if args.delta_base:
+        with telemetry.phase("base"):
+            fetch_delta_base(rbgit, remote_bin_name, commit_info)
+    with telemetry.phase("push"):
+        if args.chunk_size:
+            # Objects of the artifact get to the remote in resumable chunks. The pushes below then send only refs
+            push_chunked(rbgit, remote_bin_name, commit_info.bin_sha_commit, args.chunk_size << 20)
+        push_artifact(rbgit, remote_bin_name, commit_info, args.force_branch, args.push_tag, args.force_tag)
+    if args.index:
+        printer.high_level("Adding artifact meta-data to remote artifact index", file=sys.stderr)
+        with telemetry.phase("index"):
+            remote_index_add(rbgit, remote_bin_name, {commit_info.bin_sha_only_metadata: commit_info.bin_commit_msg})
     if args.push_note:
-        note_append_push(args, commit_info)
+        with telemetry.phase("note"):
+            note_append_push(args, commit_info)
     return commit_info
 
-def _push_commit(rbgit: RbGit, remote_bin_name: str, commit: str, force: bool):
-    if force:
-        rbgit.cmd("push", "--force", remote_bin_name, commit, capture_output=False)
-    else:
-        _push_if_not_exists(rbgit, remote_bin_name, commit)
+# Source commits searched, newest first, for one with an artifact to push against
+BASE_HISTORY = 1000
 
-def _push_if_not_exists(rbgit, remote_bin_name, commit):
-    if rbgit.remote_already_has_ref(remote_bin_name, commit):
-        printer.always(f"Remote artifact-repo already has {commit} -- and we won't force push.")
-    else:
-        rbgit.cmd("push", remote_bin_name, commit, capture_output=False)
+# Attempts of a push, each planned from a fresh snapshot of the remote's refs, when pushers race for the same refs
+PUSH_TRIES = 3
+META_FOR_COMMIT_PREFIX = "refs/artifact/meta-for-commit/"
+
+# A ref update is (source, destination ref, expected value of destination), the latter "" for must not exist
+RefUpdate = tuple[str, str, str]
 
-def push_branch(rbgit, remote_bin_name, commit_info: ArtifactCommitInfo, force: bool = False):
-    """
-        Push branch to binary remote.
 
-        Push branch first, then meta-data (we don't want meta-data to be pushed if branch push fails).
-        Branch might exist already upstream.
+def push_updates(rbgit: RbGit, remote_bin_name: str, updates: list[RefUpdate]):
+    """
+        Push all updates at once: One negotiation, one pack, and with --atomic all refs are updated or none.
+        Each is leased at its expected value, so anything changed since we looked is not overwritten.
         Pushing may take long, so always show stdout and stderr without capture.
     """
-    printer.high_level(f"Pushing to remote artifact-repo: Artifact data on branch {commit_info.bin_branch_name}", file=sys.stderr)
-    _push_commit(rbgit, remote_bin_name, commit_info.bin_branch_name, force)
+    leases = [f"--force-with-lease={dst}:{expected}" for _, dst, expected in updates]
+    refspecs = [f"{src}:{dst}" for src, dst, _ in updates]
+    try:
+        rbgit.cmd("push", "--atomic", *leases, remote_bin_name, *refspecs, capture_output=False, tee_stderr=True)
+    except RuntimeError as e:
+        if "does not support --atomic" not in str(e):
+            raise
+        printer.high_level("Remote artifact-repo can't push atomically, pushing without", file=sys.stderr)
+        rbgit.cmd("push", *leases, remote_bin_name, *refspecs, capture_output=False, tee_stderr=True)
 
-    printer.high_level(f"Pushing to remote artifact-repo: Artifact meta-data {commit_info.bin_ref_only_metadata}", file=sys.stderr)
-    _push_commit(rbgit, remote_bin_name, commit_info.bin_ref_only_metadata, force)
 
-def push_tag(rbgit, remote_bin_name, commit_info: ArtifactCommitInfo, force: bool = False):
+def push_refs(rbgit: RbGit, remote_bin_name: str, plan: Callable[[RefSnapshot], list[RefUpdate]], tries: int = PUSH_TRIES):
     """
-        Push tag to binary remote.
+        Push what plan makes of a snapshot of the remote's refs. Planned again if a lease rejected the push.
+        What was pushed is told once, after the push that succeeded.
+    """
+    for attempt in range(tries):
+        updates = plan(rbgit.ref_snapshot(remote_bin_name))
+        if not updates:
+            return
+        try:
+            push_updates(rbgit, remote_bin_name, updates)
+            break
+        except RuntimeError as e:
+            if attempt + 1 == tries or not any(reason in str(e) for reason in LEASE_REJECTIONS):
+                raise  # E.g. the remote is unreachable or denied us, which trying again won't change
+            # The push invalidated our snapshot, so the next plan sees what others pushed meanwhile
+            printer.error("Warning: Push to remote artifact-repo was rejected, see above. Trying again", file=sys.stderr)
+    for _, dst, _ in updates:
+        printer.high_level(f"Pushed to remote artifact-repo: {dst}", file=sys.stderr)
+
+
+def branch_updates(snapshot: RefSnapshot, commit_info: ArtifactCommitInfo, force: bool = False) -> list[RefUpdate]:
+    """
+        Updates of branch, and of the meta-data refs: By commit, and by name and tree-prefix.
+        Refs might exist already upstream, and then are left as-is unless forced.
+    """
+    updates = []
+    for ref in [f"refs/heads/{commit_info.bin_branch_name}", commit_info.bin_ref_only_metadata, commit_info.bin_ref_name_metadata]:
+        theirs = snapshot.get(ref)
+        if theirs and not force:
+            printer.always(f"Remote artifact-repo already has {ref} -- and we won't force push.")
+            continue
+        updates.append((ref, ref, theirs or ""))
+    return updates
+
+
+def tag_updates(rbgit: RbGit, remote_bin_name: str, snapshot: RefSnapshot,
+                commit_info: ArtifactCommitInfo, force: bool = False) -> list[RefUpdate]:
+    """
+        Update of the 'latest' tag, if our artifact is newer than the one it points to, or forced.
     """
 
     tag = commit_info.bin_tag_name
     if not tag:
         printer.error("Error: You are in Detached HEAD, so you can't push 'latest' tag to bin-remote with name of your source branch.", file=sys.stderr)
-        return
+        return []
 
-    if commit_info.src_commits_ahead != "" and int(commit_info.src_commits_ahead) >= 1:
+    if commit_info.src_commits_ahead not in ("", "?") and int(commit_info.src_commits_ahead) >= 1:
         printer.error(f"Error: Your local branch is ahead by {commit_info.src_commits_ahead} commits of its upstream authoritative branch. Won't push tag to bin-remote.", file=sys.stderr)
-        return
+        return []
 
-    remote_bin_sha_commit = rbgit.fetch_current_tag_value(remote_bin_name, tag)
+    tag_ref = f"refs/tags/{tag}"
+    remote_bin_sha_commit = snapshot.get(tag_ref)
     if not remote_bin_sha_commit:
         printer.high_level(f"Bin-remote does not have a tag named {tag} -- we'll publish it.", file=sys.stderr)
-        rbgit.cmd("push", remote_bin_name, tag)  # Create new tag; push with force is not necessary
-        return
+        return [(tag_ref, tag_ref, "")]
+    if remote_bin_sha_commit == commit_info.bin_sha_commit:
+        printer.high_level(f"Bin-remote already has a tag named {tag} pointing to our artifact.", file=sys.stderr)
+        return []
 
     printer.high_level(f"Bin-remote already has a tag named {tag} pointing to {remote_bin_sha_commit[:8]}.", file=sys.stderr)
-    remote_meta = rbgit.fetch_cat_pretty(remote_bin_name, commit_info.bin_ref_only_metadata)
+    # Their artifact's meta-data, as in {META_FOR_COMMIT_PREFIX}{src_sha}/{bin_sha}
+    their_meta = [sha for sha, ref in snapshot.prefix(META_FOR_COMMIT_PREFIX) if ref.endswith(f"/{remote_bin_sha_commit}")]
+    if not their_meta:
+        printer.high_level("Their artifact has no meta-data, so has expired. Updating...", file=sys.stderr)
+        return [(tag_ref, tag_ref, remote_bin_sha_commit)]
+    remote_meta = rbgit.fetch_cat_batch(remote_bin_name, their_meta[:1])[their_meta[0]]
 
     commit_time_theirs = parse_commit_msg(remote_meta)['src-git-commit-time-commit']
     commit_time_ours = commit_info.src_time_commit
     commit_time_theirs_u = date_formatted2unix(commit_time_theirs, DATE_FMT_GIT)
     commit_time_ours_u = date_formatted2unix(commit_time_ours, DATE_FMT_GIT)
-    printer.high_level(f"Our artifact {commit_info.bin_sha_commit[:8]} has src committer-time:   {commit_time_ours} ({commit_time_theirs_u})", file=sys.stderr)
-    printer.high_level(f"Their artifact {remote_bin_sha_commit[:8]} has src committer-time: {commit_time_theirs} ({commit_time_ours_u})", file=sys.stderr)
+    printer.high_level(f"Our artifact {commit_info.bin_sha_commit[:8]} has src committer-time:   {commit_time_ours} ({commit_time_ours_u})", file=sys.stderr)
+    printer.high_level(f"Their artifact {remote_bin_sha_commit[:8]} has src committer-time: {commit_time_theirs} ({commit_time_theirs_u})", file=sys.stderr)
 
     if commit_time_ours_u > commit_time_theirs_u:
         printer.high_level(f"Our artifact is newer than theirs. Updating...", file=sys.stderr)
-        rbgit.cmd("push", "--force", remote_bin_name, tag)  # Push with force is necessary to update existing tag
-    else:
-        if not force:
-            printer.high_level(f"Our artifact is not newer than theirs. Leaving remote tag as-is.", file=sys.stderr)
-        else:
-            printer.high_level(f"Our artifact is not newer than theirs. Forcing update to remote tag.", file=sys.stderr)
-            rbgit.cmd("push", "--force", remote_bin_name, tag)  # Push with force is necessary to update existing tag
+        return [(tag_ref, tag_ref, remote_bin_sha_commit)]  # Leased, as which is newest was decided against theirs
+    if not force:
+        printer.high_level(f"Our artifact is not newer than theirs. Leaving remote tag as-is.", file=sys.stderr)
+        return []
+    printer.high_level(f"Our artifact is not newer than theirs. Forcing update to remote tag.", file=sys.stderr)
+    return [(tag_ref, tag_ref, remote_bin_sha_commit)]
+
+
+def push_artifact(rbgit: RbGit, remote_bin_name: str, commit_info: ArtifactCommitInfo,
+                  force_branch: bool = False, tag: bool = False, force_tag: bool = False):
+    """
+        Push branch, meta-data refs and, if tag, the 'latest' tag to binary remote, in one atomic push.
+        So meta-data is never visible without its branch, nor the tag without either.
+    """
+    def plan(snapshot: RefSnapshot) -> list[RefUpdate]:
+        updates = branch_updates(snapshot, commit_info, force_branch)
+        if tag:
+            updates += tag_updates(rbgit, remote_bin_name, snapshot, commit_info, force_tag)
+        return updates
+    push_refs(rbgit, remote_bin_name, plan)
+
+
+def previous_artifact(snapshot: RefSnapshot, commit_info: ArtifactCommitInfo, src_history: list[str]) -> str | None:
+    """
+        The remote's most recent artifact of the same tree-prefix as ours: That of our 'latest' tag, or else by
+        meta-for-name refs, that of the first source commit in src_history. Only artifacts at the tip of a branch or
+        tag count, as pushing leaves out objects of the remote's tips only. None if the remote has ours already.
+    """
+    tips = {sha for ref, sha in snapshot.refs.items() if ref.startswith(("refs/heads/", "refs/tags/"))}
+    if commit_info.bin_sha_commit in tips:
+        return None
+    if commit_info.bin_tag_name and snapshot.get(f"refs/tags/{commit_info.bin_tag_name}"):
+        return snapshot.get(f"refs/tags/{commit_info.bin_tag_name}")
+
+    name = sanitize_ref_component(commit_info.artifact_name)
+    tree_prefix = sanitize_ref_component(f"{{{commit_info.artifact_relpath_nca}}}")
+    by_src = {}
+    for _, ref in snapshot.prefix(META_FOR_NAME_PREFIX):
+        their_name, their_tree_prefix, src_sha, bin_sha = ref[len(META_FOR_NAME_PREFIX):].split("/")
+        if their_tree_prefix == tree_prefix and bin_sha in tips and (src_sha not in by_src or their_name == name):
+            by_src[src_sha] = bin_sha  # Of artifacts built from the same source commit, ours by name is preferred
+    return next((by_src[sha] for sha in src_history if sha in by_src), None)
+
+
+def fetch_delta_base(rbgit: RbGit, remote_bin_name: str, commit_info: ArtifactCommitInfo) -> str | None:
+    """
+        Fetch the commit and trees, but no blobs, of the remote's previous artifact of our tree-prefix. Returns it.
+        Fetched shallow, git's push leaves out every blob of its trees, rather than just objects of its commit: Files
+        unchanged since are not sent again.
+    """
+    try:
+        src_history = exec(["git", "rev-list", f"--max-count={BASE_HISTORY}", "HEAD"], cwd=commit_info.src_tree_root).split()
+    except subprocess.CalledProcessError:
+        src_history = []
+    base = previous_artifact(rbgit.ref_snapshot(remote_bin_name), commit_info, src_history)
+    if not base:
+        printer.detail("Remote artifact-repo has no previous artifact of this path to push against", file=sys.stderr)
+        return None
+    # A remote not supporting the filter would send all blobs of the previous artifact, so it is not asked
+    if not {"shallow", "filter"} <= rbgit.fetch_capabilities(remote_bin_name):
+        printer.detail("Remote artifact-repo can't fetch without blobs, so pushing against no previous artifact", file=sys.stderr)
+        return None
+
+    # The fetch makes the repo a partial clone. Downloads make it one again when they need to
+    before = {key: rbgit.cmd("config", "--default=", "--get", key).strip()
+              for key in ("core.repositoryformatversion", "extensions.partialClone")}
+    before |= {f"remote.{remote_bin_name}.{key}": "" for key in ("promisor", "partialclonefilter")}
+
+    printer.high_level(f"Fetching trees of previous artifact {base[:8]}, to push only what it lacks", file=sys.stderr)
+    try:
+        rbgit.cmd("fetch", "--no-tags", "--no-write-fetch-head", "--depth=1", "--filter=blob:none", remote_bin_name, base)
+        return base
+    except RuntimeError as e:
+        printer.error(f"Warning: Could not fetch previous artifact {base[:8]}, pushing without: {e}", file=sys.stderr)
+        return None
+    finally:
+        # As a partial clone, the remote would be fetched from for each blob left out that pushing, or any later
+        # command, tries as a delta base. Deltas are then against blobs we have only
+        for key, value in before.items():
+            try:
+                rbgit.cmd("config", *([key, value] if value else ["--unset", key]))
+            except RuntimeError:
+                pass  # Not set, as nothing was fetched: We had the previous artifact already
+
+
+def push_branch(rbgit, remote_bin_name, commit_info: ArtifactCommitInfo, force: bool = False):
+    """
+        Push branch and meta-data refs to binary remote.
+    """
+    push_refs(rbgit, remote_bin_name, lambda snapshot: branch_updates(snapshot, commit_info, force))
+
+
+def push_tag(rbgit, remote_bin_name, commit_info: ArtifactCommitInfo, force: bool = False):
+    """
+        Push tag to binary remote.
+    """
+    push_refs(rbgit, remote_bin_name, lambda snapshot: tag_updates(rbgit, remote_bin_name, snapshot, commit_info, force))
 
 
 def note_append_push(args, commit_info: ArtifactCommitInfo):
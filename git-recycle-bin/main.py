@@ -1,19 +1,25 @@
 #!/usr/bin/env python3
 import sys
+import tempfile
 
 from .utils.extern import exec
 from .printer import printer
 from .arg_parser import parse_args
 from .rbgit import create_rbgit
+from .meta_cache import MetaCache
+from .materialize import BlobCache, StatCache
+from .telemetry import telemetry
 
 # commands
 from . import (
     remote_artifacts,
+    print_artifacts,
     push,
     clean,
     remote_delete_expired_branches,
     remote_flush_meta_for_commit,
-    download,
+    download_refs,
+    download_to_stdout,
     cat_metas
 )
 
@@ -25,6 +31,9 @@ def main() -> int:
     if args is None:
         return 1
 
+    # Git only reports what it transferred when asked to, so ask only when the report is wanted
+    telemetry.enabled = printer.verbosity >= 3 or bool(args.stats_json)
+
     printer.debug("Arguments:", file=sys.stderr)
     for arg in vars(args):
         printer.debug(f"  '{arg}': '{getattr(args, arg)}'", file=sys.stderr)
@@ -43,8 +52,14 @@ def main() -> int:
 
     remote_bin_name = "recyclebin"
     commit_info = None
+    ret = 0
+    meta_cache = MetaCache(args.cache_dir, args.meta_cache_max) if args.meta_cache else None
+
+    # Streaming needs no work tree, so keep the bin repo out of the source tree, which may even be read-only
+    tmp_root = tempfile.TemporaryDirectory(prefix="gitrb-") if getattr(args, "to_stdout", False) else None
 
-    with create_rbgit(artifact_path=path, clean=args.rm_tmp) as rbgit:
+    with create_rbgit(src_tree_root=tmp_root.name if tmp_root else None, artifact_path=path, clean=args.rm_tmp) as rbgit:
+        rbgit.use_ref_snapshot_cache(args.cache_dir, args.ref_snapshot_ttl)
 
         # setup
         if args.user_name:
@@ -62,15 +77,24 @@ def main() -> int:
         if args.command == "clean":
             clean(rbgit, remote_bin_name)
         if args.command == "list":
-            for _, artifact_sha in remote_artifacts(rbgit, remote_bin_name,
-                                                    args.query,
-                                                    args.list_all_shas
-                                                    ):
-                print(artifact_sha)
-        if args.command == "download":
-            download(rbgit, remote_bin_name, args.artifacts, args)
+            ret = print_artifacts(remote_artifacts(rbgit, remote_bin_name,
+                                                   args.query,
+                                                   all_shas=args.list_all_shas,
+                                                   cache=meta_cache,
+                                                   limit=args.limit,
+                                                   jobs=args.jobs,
+                                                   sort=args.sort,
+                                                   ), args.format)
+        if args.command == "download" and args.to_stdout:
+            ret = download_to_stdout(rbgit, remote_bin_name, args.artifacts[0], format=args.format, cache=meta_cache,
+                                     store_dir=args.cache_dir if args.object_store else None) or 0
+        elif args.command == "download":
+            ret = download_refs(rbgit, remote_bin_name, args.artifacts, force=args.force, rm_tmp=args.rm_tmp, cache=meta_cache, jobs=args.jobs,
+                                store_dir=args.cache_dir if args.object_store else None, include=args.include,
+                                stat_cache=StatCache(args.cache_dir) if args.incremental else None, prune=args.prune,
+                                blob_cache=BlobCache(args.cache_dir, args.blob_cache_max << 20, args.link) if args.link != "copy" else None) or 0
         if args.command == "cat-meta":
-            cat_metas(rbgit, remote_bin_name, args.commits)
+            cat_metas(rbgit, remote_bin_name, args.commits, cache=meta_cache, jobs=args.jobs)
 
         # garbage collection
         if args.rm_expired:
@@ -78,11 +102,16 @@ def main() -> int:
         if args.flush_meta:
             remote_flush_meta_for_commit(rbgit, remote_bin_name)
 
+    if tmp_root:
+        tmp_root.cleanup()
+    if telemetry.enabled:
+        telemetry.report(args.command, args.stats_json)
+
     # if we have pushed and we want to print the commit do it last
     if args.command == "push" and not args.no_print_commit:
         print(commit_info.bin_sha_commit)
 
-    return 0
+    return ret
 
 
 if __name__ == "__main__":
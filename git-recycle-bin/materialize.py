@@ -0,0 +1,470 @@
+import os
+import sys
+import json
+import time
+import shutil
+import hashlib
+import secrets
+import threading
+import subprocess
+from contextlib import contextmanager
+from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+from .printer import printer
+from .utils.file import atomic_write
+
+# Blobs up to this size are read whole and written by the pool. Larger ones are streamed to disk in chunks by the
+# reader itself, so memory use is bounded whatever the artifact holds.
+SMALL_BLOB = 1 << 20
+CHUNK = 1 << 20
+
+LINK_MODES = ["copy", "hardlink", "reflink"]
+FICLONE = 0x40049409  # Linux ioctl, sharing all extents of one file with another, on Btrfs, XFS and alike
+
+
+@dataclass
+class TreeEntry:
+    mode: str
+    sha: str
+    path: str
+
+
+def parse_ls_tree(output: str) -> list[TreeEntry]:
+    """ Files in `ls-tree -r -z --full-tree` output. Submodules are skipped, as checkout would """
+    entries = []
+    for entry in output.split("\0"):
+        if not entry:
+            continue
+        info, path = entry.split("\t", maxsplit=1)
+        mode, obj_type, sha = info.split()
+        if obj_type == "blob":
+            entries.append(TreeEntry(mode, sha, path))
+    return entries
+
+
+def under_prefix(path: str, prefix: str) -> bool:
+    return not prefix or path == prefix or path.startswith(prefix.rstrip("/") + "/")
+
+
+def new_file(path: str, mode: str) -> int:
+    """ Create path exclusively, like checkout does, with 0666 or 0777 masked by umask. Returns its fd """
+    perm = 0o777 if mode == "100755" else 0o666
+    return os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, "O_BINARY", 0), perm)
+
+
+def reflink(src: str, dst: str, mode: str):
+    """ Make dst a copy-on-write clone of src, sharing its disk blocks, or raise OSError if not supported """
+    if fcntl is None:
+        raise OSError("Reflinks are not supported on this platform")
+    with open(src, "rb") as src_file, os.fdopen(new_file(dst, mode), "wb") as dst_file:
+        try:
+            fcntl.ioctl(dst_file.fileno(), FICLONE, src_file.fileno())
+        except OSError:
+            dst_file.close()
+            os.remove(dst)
+            raise
+
+
+class BlobCache:
+    """
+    Files on this host, one per blob SHA, which downloads hardlink or reflink into place instead of writing them.
+    Repeated downloads, e.g. of the same artifact into several workspaces, then cost neither fetching nor writing.
+
+    Entries are read-only, as hardlinks share them with workspaces: Editing a hardlinked file in place would change
+    the cache and every other workspace. Executables are separate entries, as hardlinks share their mode too.
+    The cache is bounded in the disk space it takes: Oldest entries are evicted first. Those still hardlinked
+    elsewhere take no space of their own, so are neither counted nor evicted.
+    Downloads hold the cache's lock shared from finding which blobs it has until those are placed, and eviction
+    holds it exclusively, so no entry found vanishes before use.
+    """
+
+    def __init__(self, cache_dir: str, max_bytes: int, link: str = "hardlink"):
+        self.cache_dir = os.path.join(cache_dir, "blobs")
+        self.max_bytes = max_bytes
+        self.link = link
+        self.fallback = None  # Set once link turned out to be unsupported, to copy instead
+
+    @contextmanager
+    def lock(self, shared: bool = True):
+        if fcntl is None:  # Windows: Evicting may race concurrent downloads
+            yield
+            return
+        os.makedirs(self.cache_dir, exist_ok=True)
+        with open(self.cache_dir + ".lock", "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _path(self, sha: str, executable: bool) -> str:
+        return os.path.join(self.cache_dir, sha[:2], sha[2:] + (".x" if executable else ""))
+
+    def has(self, sha: str) -> bool:
+        return os.path.exists(self._path(sha, False)) or os.path.exists(self._path(sha, True))
+
+    def get(self, entry: TreeEntry) -> str | None:
+        """ Path of the entry holding entry's blob with entry's mode, if cached """
+        executable = entry.mode == "100755"
+        path = self._path(entry.sha, executable)
+        if os.path.exists(path):
+            return path
+        other = self._path(entry.sha, not executable)
+        try:
+            with open(other, "rb") as file:
+                return self.add(entry, iter(lambda: file.read(CHUNK), b""))
+        except FileNotFoundError:
+            return None
+
+    def add(self, entry: TreeEntry, chunks) -> str:
+        """ Cache entry's content, an iterable of bytes chunks. Returns the path of the cache entry """
+        path = self._path(entry.sha, entry.mode == "100755")
+        atomic_write(path, chunks, 0o555 if entry.mode == "100755" else 0o444)
+        return path
+
+    def place(self, cached: str, tmp: str, mode: str):
+        """ Create tmp from cached, by link if possible, else by copy """
+        link = self.fallback or self.link
+        try:
+            if link == "hardlink":
+                os.link(cached, tmp)
+                return
+            if link == "reflink":
+                reflink(cached, tmp, mode)
+                return
+        except OSError as e:
+            # E.g. cache and workspace on different file systems, or one without reflinks
+            printer.detail(f"Cannot {link} from {self.cache_dir}, copying instead: {e}", file=sys.stderr)
+            self.fallback = "copy"
+        with open(cached, "rb") as src, os.fdopen(new_file(tmp, mode), "wb") as dst:
+            shutil.copyfileobj(src, dst, CHUNK)
+
+    def evict(self):
+        with self.lock(shared=False):
+            self._evict()
+
+    def _evict(self):
+        entries = []
+        for root, _, names in os.walk(self.cache_dir):
+            for name in names:
+                try:
+                    st = os.stat(os.path.join(root, name))
+                except FileNotFoundError:
+                    continue  # Concurrently evicted by someone else
+                entries.append((st.st_mtime, st.st_size, st.st_nlink, os.path.join(root, name)))
+        # Entries hardlinked elsewhere take no disk space of their own
+        entries = [(mtime, size, path) for mtime, size, nlink, path in entries if nlink == 1]
+        excess = sum(size for _, size, _ in entries) - self.max_bytes
+        for _, size, path in sorted(entries):
+            if excess <= 0:
+                break
+            try:
+                os.remove(path)
+                excess -= size
+            except FileNotFoundError:
+                pass
+
+
+class Writer:
+    """
+    Writes files below work_tree, like checkout would, but without an index.
+    Each file is written to a temporary name and renamed into place, so readers never see a partial file.
+    Symlinks and files in the way of a directory are only replaced with force, and never followed.
+    """
+
+    def __init__(self, work_tree: str, force: bool, blob_cache: BlobCache | None = None):
+        self.work_tree = work_tree
+        self.force = force
+        self.blob_cache = blob_cache
+        self.known_dirs = {work_tree}  # Directories we know are real, not symlinks
+        self.lock = threading.Lock()
+
+    def dest(self, path: str) -> str:
+        """ Absolute destination of path, refusing anything a hostile tree could use to write outside work_tree """
+        parts = path.split("/")
+        if os.path.isabs(path) or any(part in ("", ".", "..", ".git") for part in parts):
+            raise RuntimeError(f"Refusing to write unsafe path '{path}'")
+        return os.path.join(self.work_tree, *parts)
+
+    def make_parent(self, dest: str):
+        parent = os.path.dirname(dest)
+        if parent in self.known_dirs:
+            return
+        path = self.work_tree
+        for part in os.path.relpath(parent, self.work_tree).split(os.sep):
+            path = os.path.join(path, part)
+            if path in self.known_dirs:
+                continue
+            if os.path.islink(path) or os.path.lexists(path) and not os.path.isdir(path):
+                if not self.force:
+                    raise RuntimeError(f"'{os.path.relpath(path, self.work_tree)}' is in the way of a directory. "
+                                       "Use --force to replace it.")
+                os.remove(path)
+            os.makedirs(path, exist_ok=True)
+            with self.lock:
+                self.known_dirs.add(path)
+
+    def place(self, tmp: str, dest: str):
+        if os.path.isdir(dest) and not os.path.islink(dest):
+            if not self.force:
+                os.remove(tmp)
+                raise RuntimeError(f"Directory '{os.path.relpath(dest, self.work_tree)}' is in the way of a file. "
+                                   "Use --force to replace it.")
+            shutil.rmtree(dest)
+        os.replace(tmp, dest)
+
+    def write(self, entry: TreeEntry, chunks):
+        """ Write entry's content, an iterable of bytes chunks, with entry's mode. Through blob_cache, if any """
+        if self.blob_cache and entry.mode != "120000":
+            self.write_cached(entry, self.blob_cache.add(entry, chunks))
+            return
+        dest = self.dest(entry.path)
+        self.make_parent(dest)
+        tmp = self.tmp_path(dest)
+        if entry.mode == "120000":
+            os.symlink(b"".join(chunks).decode(), tmp)
+        else:
+            with os.fdopen(new_file(tmp, entry.mode), "wb") as file:
+                for chunk in chunks:
+                    file.write(chunk)
+        self.place(tmp, dest)
+
+    def write_cached(self, entry: TreeEntry, cached: str):
+        """ Write entry from its blob_cache entry, cached """
+        dest = self.dest(entry.path)
+        self.make_parent(dest)
+        tmp = self.tmp_path(dest)
+        self.blob_cache.place(cached, tmp, entry.mode)
+        self.place(tmp, dest)
+
+    @staticmethod
+    def tmp_path(dest: str) -> str:
+        return os.path.join(os.path.dirname(dest), f".{os.path.basename(dest)}.gitrb-{secrets.token_hex(4)}")
+
+
+def file_blob_sha(path: str) -> str | None:
+    """ Git blob SHA-1 of the file or symlink at path, i.e. what `git hash-object` yields, or None if absent """
+    try:
+        if os.path.islink(path):
+            data = os.readlink(path).encode()
+            return hashlib.sha1(b"blob %d\0" % len(data) + data).hexdigest()
+        with open(path, "rb") as file:
+            digest = hashlib.sha1(b"blob %d\0" % os.fstat(file.fileno()).st_size)
+            while chunk := file.read(CHUNK):
+                digest.update(chunk)
+        return digest.hexdigest()
+    except OSError:
+        return None
+
+
+def file_mode(st: os.stat_result) -> str:
+    """ Git mode of a file, from its lstat """
+    if os.path.stat.S_ISLNK(st.st_mode):
+        return "120000"
+    return "100755" if st.st_mode & 0o100 else "100644"
+
+
+class StatCache:
+    """
+    On-disk record of the files a download wrote to a directory: {path: [mode, blob sha, size, mtime_ns]}.
+
+    A file whose size and mtime still match its record is known to hold the recorded blob, without reading it.
+    Like git's index, files modified no earlier than the record was taken are "racily clean" and are not trusted.
+    Files without a trusted record are hashed, which is still cheaper than writing them.
+    Only recorded files are ever pruned, so files which others put in the directory are left alone.
+    """
+
+    def __init__(self, cache_dir: str):
+        self.cache_dir = os.path.join(cache_dir, "stat")
+
+    def _path(self, root: str) -> str:
+        return os.path.join(self.cache_dir, hashlib.sha256(os.path.abspath(root).encode()).hexdigest() + ".json")
+
+    def load(self, root: str) -> tuple[dict[str, list], int]:
+        """ Records of files below root, and when they were taken """
+        try:
+            with open(self._path(root), "r") as file:
+                data = json.load(file)
+            return data["files"], data["taken_ns"]
+        except (OSError, ValueError, KeyError):
+            return {}, 0
+
+    def save(self, root: str, files: dict[str, list], taken_ns: int):
+        atomic_write(self._path(root), json.dumps({"files": files, "taken_ns": taken_ns}))
+
+
+def materialize(rbgit, commit: str, prefix: str = "",
+                paths: list[str] | None = None,
+                force: bool = False,
+                workers: int | None = None,
+                stat_cache: StatCache | None = None,
+                prune: bool = False,
+                blob_cache: BlobCache | None = None) -> int:
+    """
+    Write the files of commit at or below prefix into rbgit's work tree, like `checkout <commit> -- <prefix>`,
+    but without touching an index or HEAD. If paths are given, only those files are written.
+
+    Blobs are streamed through a single `cat-file --batch` process. Small files are handed to a bounded pool of
+    writers, while large ones are written in chunks as they are read. Returns the number of files written.
+
+    With a stat_cache, files already on disk with the right content and mode are not rewritten. With prune too,
+    files this cache recorded earlier, which the commit no longer has, are deleted. Files the commit has but paths
+    leaves out are kept, as are their records.
+    With a blob_cache, files are linked from there, see BlobCache. Only blobs it lacks are read from rbgit.
+    """
+    tree_entries = [entry for entry in parse_ls_tree(rbgit.cmd("ls-tree", "-r", "-z", "--full-tree", commit))
+                    if under_prefix(entry.path, prefix)]
+    entries = tree_entries
+    if paths is not None:
+        wanted = set(paths)
+        entries = [entry for entry in entries if entry.path in wanted]
+    if not entries:
+        raise RuntimeError(f"Artifact {commit} has no files at '{prefix}'")
+    writer = Writer(rbgit.rbgit_work_tree, force, blob_cache)
+    for entry in entries:
+        writer.dest(entry.path)  # Refuse a hostile tree before writing anything
+
+    workers = workers or min(8, os.cpu_count() or 1)
+    if stat_cache is None:
+        write_entries(rbgit, writer, entries, workers)
+        return len(entries)
+
+    root = os.path.join(rbgit.rbgit_work_tree, prefix)
+    records, taken_ns = stat_cache.load(root)
+
+    def unchanged(entry: TreeEntry) -> bool:
+        try:
+            st = os.lstat(writer.dest(entry.path))
+        except OSError:
+            return False
+        if file_mode(st) != entry.mode:
+            return False
+        record = records.get(entry.path)
+        if record == [entry.mode, entry.sha, st.st_size, st.st_mtime_ns] and st.st_mtime_ns < taken_ns:
+            return True
+        return len(entry.sha) == 40 and file_blob_sha(writer.dest(entry.path)) == entry.sha
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        todo = [entry for entry, same in zip(entries, pool.map(unchanged, entries)) if not same]
+    printer.detail(f"{len(todo)} of {len(entries)} files of {commit} changed", file=sys.stderr)
+    write_entries(rbgit, writer, todo, workers)
+    # Taken once the files are written, so their records are trusted next time. Files with an mtime from now on
+    # are not, but hashed: A change made after, but within the file system's mtime granularity, is still noticed
+    taken_ns = time.time_ns()
+
+    new_records = {}
+    for entry in entries:
+        st = os.lstat(writer.dest(entry.path))
+        new_records[entry.path] = [entry.mode, entry.sha, st.st_size, st.st_mtime_ns]
+    # Files of the commit which were not included are neither pruned, nor forgotten: They keep their records,
+    # so the next run needs not hash them
+    in_tree = {entry.path for entry in tree_entries}
+    gone = {path: record for path, record in records.items() if path not in in_tree and under_prefix(path, prefix)}
+    if prune:
+        prune_files(writer, gone)
+    if paths is not None:
+        new_records = {path: record for path, record in records.items() if not (prune and path in gone)} | new_records
+    stat_cache.save(root, new_records, taken_ns)
+    return len(todo)
+
+
+def prune_files(writer: Writer, records: dict[str, list]):
+    """ Delete recorded files, unless modified since, and directories left empty """
+    pruned = 0
+    for path, (_, _, size, mtime_ns) in records.items():
+        dest = writer.dest(path)
+        try:
+            st = os.lstat(dest)
+        except OSError:
+            continue
+        if (st.st_size, st.st_mtime_ns) != (size, mtime_ns):
+            printer.detail(f"Not pruning '{path}', it was modified since downloaded", file=sys.stderr)
+            continue
+        os.remove(dest)
+        pruned += 1
+        parent = os.path.dirname(dest)
+        while parent != writer.work_tree and not os.listdir(parent):
+            os.rmdir(parent)
+            parent = os.path.dirname(parent)
+    printer.detail(f"Pruned {pruned} files", file=sys.stderr)
+
+
+def write_entries(rbgit, writer: Writer, entries: list[TreeEntry], workers: int):
+    """ Write entries, from writer's blob cache where it has them, else from rbgit """
+    if writer.blob_cache:
+        cached = [(entry, writer.blob_cache.get(entry) if entry.mode != "120000" else None) for entry in entries]
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            list(pool.map(lambda hit: writer.write_cached(*hit), [hit for hit in cached if hit[1]]))
+        printer.debug(f"Blob cache: {sum(1 for _, path in cached if path)} hits, "
+                      f"{sum(1 for _, path in cached if not path)} misses", file=sys.stderr)
+        entries = [entry for entry, path in cached if not path]
+    write_blobs(rbgit, writer, entries, workers)
+
+
+def write_blobs(rbgit, writer: Writer, entries: list[TreeEntry], workers: int):
+    """ Stream the blobs of entries from rbgit to disk """
+    if not entries:
+        return
+    printer.debug(f"Writing {len(entries)} files with {workers} writers", file=sys.stderr)
+    proc = subprocess.Popen(["git", "cat-file", "--batch"], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                            stderr=subprocess.DEVNULL, env=os.environ | {"GIT_DIR": rbgit.rbgit_dir})
+
+    def feed():
+        # Own thread, as cat-file stops reading input while its output is not read
+        try:
+            for entry in entries:
+                proc.stdin.write(entry.sha.encode() + b"\n")
+            proc.stdin.close()
+        except (BrokenPipeError, ValueError):
+            pass  # Reader gave up on an error
+    feeder = threading.Thread(target=feed, daemon=True)
+    feeder.start()
+
+    # Bound how many small files are held in memory, waiting for a writer
+    in_flight = threading.BoundedSemaphore(workers * 4)
+
+    def write_small(entry: TreeEntry, data: bytes):
+        try:
+            writer.write(entry, [data])
+        finally:
+            in_flight.release()
+
+    def read_chunks(size: int):
+        while size > 0:
+            chunk = proc.stdout.read(min(CHUNK, size))
+            if not chunk:
+                raise RuntimeError("RbGit cat-file ended early")
+            size -= len(chunk)
+            yield chunk
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = []
+            for entry in entries:
+                header = proc.stdout.readline().split()
+                if len(header) != 3:
+                    raise RuntimeError(f"RbGit object {entry.sha} of '{entry.path}' is missing")
+                size = int(header[2])
+                if size <= SMALL_BLOB:
+                    data = proc.stdout.read(size)
+                    in_flight.acquire()
+                    futures.append(pool.submit(write_small, entry, data))
+                else:
+                    writer.write(entry, read_chunks(size))
+                proc.stdout.read(1)  # Newline after content
+                # Surface a failed write now, instead of after writing everything else
+                while futures and futures[0].done():
+                    futures.pop(0).result()
+            for future in futures:
+                future.result()
+    finally:
+        proc.kill()
+        proc.wait()
+        proc.stdout.close()
+        feeder.join()
@@ -0,0 +1,142 @@
+import os
+import re
+import sys
+import json
+
+from .printer import printer
+from .utils.file import atomic_write
+from .commit_msg import parse_commit_msg
+from .artifact_index import remote_index_load
+
+
+def default_cache_dir() -> str:
+    """ Per-user cache directory, honoring $XDG_CACHE_HOME """
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(cache_home, "git-recycle-bin")
+
+
+def evict_lru(directory: str, max_entries: int) -> int:
+    """ Delete least-recently-used files below directory, until at most max_entries remain. Returns how many remain """
+    files = []
+    for root, _, names in os.walk(directory):
+        for name in names:
+            path = os.path.join(root, name)
+            try:
+                files.append((os.stat(path).st_mtime, path))
+            except FileNotFoundError:
+                pass  # concurrently evicted by someone else
+
+    excess = len(files) - max_entries
+    if excess <= 0:
+        return len(files)
+    files.sort()
+    for _, path in files[:excess]:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+    return max_entries
+
+
+class MetaCache:
+    """
+    On-disk cache of meta-data, keyed by SHA of the meta-data blob.
+
+    Meta-data blobs are content-addressed and never change, so entries can't go stale and need no invalidation.
+    The cache is only bounded in size: Entries are evicted least-recently-used first.
+    How many entries there are is counted in a file beside the cache, so it is only walked when over its bound.
+    Each entry is one small file, written atomically, so concurrent invocations can share the cache.
+    """
+
+    def __init__(self, cache_dir: str, max_entries: int = 10000):
+        self.cache_dir = os.path.join(cache_dir, "meta")
+        self.max_entries = max_entries
+        self.count_path = os.path.join(cache_dir, "meta.count")
+
+    @staticmethod
+    def cacheable(obj: str) -> bool:
+        """ Only full object SHAs (SHA-1 or SHA-256) are content-addressed. Ref names and short SHAs are not """
+        return re.fullmatch(r"[0-9a-f]{40}|[0-9a-f]{64}", obj) is not None
+
+    def _path(self, sha: str) -> str:
+        return os.path.join(self.cache_dir, sha[:2], sha[2:])
+
+    def get(self, sha: str) -> dict | None:
+        """ Returns entry as {"content": raw meta-data, "meta_data": parsed meta-data}, or None if not cached """
+        if not self.cacheable(sha):
+            return None
+        path = self._path(sha)
+        try:
+            with open(path, "r") as file:
+                entry = json.load(file)
+            os.utime(path)  # Mark as recently used
+        except (OSError, ValueError):
+            return None
+        return entry
+
+    def put(self, sha: str, entry: dict):
+        if not self.cacheable(sha):
+            return
+        atomic_write(self._path(sha), json.dumps(entry))
+
+    def _count(self) -> int | None:
+        try:
+            with open(self.count_path, "r") as file:
+                return int(file.read())
+        except (OSError, ValueError):
+            return None
+
+    def _set_count(self, count: int):
+        atomic_write(self.count_path, f"{count}\n")
+
+    def evict(self, added: int = 0):
+        """
+        Evict once there may be more than max_entries, after added entries were put. Otherwise only the count is
+        updated, without walking the cache. Concurrent invocations may lose each other's updates, and entries put
+        again are counted again, so the count is an estimate, made exact by each walk.
+        """
+        count = self._count()
+        if count is not None and count + added <= self.max_entries:
+            self._set_count(count + added)
+            return
+        self._set_count(evict_lru(self.cache_dir, self.max_entries))
+
+
+def fetch_metas(rbgit, remote_bin_name: str, objs: list[str],
+                cache: MetaCache | None = None,
+                index_sha: str | None = None,
+                jobs: int = 1) -> dict[str, dict]:
+    """
+    Get meta-data entries, {"content": str, "meta_data": dict}, for every object in objs.
+    Objects found in cache are not fetched. If the remote has an artifact index, index_sha, the rest
+    are looked up there. Only what remains is fetched, in one batch split between jobs concurrent fetches.
+    Everything fetched is added to cache.
+    """
+    entries = {}
+    missing = []
+    for obj in dict.fromkeys(objs):
+        entry = cache.get(obj) if cache else None
+        if entry is None:
+            missing.append(obj)
+        else:
+            entries[obj] = entry
+
+    if cache:
+        printer.debug(f"Meta-data cache: {len(entries)} hits, {len(missing)} misses", file=sys.stderr)
+
+    contents = {}
+    if missing and index_sha:
+        index = remote_index_load(rbgit, remote_bin_name, index_sha)
+        contents = {obj: index[obj] for obj in missing if obj in index}
+        printer.debug(f"Artifact index: {len(contents)} hits, {len(missing) - len(contents)} misses", file=sys.stderr)
+    contents |= rbgit.fetch_cat_batch(remote_bin_name, [obj for obj in missing if obj not in contents], jobs=jobs)
+
+    for obj, content in contents.items():
+        entries[obj] = {"content": content, "meta_data": parse_commit_msg(content)}
+        if cache:
+            cache.put(obj, entries[obj])
+
+    if cache and contents:
+        cache.evict(added=len(contents))
+
+    return entries
@@ -0,0 +1,98 @@
+import os
+import sys
+import time
+import hashlib
+import subprocess
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+from .printer import printer
+from .chunked_transfer import fetch_chunked
+from .telemetry import telemetry
+
+
+class ObjectStore:
+    """
+    Persistent bare repo per bin remote, below cache_dir/store/, holding downloaded artifacts between invocations.
+    Download repos borrow its objects through git alternates, so only objects the store lacks are ever fetched.
+
+    Concurrent invocations on the same machine share a store: Fetches are serialized by a file lock, while
+    reading is lock-free, as objects never change. Fetched commits are kept alive by refs, and automatic gc is
+    off, so objects can't vanish under a reader.
+    """
+
+    def __init__(self, cache_dir: str, url: str):
+        if os.path.exists(url):
+            url = os.path.abspath(url)  # Same local remote, whatever the cwd
+        self.url = url
+        self.path = os.path.abspath(os.path.join(cache_dir, "store", hashlib.sha256(url.encode()).hexdigest() + ".git"))
+
+    def git(self, *args, input=None, env=None) -> str:
+        args = telemetry.instrument(args)
+        printer.debug("Run:", ["store-git", *args], file=sys.stderr)
+        start = time.monotonic()
+        result = subprocess.run(["git", "-c", "protocol.version=2", *args], input=input, capture_output=True, text=True,
+                                env=os.environ | {"GIT_DIR": self.path} | (env or {}))
+        telemetry.record(args, time.monotonic() - start, result.stderr)
+        if result.returncode != 0:
+            raise RuntimeError(f"Object store command failed with error: {result.stderr}")
+        return result.stdout
+
+    @contextmanager
+    def lock(self):
+        if fcntl is None:
+            raise RuntimeError("Object store needs file locking, which is not available on this platform")
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path + ".lock", "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _init_idempotent(self):
+        if os.path.exists(os.path.join(self.path, "objects")):
+            return
+        self.git("init", "--bare", "--quiet", self.path)
+        self.git("config", "gc.auto", "0")
+
+    def missing(self, shas: list[str]) -> list[str]:
+        """ Those of shas whose commit is not in the store. A fetched commit comes with all objects it needs """
+        if not os.path.exists(os.path.join(self.path, "objects")):
+            return list(shas)
+        out = self.git("cat-file", "--batch-check", input="".join(f"{sha}^{{commit}}\n" for sha in shas))
+        return [sha for sha, line in zip(shas, out.splitlines()) if line.endswith(" missing")]
+
+    def fetch(self, shas: list[str], ssh_command: str | None = None,
+              chunks: dict[str, list[tuple[str, str]]] | None = None) -> list[str]:
+        """
+        Fetch those artifact commits the store lacks, in one fetch, except those in chunks, which are fetched
+        chunk by chunk, see fetch_chunked. Chunks fetched stay in the store, so a failed fetch resumes where it
+        stopped, even in a later invocation. Returns what was fetched.
+        """
+        chunks = chunks or {}
+        shas = list(dict.fromkeys(shas))
+        with self.lock():
+            self._init_idempotent()
+            missing = self.missing(shas)
+            printer.debug(f"Object store has {len(shas) - len(missing)} of {len(shas)} artifacts", file=sys.stderr)
+            if missing:
+                env = {"GIT_SSH_COMMAND": ssh_command} if ssh_command else None
+                for sha in missing:
+                    if sha in chunks:
+                        fetch_chunked(lambda *args, **kwargs: self.git(*args, env=env, **kwargs), self.url, sha, chunks[sha])
+                whole = [sha for sha in missing if sha not in chunks]
+                if whole:
+                    self.git("fetch", "--no-tags", "--no-write-fetch-head", "--stdin", self.url,
+                             input="\n".join(whole) + "\n", env=env)
+                # Unreferenced objects would be pruned by a manual gc
+                self.git("update-ref", "--stdin", input="".join(f"update refs/keep/{sha} {sha}\n" for sha in missing))
+        return missing
+
+    def link(self, rbgit):
+        """ Let rbgit read objects from the store, as if they were its own """
+        rbgit.add_alternate(os.path.join(self.path, "objects"))
@@ -1,13 +1,31 @@
 import os
 import sys
+import json
+import time
+import shlex
+import hashlib
+import tempfile
 import subprocess
 import re
+import stat
 import shutil
+from concurrent.futures import ThreadPoolExecutor
 from typing import Optional
 
-from .utils.file import nca_path
+from .utils.file import atomic_write, nca_path
 from .printer import printer as default_printer
+from .telemetry import telemetry, run_teeing_stderr
 from .utils.extern import exec
+from .blob_pack import write_blobs
+
+# Attributes which may have `add` store other content than a file's
+FILTER_ATTRIBUTES = ("filter", "text", "eol", "crlf", "ident", "working-tree-encoding")
+
+# Objects asked for by one fetch at most. Some hosts throttle or reject fetches of thousands
+FETCH_BATCH_SIZE = 1000
+
+# Told by pushes rejected since a leased ref moved meanwhile, i.e. those worth trying again
+LEASE_REJECTIONS = ("stale info", "atomic push failed")
 
 
 Path = str
@@ -34,6 +52,49 @@ def create_rbgit(src_tree_root: Optional[Path] = None,
 
     return RbGit(printer, rbgit_dir=rbgit_dir, rbgit_work_tree=nca_dir, clean=clean)
 
+class RefSnapshot:
+    """
+    All refs of a remote, as advertised by a single `ls-remote`.
+    Existence, value and prefix queries are answered from memory, instead of each costing a round trip.
+    """
+
+    def __init__(self, refs: dict[str, str]):
+        self.refs = refs  # {ref name: sha}, in ls-remote order
+
+    @classmethod
+    def parse(cls, ls_remote_output: str) -> "RefSnapshot":
+        refs = {}
+        for line in ls_remote_output.splitlines():
+            sha, ref = line.split()
+            refs[ref] = sha
+        return cls(refs)
+
+    @classmethod
+    def load(cls, path: str, ttl: float) -> Optional["RefSnapshot"]:
+        """ Snapshot saved at path, unless older than ttl seconds """
+        try:
+            if time.time() - os.stat(path).st_mtime > ttl:
+                return None
+            with open(path, "r") as file:
+                return cls(json.load(file))
+        except (OSError, ValueError):
+            return None
+
+    def save(self, path: str):
+        atomic_write(path, json.dumps(self.refs))
+
+    def has(self, ref_name: str) -> bool:
+        """ Forgiving like `ls-remote <remote> <ref_name>`, e.g. either {master, refs/heads/master} will be found """
+        return any(ref == ref_name or ref.endswith(f"/{ref_name}") for ref in self.refs)
+
+    def get(self, ref: str) -> str | None:
+        return self.refs.get(ref)
+
+    def prefix(self, prefix: str) -> list[tuple[str, str]]:
+        """ Pairs of (sha, ref) for refs starting with prefix """
+        return [(sha, ref) for ref, sha in self.refs.items() if ref.startswith(prefix)]
+
+
 class RbGit:
     """
     Initialize and manage a git repository for storing binary artifacts.
@@ -44,9 +105,16 @@ class RbGit:
         self.rbgit_dir = rbgit_dir if rbgit_dir else os.environ["RBGIT_DIR"]
         self.rbgit_work_tree = rbgit_work_tree if rbgit_work_tree else os.environ["RBGIT_WORK_TREE"]
         self.clean = clean
+        self.ref_snapshots = {}
+        self.ref_snapshot_dir = None
+        self.ref_snapshot_ttl = 0
+        self.ssh_base = None
+        self.ssh_command = None
+        self.ssh_control_dir = None
         self.init_idempotent()
 
     def __enter__(self):
+        self.ssh_multiplex_start()
         return self
 
     def cleanup(self):
@@ -59,21 +127,89 @@ class RbGit:
             shutil.rmtree(self.rbgit_dir, ignore_errors=True)
 
     def __exit__(self, exc_type, exc_value, traceback):
+        self.ssh_multiplex_stop()
         self._destroy()
 
-    def cmd(self, *args, input=None, capture_output=True):
+    def ssh_multiplex_start(self):
+        """
+        Make all our ssh-transported git calls share one connection per host, instead of each doing a full
+        ssh handshake. The user's ssh command and config are kept, only connection sharing options are added.
+        Not done if the user's ssh may not be OpenSSH, or on Windows whose OpenSSH can't share connections.
+        """
+        if os.name == "nt" or os.environ.get("GIT_SSH"):
+            return
+        base = os.environ.get("GIT_SSH_COMMAND")
+        if not base:
+            try:
+                base = self.cmd("config", "core.sshCommand").strip()
+            except RuntimeError:
+                base = "ssh"  # Not configured
+        if os.path.basename(shlex.split(base)[0]) not in ("ssh", "ssh.exe"):
+            return
+
+        self.ssh_control_dir = tempfile.mkdtemp(prefix="gitrb-ssh-")
+        # %C is a 40 char hash of the connection, and socket paths can't be much longer than 100 chars
+        if len(self.ssh_control_dir) + 41 > 100:
+            self.ssh_multiplex_stop()
+            return
+
+        # First connection becomes master. It lingers a while after the last client, in case we die without exit
+        self.ssh_base = base
+        self.ssh_command = " ".join([
+            base,
+            "-o", "ControlMaster=auto",
+            "-o", shlex.quote(f"ControlPath={self.ssh_control_dir}/%C"),
+            "-o", "ControlPersist=60",
+        ])
+        self.printer.debug(f"Sharing ssh connections: {self.ssh_command}", file=sys.stderr)
+
+    def ssh_multiplex_stop(self):
+        if self.ssh_control_dir is None:
+            return
+        for socket in os.listdir(self.ssh_control_dir):
+            # The host argument is required, but the master is found by its socket.
+            # ssh uses the first value given for an option, so don't pass our %C ControlPath here.
+            subprocess.run([*shlex.split(self.ssh_base), "-o", f"ControlPath={self.ssh_control_dir}/{socket}", "-O", "exit", "_"],
+                           capture_output=True)
+        shutil.rmtree(self.ssh_control_dir, ignore_errors=True)
+        self.ssh_base = None
+        self.ssh_command = None
+        self.ssh_control_dir = None
+
+    def cmd(self, *args, input=None, capture_output=True, text=True, env=None, cwd=None, tee_stderr=False):
+        """ Run git in this repo. With tee_stderr, stderr is shown as it comes but also told by errors, see capture_output """
+        if args and args[0] in ("push", "remote"):
+            # Whether or not it succeeds, the remote's refs may differ from our snapshot afterwards
+            self._invalidate_ref_snapshots(args)
+
         # Override environment variables
         envcopy = os.environ.copy()
         envcopy["GIT_DIR"] = self.rbgit_dir
         envcopy["GIT_WORK_TREE"] = self.rbgit_work_tree
+        if self.ssh_command:
+            envcopy["GIT_SSH_COMMAND"] = self.ssh_command
+        envcopy.update(env or {})
 
-        # execute the git command with the modified environment
+        args = telemetry.instrument(args)
+
+        # execute the git command with the modified environment.
+        # Protocol v2 lets fetch skip the ref advertisement when only fetching by SHA, and is ignored by push.
         self.printer.debug("Run:", ["rbgit", *args], file=sys.stderr)
-        result = subprocess.run(["git", *args], input=input, env=envcopy, capture_output=capture_output, text=True)
+        argv = ["git", "-c", "protocol.version=2", *args]
+        start = time.monotonic()
+        if (telemetry.enabled or tee_stderr) and not capture_output and input is None:
+            result = run_teeing_stderr(argv, env=envcopy, cwd=cwd)  # Still shown, but also parsed for what was transferred
+        else:
+            result = subprocess.run(argv, input=input, env=envcopy, capture_output=capture_output, text=text, cwd=cwd)
+        telemetry.record(args, time.monotonic() - start, result.stderr if isinstance(result.stderr, str) else None)
 
         # If the subprocess exited with a non-zero return code, raise an error
         if result.returncode != 0:
-            raise RuntimeError(f"RbGit command failed with error: {result.stderr}")
+            if result.stderr is None:
+                stderr = f"exit code {result.returncode}, see above"  # Not captured, so shown already
+            else:
+                stderr = result.stderr if text else result.stderr.decode(errors="replace")
+            raise RuntimeError(f"RbGit command failed with error: {stderr}")
 
         # return the result of the command
         return result.stdout
@@ -124,6 +260,79 @@ class RbGit:
 
         return changes
 
+    def write_tree_of(self, binpath: str, force: bool = False, jobs: int = 1) -> str | None:
+        """
+        Write the tree which `add` of binpath followed by `write-tree` would, but by plumbing only: No index is read
+        or written and nothing is checked out. None if that takes an index after all, i.e. binpath holds an embedded
+        git repo, or no files at all, for which `add` has its own say.
+        With jobs other than 1, blobs are hashed and packed by that many processes, 0 for one per CPU, see write_blobs.
+        """
+        if not os.path.exists(binpath):
+            raise RuntimeError(f"Artifact '{binpath}' does not exist!")
+
+        # Same files as `add` would take: Not ignored ones, unless forced. Listed against an empty index, in case
+        # this repo has one from earlier, as then its files would count as tracked rather than untracked
+        excludes = [] if force else ["--exclude-standard"]
+        pathspec = os.path.relpath(binpath, self.rbgit_work_tree)
+        listing = self.cmd("ls-files", "--others", "-z", *excludes, "--", pathspec,
+                           env={"GIT_INDEX_FILE": os.path.join(self.rbgit_dir, "no-index")}, cwd=self.rbgit_work_tree)
+        paths = [path for path in listing.split("\0") if path]
+        if not paths or any(path.endswith("/") or "\n" in path for path in paths):
+            return None  # Embedded repos are listed as directories. Newlines don't fit --stdin-paths
+
+        # Modes as `add` records them, with core.filemode and core.symlinks as `init` leaves them
+        modes = {}
+        for path in paths:
+            mode = os.lstat(os.path.join(self.rbgit_work_tree, path)).st_mode
+            modes[path] = "120000" if stat.S_ISLNK(mode) else "100755" if mode & stat.S_IXUSR else "100644"
+
+        jobs = jobs or os.cpu_count() or 1
+        if jobs > 1 and not self.filtered(paths):
+            blobs = write_blobs(self, paths, jobs)
+        else:
+            blobs = self.hash_objects(paths, modes)
+
+        # Entries per directory, "" being the root. Written deepest first, a level per mktree, as parents take
+        # the trees of their subdirectories
+        entries: dict[str, list[str]] = {"": []}
+        for path in paths:
+            parent, _, name = path.rpartition("/")
+            entries.setdefault(parent, []).append(f"{modes[path]} blob {blobs[path]}\t{name}")
+            while parent and parent.rpartition("/")[0] not in entries:
+                entries[parent.rpartition("/")[0]] = []
+                parent = parent.rpartition("/")[0]
+        depths: dict[int, list[str]] = {}
+        for directory in entries:
+            depths.setdefault(directory.count("/") + 1 if directory else 0, []).append(directory)
+        for depth in sorted(depths, reverse=True):
+            batch = "".join("".join(f"{entry}\0" for entry in entries[directory]) + "\0" for directory in depths[depth])
+            for directory, tree in zip(depths[depth], self.cmd("mktree", "-z", "--batch", input=batch).split()):
+                if directory:
+                    parent, _, name = directory.rpartition("/")
+                    entries[parent].append(f"040000 tree {tree}\t{name}")
+                else:
+                    return tree
+
+    def hash_objects(self, paths: list[str], modes: dict[str, str]) -> dict[str, str]:
+        """ Write blobs of paths, relative to the work tree, as loose objects by `hash-object`. Returns their SHAs by path """
+        # Relative to the work tree, so .gitattributes apply like for `add`
+        files = [path for path in paths if modes[path] != "120000"]
+        blobs = {}
+        if files:
+            shas = self.cmd("hash-object", "-w", "--stdin-paths", input="\n".join(files) + "\n", cwd=self.rbgit_work_tree)
+            blobs = dict(zip(files, shas.split()))
+        for path in paths:
+            if modes[path] == "120000":  # hash-object would follow the link, while its target is what `add` stores
+                target = os.readlink(os.path.join(self.rbgit_work_tree, path))
+                blobs[path] = self.cmd("hash-object", "-w", "--stdin", "--no-filters", input=target).strip()
+        return blobs
+
+    def filtered(self, paths: list[str]) -> bool:
+        """ Whether attributes make `add` convert any of paths, relative to the work tree, on their way in """
+        attrs = self.cmd("check-attr", "-z", "--stdin", *FILTER_ATTRIBUTES, input="\0".join(paths) + "\0", cwd=self.rbgit_work_tree)
+        values = attrs.split("\0")[2::3]  # Records of path, attribute and value
+        return any(value != "unspecified" for value in values)
+
     def add_remote_idempotent(self, name: str, url: str):
         try:
             self.cmd("remote", "add", name, url)
@@ -153,30 +362,182 @@ class RbGit:
         sizes = [int(re.split(r'\s+', line)[3]) for line in lines.splitlines()]
         return sum(sizes)
 
+    def use_ref_snapshot_cache(self, cache_dir: str, ttl: float):
+        """ Share ref snapshots between invocations through cache_dir, for ttl seconds. 0 disables """
+        self.ref_snapshot_dir = os.path.join(cache_dir, "refs")
+        self.ref_snapshot_ttl = ttl
+
+    def _ref_snapshot_path(self, remote: str) -> str:
+        url = self.get_remote_url(remote)
+        return os.path.join(self.ref_snapshot_dir, hashlib.sha256(url.encode()).hexdigest() + ".json")
+
+    def ref_snapshot(self, remote: str) -> RefSnapshot:
+        """ Refs of remote. One `ls-remote` serves all queries until our next push to it """
+        if remote in self.ref_snapshots:
+            return self.ref_snapshots[remote]
+
+        snapshot = None
+        use_disk = self.ref_snapshot_dir is not None and self.ref_snapshot_ttl > 0
+        if use_disk:
+            snapshot = RefSnapshot.load(self._ref_snapshot_path(remote), self.ref_snapshot_ttl)
+            if snapshot is not None:
+                self.printer.debug(f"Using ref snapshot of {remote} cached less than {self.ref_snapshot_ttl}s ago", file=sys.stderr)
+        if snapshot is None:
+            snapshot = RefSnapshot.parse(self.cmd("ls-remote", "--refs", remote))
+            if use_disk:
+                snapshot.save(self._ref_snapshot_path(remote))
+
+        self.ref_snapshots[remote] = snapshot
+        return snapshot
+
+    def fetch_refs(self, remote: str, prefix: str) -> RefSnapshot:
+        """
+        Refs of remote starting with prefix, fetched along with the objects they point to. Unlike `ls-remote`,
+        `fetch` asks for the prefix only, which protocol v2 remotes filter on, so other refs are not advertised.
+        Fetched refs are kept below refs/fetched/, pruned to what remote has.
+        """
+        local = f"refs/fetched/{remote}/{prefix[len('refs/'):]}"
+        self.cmd("fetch", "--no-tags", "--no-write-fetch-head", "--prune", remote, f"+{prefix}*:{local}*")
+        lines = self.cmd("for-each-ref", "--format=%(objectname) %(refname)", local)
+        return RefSnapshot({prefix + ref[len(local):]: sha for sha, ref in (line.split() for line in lines.splitlines())})
+
+    def _invalidate_ref_snapshots(self, args):
+        # git takes the first non-option argument as the remote, e.g. `push [--force] <remote> <refspec>...`
+        # and `remote {add,set-url} <name> <url>`
+        names = [arg for arg in args[1:] if not arg.startswith("-")]
+        if args[0] == "remote":
+            if not names or names[0] not in ("add", "set-url", "rename", "remove"):
+                return
+            names = names[1:]
+        if not names:
+            return
+        remote = names[0]
+        self.ref_snapshots.pop(remote, None)
+        if args[0] == "push" and self.ref_snapshot_dir is not None and self.ref_snapshot_ttl > 0:
+            try:
+                os.remove(self._ref_snapshot_path(remote))
+            except (OSError, RuntimeError):
+                pass  # No cached snapshot, or not a configured remote
+
     def remote_already_has_ref(self, remote: str, ref_name: str):
-        """ `ls-remote` is pretty forgiving, e.g. either {master, refs/heads/master} will be found """
-        lines = self.cmd("ls-remote", remote, ref_name)
-        return (lines != "")
+        return self.ref_snapshot(remote).has(ref_name)
 
     def fetch_current_tag_value(self, remote: str, tag_name: str):
-        lines = self.cmd("ls-remote", "--tags", remote, tag_name)
-        for line in lines.splitlines():
-            cols = line.split()
-            sha = cols[0]
-            tag = cols[1].removeprefix('refs/tags/')
-            if tag == tag_name:
-                return sha
-        return None
+        return self.ref_snapshot(remote).get(f"refs/tags/{tag_name}")
 
     def fetch_cat_pretty(self, remote: str, ref: str) -> str:
-        self.cmd("fetch", remote, ref)
+        self.cmd("fetch", "--no-tags", remote, ref)
         content = self.cmd("cat-file", "-p", ref)
         return content
 
+    def fetch_batch(self, remote: str, objs: list[str], jobs: int = 1, filter: str | None = None,
+                    batch_size: int = FETCH_BATCH_SIZE):
+        """
+        Fetch many objects, at most batch_size per fetch round trip, for remotes which throttle or reject a single
+        fetch of thousands of objects. Batches are fetched by jobs concurrent fetches.
+        A filter, e.g. "blob:none", needs `make_partial_clone` first. Remotes not supporting filters ignore it.
+        """
+        filter_args = [f"--filter={filter}"] if filter else []
+        objs = list(dict.fromkeys(objs))  # de-duplicate, keep order
+        if not objs:
+            return
+
+        def fetch(chunk: list[str]):
+            # Object names are passed on stdin, so thousands of them won't hit the command-line length limit
+            # --no-tags: Without tags to auto-follow, there's no ref advertisement, only the fetch itself
+            self.cmd("fetch", "--no-tags", "--no-write-fetch-head", *filter_args, "--stdin", remote, input="\n".join(chunk) + "\n")
+
+        chunks = [objs[i:i+batch_size] for i in range(0, len(objs), batch_size)]
+        if len(chunks) == 1 or jobs <= 1:
+            for chunk in chunks:
+                fetch(chunk)
+        else:
+            # Fetches are I/O-bound subprocesses and write no refs, so they can share the repo concurrently
+            with ThreadPoolExecutor(max_workers=min(jobs, len(chunks))) as pool:
+                list(pool.map(fetch, chunks))  # Re-raises the first failed fetch
+
+    def fetch_cat_batch(self, remote: str, objs: list[str], jobs: int = 1,
+                        batch_size: int = FETCH_BATCH_SIZE) -> dict[str, str]:
+        """
+        Like `fetch_cat_pretty` but for many objects: One `cat-file` process in total, and the fetches of
+        `fetch_batch`.
+        """
+        objs = list(dict.fromkeys(objs))  # de-duplicate, keep order
+        if not objs:
+            return {}
+        self.fetch_batch(remote, objs, jobs=jobs, batch_size=batch_size)
+        # Output order follows objs regardless of which fetch finished first
+        return self.cat_file_batch(objs)
+
+    def cat_file_batch(self, objs: list[str]) -> dict[str, str]:
+        """ Read content of many objects through a single `cat-file --batch` stream """
+        out = self.cmd("cat-file", "--batch", input=("\n".join(objs) + "\n").encode(), text=False)
+
+        # Output is per object: "<sha> <type> <size>\n<content>\n", or "<obj> missing\n".
+        # Size is in bytes, so parse as bytes and decode each content separately.
+        contents = {}
+        pos = 0
+        for obj in objs:
+            eol = out.index(b"\n", pos)
+            header = out[pos:eol].decode().split()
+            pos = eol + 1
+            if header[-1] == "missing":
+                raise RuntimeError(f"RbGit object {obj} is missing")
+            size = int(header[2])
+            contents[obj] = out[pos:pos+size].decode(errors="replace")
+            pos += size + 1
+        return contents
+
+    def make_partial_clone(self, remote: str, filter: str = "blob:none"):
+        """
+        Allow fetching from remote with filter, leaving out e.g. blobs. Git then knows remote promises the missing
+        objects, and won't consider the repo corrupt.
+        """
+        self.cmd("config", "core.repositoryformatversion", "1")  # Required by extensions
+        self.cmd("config", "extensions.partialClone", remote)
+        self.cmd("config", f"remote.{remote}.promisor", "true")
+        self.cmd("config", f"remote.{remote}.partialclonefilter", filter)
+
+    def fetch_capabilities(self, remote: str) -> set[str]:
+        """
+        What remote supports fetching, e.g. "shallow" and "filter", as traced from its advertisement. Asked for since
+        a remote not supporting a filter is fetched from in full, with just a warning.
+        """
+        with tempfile.TemporaryDirectory(prefix="gitrb-trace-") as trace_dir:
+            trace = os.path.join(trace_dir, "packet")
+            self.cmd("ls-remote", remote, "refs/artifact/capabilities", env={"GIT_TRACE_PACKET": trace})
+            with open(trace, "r", errors="replace") as file:
+                received = [m.group(1) for m in re.finditer(r"packet: +[\w-]+< (.*)$", file.read(), re.MULTILINE)]
+        capabilities = set()
+        for payload in received:
+            if payload.startswith("fetch="):
+                capabilities.update(payload[len("fetch="):].split())  # Protocol v2
+            elif "\\0" in payload:
+                capabilities.update(payload.split("\\0", 1)[1].split())  # Protocol v0, after the first ref
+        return capabilities
+
+    def add_alternate(self, objects_dir: str):
+        """ Let this repo read objects from another repo's objects_dir, as if they were its own. Idempotent """
+        own_objects = os.path.join(self.rbgit_dir, "objects")
+        if os.path.abspath(objects_dir) == os.path.abspath(own_objects):
+            return
+        alternates = os.path.join(own_objects, "info", "alternates")
+        try:
+            with open(alternates, "r") as file:
+                if objects_dir in file.read().splitlines():
+                    return
+        except FileNotFoundError:
+            pass
+        os.makedirs(os.path.dirname(alternates), exist_ok=True)
+        with open(alternates, "a") as file:
+            file.write(objects_dir + "\n")
+
     def hash_object(self, path: str) -> str:
         sha = self.cmd("hash-object", path).strip()
         return sha
 
     def meta_for_commit_refs(self, remote: str):
-        lines = self.cmd("ls-remote", "--refs", remote, "refs/artifact/meta-for-commit/*")
-        return lines.splitlines()
+        return [f"{sha}\t{ref}" for sha, ref in self.ref_snapshot(remote).prefix("refs/artifact/meta-for-commit/")]
+
+    def meta_for_name_refs(self, remote: str):
+        return [f"{sha}\t{ref}" for sha, ref in self.ref_snapshot(remote).prefix("refs/artifact/meta-for-name/")]
@@ -0,0 +1,119 @@
+import re
+import sys
+import json
+import time
+import threading
+import subprocess
+from contextlib import contextmanager
+
+from .printer import printer
+
+# git's progress on stderr, of which the last line per counter has the totals
+PROGRESS_BYTES = re.compile(r"(?:Receiving|Unpacking|Writing) objects: +\d+% \(\d+/\d+\), ([\d.]+) (bytes|KiB|MiB|GiB)")
+PROGRESS_TOTAL = re.compile(r"(?:^|remote: )Total (\d+) ", re.MULTILINE)
+UNITS = {"bytes": 1, "KiB": 1 << 10, "MiB": 1 << 20, "GiB": 1 << 30}
+
+# git commands whose progress tells what was transferred. Only shown with --progress, as stderr is not a terminal
+TRANSFER_COMMANDS = ("fetch", "push")
+
+
+def parse_progress(stderr: str) -> tuple[int, int]:
+    """
+    Objects and bytes transferred, from the progress output of a fetch or push. Zeros if nothing was.
+    git leaves out the bytes of transfers too quick to show progress for, so those count as 0 bytes.
+    """
+    objects = [int(total) for total in PROGRESS_TOTAL.findall(stderr)]
+    sizes = PROGRESS_BYTES.findall(stderr)
+    size = int(float(sizes[-1][0]) * UNITS[sizes[-1][1]]) if sizes else 0
+    return (objects[-1] if objects else 0), size
+
+
+def git_subcommand(args) -> str:
+    """ Subcommand of git's arguments, e.g. "fetch" of ("-c", "x=y", "fetch", "origin") """
+    args = list(args)
+    while args and args[0].startswith("-"):
+        args = args[2:] if args[0] == "-c" else args[1:]
+    return args[0] if args else ""
+
+
+class Telemetry:
+    """
+    Where time went, per phase of a command and per git subcommand, and how many objects and bytes were transferred.
+    Collected from concurrent threads. Transfer counts need enabled, as git only reports them with --progress.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+        self.phases: dict[str, float] = {}
+        self.commands: dict[str, dict[str, float]] = {}
+
+    @contextmanager
+    def phase(self, name: str):
+        """ Time the enclosed code as phase name. Repeated phases add up """
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.phases[name] = self.phases.get(name, 0.0) + time.monotonic() - start
+
+    def instrument(self, args) -> tuple:
+        """ git's arguments, with those making it report what it transferred added when enabled """
+        subcommand = git_subcommand(args)
+        if not self.enabled or subcommand not in TRANSFER_COMMANDS:
+            return tuple(args)
+        after = list(args).index(subcommand) + 1
+        # A fetch kept as a pack, rather than unpacked to loose objects, reports its bytes however small
+        config = ["-c", "fetch.unpackLimit=1"] if subcommand == "fetch" else []
+        return (*config, *args[:after], "--progress", *args[after:])
+
+    def record(self, args, seconds: float, stderr: str | None = None):
+        """ Account a git command which took seconds, and its progress output if captured """
+        subcommand = git_subcommand(args)
+        objects, size = parse_progress(stderr) if stderr and subcommand in TRANSFER_COMMANDS else (0, 0)
+        with self.lock:
+            stats = self.commands.setdefault(subcommand, {"calls": 0, "seconds": 0.0, "objects": 0, "bytes": 0})
+            stats["calls"] += 1
+            stats["seconds"] += seconds
+            stats["objects"] += objects
+            stats["bytes"] += size
+
+    def summary(self, command: str) -> dict:
+        with self.lock:
+            return {
+                "command": command,
+                "seconds": round(time.monotonic() - self.started, 3),
+                "phases": {name: round(seconds, 3) for name, seconds in self.phases.items()},
+                "git": {name: {**stats, "seconds": round(stats["seconds"], 3)} for name, stats in sorted(self.commands.items())},
+            }
+
+    def report(self, command: str, json_path: str | None = None):
+        """ Print the summary with -vv, and write it as JSON to json_path if given """
+        summary = self.summary(command)
+        printer.debug(f"{command} took {summary['seconds']}s", file=sys.stderr)
+        for name, seconds in summary["phases"].items():
+            printer.debug(f"  phase {name:<12} {seconds:>9.3f}s", file=sys.stderr)
+        for name, stats in summary["git"].items():
+            printer.debug(f"  git {name:<14} {stats['seconds']:>9.3f}s {stats['calls']:>5} calls"
+                          f" {stats['objects']:>7} objects {stats['bytes']:>12} bytes", file=sys.stderr)
+        if json_path:
+            with open(json_path, "w") as file:
+                json.dump(summary, file, indent=2)
+                file.write("\n")
+
+
+def run_teeing_stderr(argv: list[str], env: dict[str, str], cwd: str | None = None) -> subprocess.CompletedProcess:
+    """ Run argv with stdout and stderr shown as they come, like `subprocess.run`, but also return stderr as text """
+    process = subprocess.Popen(argv, env=env, cwd=cwd, stderr=subprocess.PIPE)
+    stderr = bytearray()
+    # Progress is rewritten in place by \r, so pass on whatever arrives rather than waiting for whole lines
+    while chunk := process.stderr.read1(1 << 16):
+        sys.stderr.buffer.write(chunk)
+        sys.stderr.buffer.flush()
+        stderr += chunk
+    return subprocess.CompletedProcess(argv, process.wait(), None, stderr.decode(errors="replace"))
+
+
+telemetry = Telemetry()
@@ -35,6 +35,20 @@ def parse_expire_date(expiry_formatted: str, prefix_discard: str = "") -> dict:
     ret['tzoffset'] = match.group('offset') if match else None
     return ret
 
+def date_expire_from_branch(branch: str, now: datetime.datetime) -> datetime.datetime | None:
+    """
+    Expiry of an artifact branch, from the `DATE_FMT_EXPIRE` part of its name.
+    Timezone may be absent, then now's is assumed, but we insist on date and time: Returns None without them.
+    """
+    date_time_tz = parse_expire_date(branch)
+    if date_time_tz['date'] == None: return None
+    if date_time_tz['time'] == None: return None
+    if date_time_tz['tzoffset'] == None:
+        date_time_tz['tzoffset'] = datetime.datetime.strftime(now, "%z")
+
+    compliant_expire_string = f"{date_time_tz['date']}/{date_time_tz['time']}{date_time_tz['tzoffset']}"
+    return date_parse_formatted(date_string=compliant_expire_string, date_format=DATE_FMT_EXPIRE)
+
 def date_fuzzy2expiryformat(fuzzy_date: str) -> str:
     """Convert fuzzy date/time string to ``DATE_FMT_EXPIRE`` in local time."""
 
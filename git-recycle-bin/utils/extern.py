@@ -4,9 +4,9 @@ import subprocess
 
 from git_recycle_bin.printer import printer
 
-def exec(command, env={}, cwd=None):
+def exec(command, env={}, cwd=None, input=None):
     printer.debug("Run:", command, file=sys.stderr)
-    return subprocess.check_output(command, env=os.environ|env, text=True, cwd=cwd).strip()
+    return subprocess.check_output(command, env=os.environ|env, text=True, cwd=cwd, input=input).strip()
 
 def exec_nostderr(command, env={}, cwd=None):
     printer.debug("Run:", command, file=sys.stderr)
@@ -31,3 +31,50 @@ def jq(command, input, env=None):
     except (subprocess.CalledProcessError, FileNotFoundError) as e:
         printer.error(f"jq command failed: {e}", file=sys.stderr)
         return None
+
+
+class JqError(RuntimeError):
+    """ jq could not be run, or failed on its filter """
+
+
+class JqStream:
+    """
+    Evaluate one jq filter on many JSON inputs, through a single long-running jq process.
+    The filter is compiled once, instead of once per input by a new process.
+
+    The filter is wrapped to yield exactly one line per input: Whether it produced any truthy output.
+    Thus both predicates, e.g. `.x == 1`, and selections, e.g. `select(.x == 1)`, work. Errors count as false.
+    jq's own errors, e.g. of an invalid filter, go to our stderr. Raises JqError if jq is missing or exited.
+    """
+
+    def __init__(self, query: str, env=None):
+        env = env or {}
+        command = ['jq', '--unbuffered', '--compact-output', f"try ([{query}] | any) catch false"]
+        printer.debug("Run jq:", command, file=sys.stderr)
+        try:
+            self.proc = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                         env=os.environ|env, text=True)
+        except OSError as e:
+            raise JqError(f"Could not run jq: {e}")
+
+    def __call__(self, input: str) -> bool:
+        try:
+            self.proc.stdin.write(input.replace("\n", " ") + "\n")
+            self.proc.stdin.flush()
+            line = self.proc.stdout.readline()
+        except BrokenPipeError:
+            line = ""
+        if line == "":
+            raise JqError(f"jq exited with code {self.proc.wait()}, see above")
+        return line.strip() == "true"
+
+    def close(self):
+        if getattr(self, "proc", None) is not None and self.proc.poll() is None:
+            try:
+                self.proc.stdin.close()
+            except BrokenPipeError:
+                pass
+            self.proc.wait()
+
+    def __del__(self):
+        self.close()
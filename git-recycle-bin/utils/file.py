@@ -1,6 +1,8 @@
 import os
+import tempfile
 import mimetypes
 from itertools import takewhile
+from typing import Iterable
 
 def nca_path(pathA, pathB):
     """ Get nearest common ancestor of two paths """
@@ -32,3 +34,23 @@ def classify_path(binpath: str) -> str:
     elif os.path.islink(binpath): return "link"
     elif os.path.ismount(binpath): return "mount"
     else: return "unknown"
+
+
+def atomic_write(path: str, data: str | bytes | Iterable[bytes], mode: int | None = None):
+    """
+    Write data, text or bytes or an iterable of bytes chunks, to path. Written to a temporary file then renamed,
+    so readers never see a partial file. Creates path's directory. mode sets the file's permissions, if given.
+    """
+    directory = os.path.dirname(path) or "."
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "w" if isinstance(data, str) else "wb") as file:
+            for chunk in [data] if isinstance(data, (str, bytes)) else data:
+                file.write(chunk)
+        if mode is not None:
+            os.chmod(tmp_path, mode)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
@@ -10,6 +10,11 @@ def str2bool(v):
         return False
     raise ValueError('Boolean value expected.')
 
+def positive_int(v):
+    if int(v) < 1:
+        raise ValueError('Positive integer expected.')
+    return int(v)
+
 def trim_all_lines(input_string: str) -> str:
     """ Trim leading and trailing whitespaces from every line """
     lines = input_string.split('\n')
@@ -68,6 +73,25 @@ def sanitize_branch_name(name: str) -> str:
 
     return sanitized_name
 
+def sanitize_ref_component(name: str) -> str:
+    """
+        Make name usable as a single /-separated component of a ref name. See `sanitize_branch_name`.
+        Additionally a component cannot contain / \\ @{ or control characters, start with . or end with .lock
+    """
+    sanitized_name = sanitize_branch_name(sanitize_slashes(name))
+
+    # replace \ and control characters with _
+    sanitized_name = re.sub(r'[\\\x00-\x1f\x7f]', '_', sanitized_name)
+
+    # replace @{ with _{
+    sanitized_name = sanitized_name.replace('@{', '_{')
+
+    # replace starting . and ending .lock with _
+    sanitized_name = re.sub(r'^\.', '_', sanitized_name)
+    sanitized_name = re.sub(r'\.lock$', '_lock', sanitized_name)
+
+    return sanitized_name or '_'
+
 def url_redact(url: str, replacement: str = 'REDACTED'):
     """ Replace sensitive password/api-token from URL with a string """
     parsed = urllib.parse.urlparse(url)
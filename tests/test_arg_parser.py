@@ -21,6 +21,8 @@ def test_parse_args_push():
     assert args.remote == 'https://example.com'
     assert args.path == '/tmp/foo'
     assert args.name == 'bar'
+    assert args.hash_jobs == 1  # Hashing in a pool of processes is opt-in
+    assert not args.delta_base  # As is fetching the previous artifact's trees, costing a round trip
 
 
 def test_parse_args_force_tag_requires_force_branch():
@@ -28,6 +30,28 @@ def test_parse_args_force_tag_requires_force_branch():
     assert res is None
 
 
+def test_parse_args_prune_requires_incremental():
+    assert run_parse_args(['download', 'https://example.com', 'abc', '--prune']) is None
+    args = run_parse_args(['download', 'https://example.com', 'abc', '--prune', '--incremental'])
+    assert args.prune and args.incremental
+
+
+def test_parse_args_to_stdout():
+    args = run_parse_args(['download', 'https://example.com', 'abc', '--to-stdout', '--format', 'tar.zst'])
+    assert args.to_stdout and args.format == 'tar.zst'
+    assert run_parse_args(['download', 'https://example.com', 'abc', 'def', '--to-stdout']) is None
+    assert run_parse_args(['download', 'https://example.com', 'abc', '--to-stdout', '--include', '*.bin']) is None
+
+
+def test_parse_args_include_env(monkeypatch):
+    monkeypatch.setenv('GITRB_INCLUDE', 'a.bin c.bin')
+    assert run_parse_args(['download', 'https://example.com', 'abc']).include == ['a.bin', 'c.bin']
+    # Given globs replace those of the environment
+    assert run_parse_args(['download', 'https://example.com', 'abc', '--include', 'b.bin']).include == ['b.bin']
+    monkeypatch.delenv('GITRB_INCLUDE')
+    assert run_parse_args(['download', 'https://example.com', 'abc']).include is None
+
+
 def test_parse_args_list_name():
     args = run_parse_args(['list', 'https://example.com', '--name', 'foo'])
     assert args.command == 'list'
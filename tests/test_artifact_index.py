@@ -0,0 +1,91 @@
+import subprocess
+
+from git_recycle_bin.rbgit import RefSnapshot, create_rbgit
+from git_recycle_bin.artifact_index import (
+    INDEX_REF,
+    blob_sha,
+    index_emit,
+    index_parse,
+    remote_index_sha,
+    remote_index_load,
+    remote_index_add,
+    remote_index_remove,
+)
+
+
+def test_blob_sha_matches_git():
+    content = "artifact-name: æøå\n"
+    git_sha = subprocess.check_output(['git', 'hash-object', '--stdin'], input=content, text=True).strip()
+    assert blob_sha(content) == git_sha
+
+
+def test_emit_parse_roundtrip():
+    entries = {blob_sha(c): c for c in ["b: 2\n", "a: 1\nmulti\nline\n"]}
+    text = index_emit(entries)
+    assert index_parse(text) == entries
+    lines = text.splitlines()
+    assert lines[1:] == sorted(lines[1:])
+
+
+def test_parse_drops_mismatching_entries():
+    good = "a: 1\n"
+    text = index_emit({blob_sha(good): good, 'f' * 40: "tampered"})
+    assert index_parse(text) == {blob_sha(good): good}
+
+
+def test_remote_index_add_remove(temp_git_setup):
+    local, _, artifact_remote, _ = temp_git_setup
+    rbgit = create_rbgit(str(local), clean=True)
+    rbgit.add_remote_idempotent("bin", str(artifact_remote))
+    metas = {blob_sha(c): c for c in ["name: one\n", "name: two\n"]}
+    sha1, sha2 = list(metas)
+
+    assert remote_index_sha(rbgit, "bin") is None
+    assert remote_index_remove(rbgit, "bin", {sha1})  # no index is fine
+
+    assert remote_index_add(rbgit, "bin", {sha1: metas[sha1]})
+    assert remote_index_add(rbgit, "bin", {sha2: metas[sha2]})
+    assert remote_index_load(rbgit, "bin", remote_index_sha(rbgit, "bin")) == metas
+
+    assert remote_index_remove(rbgit, "bin", {sha1})
+    assert remote_index_load(rbgit, "bin", remote_index_sha(rbgit, "bin")) == {sha2: metas[sha2]}
+    rbgit.cleanup()
+
+
+def test_remote_index_update_retries_lost_race(temp_git_setup, monkeypatch):
+    local, _, artifact_remote, _ = temp_git_setup
+    rbgit = create_rbgit(str(local), clean=True)
+    rbgit.add_remote_idempotent("bin", str(artifact_remote))
+    ours, theirs = "name: ours\n", "name: theirs\n"
+
+    # A concurrent pusher updates the index right before our first push
+    cmd = rbgit.cmd
+    raced = []
+    def racing_cmd(*args, **kwargs):
+        if args[0] == "push" and not raced:
+            raced.append(True)
+            sha = cmd("hash-object", "-w", "--stdin", input=index_emit({blob_sha(theirs): theirs})).strip()
+            cmd("push", "bin", f"{sha}:{INDEX_REF}")
+        return cmd(*args, **kwargs)
+    monkeypatch.setattr(rbgit, "cmd", racing_cmd)
+
+    assert remote_index_add(rbgit, "bin", {blob_sha(ours): ours})
+    assert remote_index_load(rbgit, "bin", remote_index_sha(rbgit, "bin")) == {
+        blob_sha(ours): ours,
+        blob_sha(theirs): theirs,
+    }
+    rbgit.cleanup()
+
+
+def test_remote_index_update_fails_once_when_push_fails(temp_git_setup, tmp_path):
+    local, _, _, _ = temp_git_setup
+    rbgit = create_rbgit(str(local), clean=True)
+    rbgit.add_remote_idempotent("bin", str(tmp_path / "missing.git"))
+    pushes = []
+    cmd = rbgit.cmd
+    rbgit.cmd = lambda *args, **kwargs: (args[0] == "push" and pushes.append(args)) or cmd(*args, **kwargs)
+    rbgit.ref_snapshot = lambda remote: RefSnapshot({})
+
+    assert not remote_index_add(rbgit, "bin", {blob_sha("name: ours\n"): "name: ours\n"})
+    assert len(pushes) == 1
+    rbgit.cleanup()
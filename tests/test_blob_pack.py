@@ -0,0 +1,61 @@
+import os
+import glob
+import subprocess
+
+from git_recycle_bin.blob_pack import entry_header, split_by_size, write_blobs
+from git_recycle_bin.rbgit import create_rbgit
+
+
+def test_entry_header():
+    assert entry_header(5) == bytes([0x35])
+    assert entry_header(100) == bytes([0xb4, 0x06])  # 4 low bits first, then 7 per byte
+
+
+def test_split_by_size():
+    blobs = [('a', 'pa', 10), ('b', 'pb', 1), ('c', 'pc', 6), ('d', 'pd', 5)]
+    assert split_by_size(blobs, 2) == [[('a', 'pa'), ('b', 'pb')], [('c', 'pc'), ('d', 'pd')]]
+    assert split_by_size(blobs[:1], 4) == [[('a', 'pa')]]
+
+
+def test_write_blobs(tmp_path):
+    art = tmp_path / 'obj'
+    art.mkdir()
+    (art / 'big').write_bytes(os.urandom(3 << 20) * 2)  # Mapped, and compressed a block at a time
+    (art / 'small').write_bytes(b'small\n')
+    (art / 'same').write_bytes(b'small\n')
+    (art / 'empty').write_bytes(b'')
+    os.symlink('small', art / 'link')
+    paths = ['obj/big', 'obj/small', 'obj/same', 'obj/empty', 'obj/link']
+
+    rbgit = create_rbgit(src_tree_root=str(tmp_path), clean=True)
+    blobs = write_blobs(rbgit, paths, jobs=3)
+    for path in paths[:4]:
+        assert blobs[path] == rbgit.cmd('hash-object', str(tmp_path / path)).strip()
+    assert blobs['obj/link'] == rbgit.cmd('hash-object', '--stdin', input='small').strip()
+
+    # Written as packs git accepts, without loose objects
+    packs = glob.glob(os.path.join(rbgit.rbgit_dir, 'objects', 'pack', '*.pack'))
+    assert len(packs) == 3
+    for pack in packs:
+        subprocess.run(['git', 'verify-pack', pack], check=True)
+    assert 'count: 0\n' in rbgit.cmd('count-objects', '-v')
+    assert rbgit.cmd('cat-file', 'blob', blobs['obj/big'], text=False) == (art / 'big').read_bytes()
+
+    # Blobs the repo has are not packed again
+    assert write_blobs(rbgit, paths, jobs=3) == blobs
+    assert len(glob.glob(os.path.join(rbgit.rbgit_dir, 'objects', 'pack', '*.pack'))) == 3
+    rbgit.cleanup()
+
+
+def test_filtered_files_are_left_to_git(tmp_path):
+    (tmp_path / '.gitattributes').write_text('*.txt text\n')
+    (tmp_path / 'a.txt').write_text('a\r\n')
+    (tmp_path / 'b.bin').write_bytes(b'b\r\n')
+    rbgit = create_rbgit(src_tree_root=str(tmp_path), clean=True)
+    assert rbgit.filtered(['a.txt', 'b.bin'])
+    assert not rbgit.filtered(['b.bin'])
+
+    # Stored as `add` does, with line endings converted
+    tree = rbgit.write_tree_of(str(tmp_path / 'a.txt'), jobs=2)
+    assert rbgit.cmd('cat-file', 'blob', f'{tree}:a.txt') == 'a\n'
+    rbgit.cleanup()
@@ -0,0 +1,112 @@
+import os
+import subprocess
+
+import pytest
+
+import git_recycle_bin.chunked_transfer as chunked_mod
+from git_recycle_bin.chunked_transfer import chunk_ref, fetch_chunked, plan_chunks, push_chunked, remote_chunks
+from git_recycle_bin.commands.clean import remote_flush_chunks
+from git_recycle_bin.rbgit import create_rbgit
+from managers import git_user_info
+
+
+@pytest.fixture
+def chunked(tmp_path, monkeypatch):
+    """ An artifact commit of four 3000 byte files in a bin repo, with an empty file:// remote """
+    monkeypatch.setattr(chunked_mod, 'RETRY_DELAY', 0)
+    remote = tmp_path / 'remote.git'
+    subprocess.run(['git', 'init', '-q', '--bare', str(remote)], check=True)
+
+    work = tmp_path / 'work'
+    work.mkdir()
+    for name in 'abcd':
+        (work / name).write_bytes(os.urandom(3000))
+    rbgit = create_rbgit(src_tree_root=str(work), clean=True)
+    rbgit.add_remote_idempotent('bin', f'file://{remote}')
+    rbgit.cmd('add', '.')
+    tree = rbgit.cmd('write-tree').strip()
+    with git_user_info():
+        commit = rbgit.cmd('commit-tree', tree, '-m', 'artifact').strip()
+        yield rbgit, commit, tree, remote
+    rbgit.cleanup()
+
+
+def failing(rbgit, monkeypatch, match: str, times: int) -> list:
+    """ Make the first times commands of rbgit with an argument containing match fail. Returns all commands run """
+    run = []
+    original = rbgit.cmd
+    def cmd(*args, **kwargs):
+        nonlocal times
+        run.append(args)
+        if times and any(match in arg for arg in args):
+            times -= 1
+            raise RuntimeError('Connection reset by peer')
+        return original(*args, **kwargs)
+    monkeypatch.setattr(rbgit, 'cmd', cmd)
+    return run
+
+
+def test_plan_chunks():
+    blobs = [('a', 4), ('b', 4), ('c', 9), ('d', 1), ('e', 2)]
+    assert plan_chunks(blobs, 8) == [['a', 'b'], ['c'], ['d', 'e']]  # Too big for any chunk gets its own
+    assert plan_chunks([], 8) == []
+
+
+def test_push_resumes_and_fetch_resumes(chunked, tmp_path, monkeypatch):
+    rbgit, commit, _, remote = chunked
+    run = failing(rbgit, monkeypatch, chunk_ref(commit, 2), times=1)
+
+    assert push_chunked(rbgit, 'bin', commit, chunk_size=6000)
+    assert sum(chunk_ref(commit, 2) in ' '.join(args) for args in run if args[0] == 'push') == 2  # Retried
+    # Manifest brought the artifact along, so pushing its branch will send nothing more
+    assert subprocess.check_output(['git', 'cat-file', '-t', commit], cwd=remote, text=True).strip() == 'commit'
+
+    other = tmp_path / 'other'
+    other.mkdir()
+    dst = create_rbgit(src_tree_root=str(other), clean=True)
+    dst.add_remote_idempotent('bin', f'file://{remote}')
+    chunks = remote_chunks(dst.ref_snapshot('bin'), commit)
+    assert [ref for ref, _ in chunks] == [chunk_ref(commit, name) for name in [1, 2, 'manifest']]
+
+    # Connection dropped on every try of chunk 2
+    run = failing(dst, monkeypatch, f'+{chunk_ref(commit, 2)}:', times=2)
+    with pytest.raises(RuntimeError, match='giving up'):
+        fetch_chunked(dst.cmd, 'bin', commit, chunks, tries=2)
+
+    # Next attempt resumes from chunk 2
+    run.clear()
+    fetch_chunked(dst.cmd, 'bin', commit, chunks)
+    assert [args[-1] for args in run if args[0] == 'fetch'] == [f'+{ref}:{ref}' for ref, _ in chunks[1:]]
+    assert dst.cmd('cat-file', '-t', commit).strip() == 'commit'
+    assert len(dst.cmd('ls-tree', '-r', commit).splitlines()) == 4
+    dst.cleanup()
+
+
+def test_interrupted_push_is_resumed_by_next_push(chunked, monkeypatch):
+    rbgit, commit, tree, _ = chunked
+    failing(rbgit, monkeypatch, chunk_ref(commit, 2), times=1)
+    with pytest.raises(RuntimeError, match='giving up'):
+        push_chunked(rbgit, 'bin', commit, chunk_size=6000, tries=1)
+    assert remote_chunks(rbgit.ref_snapshot('bin'), commit) is None  # No manifest, so not used by downloads
+
+    # Pushing again makes a new artifact commit, of the same files, whose chunks are the same
+    with git_user_info():
+        again = rbgit.cmd('commit-tree', tree, '-m', 'artifact, take 2').strip()
+    run = failing(rbgit, monkeypatch, '', times=0)
+    push_chunked(rbgit, 'bin', again, chunk_size=6000)
+    pushed = [args[2:] for args in run if args[0] == 'push']
+    assert pushed[0][0].endswith(f':{chunk_ref(again, 2)}')  # Chunk 1 was not pushed again, only its ref
+    assert [refspec.split(':')[1] for refspec in pushed[1]] == [chunk_ref(again, 1)]
+
+    # Clean keeps chunks of pushes which began recently, as those may still be in progress
+    rbgit.cmd('push', 'bin', f'{again}:refs/heads/artifact')
+    remote_flush_chunks(rbgit, 'bin')
+    chunk_refs = lambda: [ref for _, ref in rbgit.ref_snapshot('bin').prefix(chunked_mod.CHUNKS_REF_PREFIX)]
+    assert len([ref for ref in chunk_refs() if ref.startswith(chunk_ref(commit, ''))]) == 2  # Chunk 1 and start
+    assert remote_chunks(rbgit.ref_snapshot('bin'), again) is not None
+
+    # Later, it flushes chunks of artifacts which are not, or no longer, on the remote
+    remote_flush_chunks(rbgit, 'bin', grace=-60)
+    assert all(ref.startswith(chunk_ref(again, '')) for ref in chunk_refs())
+    names = [ref.rsplit('/', 1)[1] for ref in chunk_refs()]
+    assert names[:3] == ['1', '2', 'manifest'] and names[3].startswith('started-')
@@ -63,3 +63,4 @@ def test_flush_meta_for_commit(temp_git_setup):
         remote_delete_expired_branches(rbgit, rb_remote)
         remote_flush_meta_for_commit(rbgit, rb_remote)
         assert contains_metas(rbgit, rb_remote, {bin_commit})
+        assert { meta[-40:] for meta in rbgit.meta_for_name_refs(rb_remote) } == {bin_commit}
@@ -1,16 +1,26 @@
 from types import SimpleNamespace
+
+import pytest
+
 import git_recycle_bin.commands.download as download_mod
 from git_recycle_bin.commands.list import ListResult
+from git_recycle_bin.rbgit import RefSnapshot
 
 class DummyRbGit:
     def __init__(self, rbgit_work_tree=None):
         self.calls = []
         self.rbgit_work_tree = rbgit_work_tree
+        self.rbgit_dir = f'{rbgit_work_tree}/.rbgit'
+        self.ssh_command = None
+        self.refs = {}
 
-    def cmd(self, *args):
-        self.calls.append(args)
-        if args[0] == 'checkout' and args[-1] == 'fail' and '-f' not in args:
-            raise RuntimeError('exists')
+    def cmd(self, *args, **kwargs):
+        self.calls.append((*args, *kwargs.values()))
+        if args[0] == 'ls-tree':
+            return LS_TREE
+
+    def ref_snapshot(self, remote_bin_name):
+        return RefSnapshot(self.refs)
 
     def get_remote_url(self, remote_bin_name):
         self.calls.append(('get_remote_url', remote_bin_name))
@@ -22,60 +32,207 @@ class DummyRbGit:
     def cleanup(self):
         self.calls.append(('cleanup'))
 
+    def fetch_batch(self, remote, objs, jobs=1, filter=None):
+        self.calls.append(('fetch_batch', remote, objs, filter) if filter else ('fetch_batch', remote, objs))
+        if 'missing' in objs:
+            raise RuntimeError('not our ref')
+
+    def add_alternate(self, objects_dir):
+        self.calls.append(('add_alternate', objects_dir))
+
+    def make_partial_clone(self, remote):
+        self.calls.append(('make_partial_clone', remote))
+
+
+@pytest.fixture(autouse=True)
+def fake_materialize(monkeypatch):
+    """ Record what would be written, instead of writing. Real writing is tested in test_materialize """
+    def materialize(rbgit, commit, prefix='', paths=None, force=False, stat_cache=None, prune=False, blob_cache=None):
+        rbgit.calls.append(('materialize', commit, prefix, paths, force))
+        if 'fail' in (commit, prefix) and not force:
+            raise RuntimeError('exists')
+    monkeypatch.setattr(download_mod, 'materialize', materialize)
+
+
+LS_TREE = '\0'.join([
+    '100644 blob b1\tout/fw/app.bin',
+    '100755 blob b2\tout/fw/boot.bin',
+    '100644 blob b3\tout/docs/index.html',
+    '160000 commit c1\tout/sub',
+    '100644 blob b4\tout.txt',
+]) + '\0'
+
 
-def test_download_single_force_false_error(capsys):
+def test_download_single_force_false_error():
     rbgit = DummyRbGit()
     ret = download_mod.download_single(rbgit, 'remote', 'fail')
     assert ret == 1
-    assert ('fetch', 'remote', 'fail') in rbgit.calls
-    assert ('checkout', 'fail') in rbgit.calls
+    assert ('fetch', '--no-tags', 'remote', 'fail') in rbgit.calls
+    assert ('materialize', 'fail', '', None, False) in rbgit.calls
 
 
 def test_download_single_force_true():
     rbgit = DummyRbGit()
-    ret = download_mod.download_single(rbgit, 'remote', 'ok', force=True)
+    ret = download_mod.download_single(rbgit, 'remote', 'fail', force=True)
     assert ret is None
-    assert rbgit.calls == [('fetch', 'remote', 'ok'), ('checkout', '-f', 'ok')]
+    assert rbgit.calls == [('fetch', '--no-tags', 'remote', 'fail'), ('materialize', 'fail', '', None, True)]
 
 def test_download_single_path_specified():
     rbgit = DummyRbGit()
     ret = download_mod.download_single(rbgit, 'remote', 'ok', path='some/path')
     assert ret is None
-    assert rbgit.calls == [('fetch', 'remote', 'ok'), ('checkout', 'ok', 'some/path')]
+    assert rbgit.calls == [('fetch', '--no-tags', 'remote', 'ok'), ('materialize', 'ok', 'some/path', None, False)]
+
+def mock_create_rbgit(monkeypatch):
+    """ One DummyRbGit per download repo directory, like create_rbgit would """
+    tmp_rbgits = {}
+    def create_rbgit(artifact_path, *args, **kwargs):
+        return tmp_rbgits.setdefault(artifact_path, DummyRbGit(artifact_path))
+    monkeypatch.setattr(download_mod, 'create_rbgit', create_rbgit)
+    return tmp_rbgits
+
+
+def artifact(sha, relpath, prefix):
+    return ListResult(meta_sha=f'meta-{sha}', artifact_sha=sha,
+                      meta_data={'src-git-relpath': relpath, 'artifact-tree-prefix': prefix})
+
 
 def test_download_function(monkeypatch):
-    """Test the main download function with multiple branches"""
-    rbgit = DummyRbGit()
-    intermediary_rbgits = []
-    def mock_create_rbgit(artifact_path, *args, **kwargs):
-        rbgit = DummyRbGit(artifact_path)
-        intermediary_rbgits.append(rbgit)
-        return rbgit
-    monkeypatch.setattr(download_mod, 'create_rbgit', mock_create_rbgit)
-
-    artifacts = [
-        ListResult(meta_sha='meta1',
-                   artifact_sha='branch1',
-                   meta_data={'src-git-relpath': 'path1',
-                              'artifact-tree-prefix': 'prefix1'}),
-        ListResult(meta_sha='meta2',
-                     artifact_sha='branch2',
-                     meta_data={'src-git-relpath': 'path2',
-                                'artifact-tree-prefix': 'prefix2'}),
+    """All artifacts in one fetch, then checked out in the download repo of their relpath"""
+    rbgit = DummyRbGit('main')
+    tmp_rbgits = mock_create_rbgit(monkeypatch)
+    artifacts = [artifact('sha1', 'path1', 'prefix1'), artifact('sha2', 'path2', 'prefix2'), artifact('sha3', 'path1', 'prefix3')]
+
+    assert download_mod.download(rbgit, 'remote', artifacts, force=False, rm_tmp=True) is None
+
+    assert rbgit.calls == [('fetch_batch', 'remote', ['sha1', 'sha2', 'sha3'])]
+    assert tmp_rbgits['path1'].calls == [
+        ('add_alternate', 'main/.rbgit/objects'),
+        ('materialize', 'sha1', 'prefix1', None, False),
+        ('materialize', 'sha3', 'prefix3', None, False),
+        ('cleanup'),
+    ]
+    assert tmp_rbgits['path2'].calls == [
+        ('add_alternate', 'main/.rbgit/objects'),
+        ('materialize', 'sha2', 'prefix2', None, False),
+        ('cleanup'),
+    ]
+
+
+def test_download_continues_past_failures(monkeypatch):
+    errors = []
+    monkeypatch.setattr(download_mod, 'printer', SimpleNamespace(error=lambda *a, **k: errors.append(a[0]),
+                                                                 detail=lambda *a, **k: None,
+                                                                 high_level=lambda *a, **k: None))
+    rbgit = DummyRbGit('main')
+    tmp_rbgits = mock_create_rbgit(monkeypatch)
+    artifacts = [artifact('missing', 'path1', 'p1'), artifact('bad', 'path1', 'fail'), artifact('ok', 'path2', 'p3')]
+
+    assert download_mod.download(rbgit, 'remote', artifacts) == 1
+
+    # Combined fetch failed, so each was fetched on its own
+    assert sorted(rbgit.calls[1:]) == [('fetch_batch', 'remote', [sha]) for sha in ['bad', 'missing', 'ok']]
+    assert ('materialize', 'ok', 'p3', None, False) in tmp_rbgits['path2'].calls
+    assert ('materialize', 'bad', 'fail', None, False) in tmp_rbgits['path1'].calls
+    assert errors[-3:] == [
+        'Failed to download missing to p1: not our ref',
+        'Failed to download bad to fail: exists',
+        '2 of 3 artifacts failed to download.',
     ]
-    # Test successful download of multiple branches
-    result = download_mod.download(rbgit, 'remote', artifacts, force=False, rm_tmp=True)
-
-    assert result is None
-    assert [('get_remote_url', 'remote')] == rbgit.calls
-
-    for irbgit, artifact in zip(intermediary_rbgits, artifacts):
-        remote_name = artifact.meta_data['artifact-tree-prefix']
-        expected_calls = [
-            ('add_remote_idempotent', remote_name, 'dummy_url'),
-            ('fetch', remote_name, artifact.artifact_sha),
-            ('checkout', artifact.artifact_sha, remote_name),
-            ('cleanup')
-        ]
-        assert expected_calls == irbgit.calls
-    # TODO test result of intermediary rbgit instances
+
+
+def test_resolve_artifacts(monkeypatch):
+    errors = []
+    monkeypatch.setattr(download_mod, 'printer', SimpleNamespace(error=lambda msg, **k: errors.append(msg)))
+    src1, src2 = '1' * 40, '2' * 40
+    bin1, bin2, bin3 = 'abc1' + 'a' * 36, 'abc2' + 'b' * 36, 'ffff' + 'c' * 36
+    snapshot = RefSnapshot.parse('\n'.join([
+        f'm1\trefs/artifact/meta-for-commit/{src1}/{bin1}',
+        f'm2\trefs/artifact/meta-for-commit/{src1}/{bin2}',
+        f'm3\trefs/artifact/meta-for-commit/{src2}/{bin3}',
+        f'x\trefs/heads/artifact/expire/2030-01-01/00.00+0000/r@{src2}/{{p}}',
+    ]))
+    fetches = []
+    def fake_fetch_batch(remote, objs, jobs=1):
+        fetches.append(objs)
+        return {obj: f'artifact-name: {obj}' for obj in objs}
+    rbgit = SimpleNamespace(ref_snapshot=lambda remote: snapshot, fetch_cat_batch=fake_fetch_batch)
+
+    res = download_mod.resolve_artifacts(rbgit, 'remote', [f'{src1}/{bin1}', 'ffff', f'{src1[:7]}/abc2', 'abc', 'dead'])
+    assert [(r.meta_sha, r.artifact_sha) for r in res] == [('m1', bin1), ('m3', bin3), ('m2', bin2)]
+    assert res[0].meta_data == {'artifact-name': 'm1'}
+    assert fetches == [['m1', 'm3', 'm2']]  # Only meta-data of the requested artifacts
+
+    assert errors == [f'Artifact abc is ambiguous, it matches: {bin1} {bin2}', 'Artifact dead not found in remote.']
+
+
+def test_download_with_object_store(monkeypatch):
+    rbgit = DummyRbGit('main')
+    tmp_rbgits = mock_create_rbgit(monkeypatch)
+    store_calls = []
+    store = SimpleNamespace(fetch=lambda shas, ssh_command=None, chunks=None: store_calls.append(('fetch', shas)),
+                            link=lambda r: store_calls.append(('link', r)))
+    artifacts = [artifact('sha1', 'path1', 'prefix1'), artifact('sha2', 'path1', 'prefix2')]
+    assert download_mod.download(rbgit, 'remote', artifacts, store=store) is None
+
+    assert store_calls == [('link', tmp_rbgits['path1']), ('fetch', ['sha1', 'sha2'])]
+    assert rbgit.calls == []  # Objects come from the store
+    assert ('materialize', 'sha2', 'prefix2', None, False) in tmp_rbgits['path1'].calls
+
+
+def test_select_paths():
+    select = lambda *include: [(e.sha, e.path) for e in download_mod.select_paths(LS_TREE, 'out', list(include))]
+    assert select('*.bin') == [('b1', 'out/fw/app.bin'), ('b2', 'out/fw/boot.bin')]
+    assert select('fw/boot.bin', 'docs/') == [('b2', 'out/fw/boot.bin'), ('b3', 'out/docs/index.html')]
+    assert select('docs') == [('b3', 'out/docs/index.html')]  # whole directory
+    assert select('sub', 'out.txt', 'nothing') == []  # no submodules, nothing outside the artifact
+    assert [e.path for e in download_mod.select_paths(LS_TREE, 'out.txt', ['out.txt'])] == ['out.txt']  # single file
+    assert len(download_mod.select_paths(LS_TREE, 'out', None)) == 3  # everything
+
+
+def test_download_include(monkeypatch):
+    rbgit = DummyRbGit('main')
+    tmp_rbgits = mock_create_rbgit(monkeypatch)
+    artifacts = [artifact('sha1', 'path1', 'out'), artifact('sha2', 'path1', 'out')]
+
+    assert download_mod.download(rbgit, 'remote', artifacts[:1], include=['fw/*.bin']) is None
+    # Commit and trees first, then only the selected blobs
+    assert rbgit.calls == [
+        ('make_partial_clone', 'remote'),
+        ('fetch_batch', 'remote', ['sha1'], 'blob:none'),
+        ('fetch_batch', 'remote', ['b1', 'b2']),
+    ]
+    assert tmp_rbgits['path1'].calls[-2:] == [
+        ('materialize', 'sha1', 'out', ['out/fw/app.bin', 'out/fw/boot.bin'], False),
+        ('cleanup'),
+    ]
+
+    # Artifact in the store needs no fetch
+    store = SimpleNamespace(missing=lambda shas: ['sha2'], link=lambda r: None)
+    rbgit.calls.clear()
+    assert download_mod.download(rbgit, 'remote', artifacts, include=['*.html'], store=store) is None
+    assert rbgit.calls == [('make_partial_clone', 'remote'), ('fetch_batch', 'remote', ['sha2'], 'blob:none'),
+                           ('fetch_batch', 'remote', ['b3'])]
+    assert ('materialize', 'sha1', 'out', ['out/docs/index.html'], False) in tmp_rbgits['path1'].calls
+
+    # Matching nothing is a failure, and nothing is checked out
+    tmp_rbgits['path1'].calls.clear()
+    assert download_mod.download(rbgit, 'remote', artifacts[:1], include=['nothing']) == 1
+    assert not any(call[0] == 'materialize' for call in tmp_rbgits['path1'].calls)
+
+
+def test_download_to_stdout(monkeypatch):
+    monkeypatch.setattr(download_mod, 'resolve_artifacts', lambda rbgit, remote, artifacts, cache=None:
+                        [artifact('sha1', 'path1', 'out')] if artifacts != ['nothing'] else [])
+    rbgit = DummyRbGit('main')
+
+    assert download_mod.download_to_stdout(rbgit, 'remote', 'sha1') is None
+    # Archived straight from the commit, nothing is written
+    assert rbgit.calls == [('fetch', '--no-tags', 'remote', 'sha1'), ('archive', '--format=tar', 'sha1', False)]
+
+    assert download_mod.download_to_stdout(rbgit, 'remote', 'nothing') == 1
+
+    rbgit.calls.clear()
+    monkeypatch.setattr(download_mod.shutil, 'which', lambda command: None)
+    assert download_mod.download_to_stdout(rbgit, 'remote', 'sha1', format='tar.zst') == 1
+    assert rbgit.calls == []  # Fails before fetching
@@ -1,94 +1,234 @@
 import datetime
+import subprocess
 from types import SimpleNamespace
 
+import pytest
+
 import git_recycle_bin as grb
+import git_recycle_bin.commands.push as push_mod
+from git_recycle_bin.commands.push import PUSH_TRIES, push_refs
+from git_recycle_bin.rbgit import RefSnapshot
 from git_recycle_bin.utils.string import (
     sanitize_branch_name,
     sanitize_slashes,
 )
 
 
-def test_push_branch_force(monkeypatch):
-    calls = []
-    dummy = SimpleNamespace(
-        cmd=lambda *a, **k: calls.append(a)
-    )
-    commit_info = SimpleNamespace(
-        bin_branch_name='b',
-        bin_ref_only_metadata='m'
-    )
-    grb.push_branch(dummy, 'remote', commit_info, force=True)
-    assert ('push', '--force', 'remote', 'b') in calls
-    assert ('push', '--force', 'remote', 'm') in calls
+class PushDummy:
+    """ Remote with refs, recording the pushes and fetches made to it """
+    def __init__(self, refs=None, metas=None):
+        self.calls = []
+        self.snapshot = RefSnapshot(refs or {})
+        self.metas = metas or {}
 
+    def ref_snapshot(self, remote):
+        return self.snapshot
 
-def test_push_branch_skip_existing(monkeypatch):
-    calls = []
+    def fetch_cat_batch(self, remote, objs, jobs=1):
+        self.calls.append(('fetch', *objs))
+        return {obj: self.metas[obj] for obj in objs}
 
-    class Dummy:
-        def cmd(self, *a, **k):
-            calls.append(a)
-            return ''
+    def cmd(self, *a, **k):
+        self.calls.append(a)
+        return ''
 
-        def remote_already_has_ref(self, remote, ref):
-            return ref == 'b'
 
-    dummy = Dummy()
-    commit_info = SimpleNamespace(
-        bin_branch_name='b',
-        bin_ref_only_metadata='m'
-    )
-    grb.push_branch(dummy, 'remote', commit_info)
-    assert ('push', 'remote', 'm') in calls
-    assert ('push', 'remote', 'b') not in calls
+def commit_info(**kwargs):
+    return SimpleNamespace(bin_branch_name='b', bin_ref_only_metadata='refs/artifact/m', bin_ref_name_metadata='refs/artifact/n',
+                           bin_tag_name='tag', src_commits_ahead='0', bin_sha_commit='ours',
+                           src_time_commit='Wed, 21 Jun 2023 12:00:00 +0000', **kwargs)
 
 
-def test_push_tag_new(monkeypatch):
-    calls = []
+def test_push_branch_force(monkeypatch):
+    dummy = PushDummy({'refs/heads/b': 'old'})
+    grb.push_branch(dummy, 'remote', commit_info(), force=True)
+    assert dummy.calls == [('push', '--atomic', '--force-with-lease=refs/heads/b:old', '--force-with-lease=refs/artifact/m:',
+                            '--force-with-lease=refs/artifact/n:', 'remote', 'refs/heads/b:refs/heads/b', 'refs/artifact/m:refs/artifact/m', 'refs/artifact/n:refs/artifact/n')]
 
-    class Dummy:
-        def fetch_current_tag_value(self, r, t):
-            return None
 
-        def cmd(self, *a, **k):
-            calls.append(a)
-            return ''
+def test_push_branch_skip_existing(monkeypatch):
+    dummy = PushDummy({'refs/heads/b': 'old'})
+    grb.push_branch(dummy, 'remote', commit_info())
+    assert dummy.calls == [('push', '--atomic', '--force-with-lease=refs/artifact/m:', '--force-with-lease=refs/artifact/n:',
+                            'remote', 'refs/artifact/m:refs/artifact/m', 'refs/artifact/n:refs/artifact/n')]
 
-    dummy = Dummy()
-    commit_info = SimpleNamespace(
-        bin_tag_name='tag',
-        src_commits_ahead='',
-        bin_sha_commit='sha',
-        src_time_commit='Wed, 21 Jun 2023 12:00:00 +0000',
-    )
-    grb.push_tag(dummy, 'remote', commit_info)
-    assert ('push', 'remote', 'tag') in calls
+
+def test_push_tag_new(monkeypatch):
+    dummy = PushDummy()
+    grb.push_tag(dummy, 'remote', commit_info())
+    assert dummy.calls == [('push', '--atomic', '--force-with-lease=refs/tags/tag:', 'remote', 'refs/tags/tag:refs/tags/tag')]
 
 
 def test_push_tag_force_when_newer(monkeypatch):
-    calls = []
+    # Their meta-data is looked up by their artifact, not ours
+    dummy = PushDummy({'refs/tags/tag': 'theirs', 'refs/artifact/meta-for-commit/src/theirs': 'theirmeta',
+                       'refs/artifact/meta-for-commit/src/ours': 'ourmeta'},
+                      {'theirmeta': 'src-git-commit-time-commit: Wed, 21 Jun 2023 11:00:00 +0000'})
+    grb.push_tag(dummy, 'remote', commit_info(), force=False)
+    assert dummy.calls == [('fetch', 'theirmeta'),
+                           ('push', '--atomic', '--force-with-lease=refs/tags/tag:theirs', 'remote', 'refs/tags/tag:refs/tags/tag')]
+
+    # Not when theirs is newer
+    dummy.metas['theirmeta'] = 'src-git-commit-time-commit: Wed, 21 Jun 2023 13:00:00 +0000'
+    dummy.calls.clear()
+    grb.push_tag(dummy, 'remote', commit_info(), force=False)
+    assert dummy.calls == [('fetch', 'theirmeta')]
+
+
+def test_push_artifact_is_one_push(monkeypatch):
+    dummy = PushDummy()
+    grb.push_artifact(dummy, 'remote', commit_info(), tag=True)
+    assert len(dummy.calls) == 1
+    assert dummy.calls[0][-4:] == ('refs/heads/b:refs/heads/b', 'refs/artifact/m:refs/artifact/m', 'refs/artifact/n:refs/artifact/n', 'refs/tags/tag:refs/tags/tag')
+
+
+def test_push_refs_plans_again_only_when_lease_rejected():
+    class FailingDummy(PushDummy):
+        def cmd(self, *a, **k):
+            super().cmd(*a, **k)
+            raise RuntimeError(f"RbGit command failed with error: {self.error}")
 
-    class Dummy:
-        def fetch_current_tag_value(self, r, t):
-            return 'abc'
+    plan = lambda snapshot: [('refs/heads/b', 'refs/heads/b', '')]
+    dummy = FailingDummy()
+    dummy.error = " ! [rejected]        refs/heads/b -> refs/heads/b (stale info)\nerror: atomic push failed for ref refs/heads/b"
+    with pytest.raises(RuntimeError, match="stale info"):
+        push_refs(dummy, 'remote', plan)
+    assert len(dummy.calls) == PUSH_TRIES
 
-        def fetch_cat_pretty(self, r, ref):
-            return 'src-git-commit-time-commit: Wed, 21 Jun 2023 11:00:00 +0000'
+    dummy = FailingDummy()
+    dummy.error = "fatal: Could not read from remote repository."
+    with pytest.raises(RuntimeError, match="Could not read"):
+        push_refs(dummy, 'remote', plan)
+    assert len(dummy.calls) == 1
 
-        def cmd(self, *a, **k):
-            calls.append(a)
-            return ''
 
-    dummy = Dummy()
-    commit_info = SimpleNamespace(
-        bin_tag_name='tag',
-        src_commits_ahead='',
-        bin_sha_commit='ours',
-        bin_ref_only_metadata='unused',
-        src_time_commit='Wed, 21 Jun 2023 12:00:00 +0000',
-    )
-    grb.push_tag(dummy, 'remote', commit_info, force=False)
-    assert ('push', '--force', 'remote', 'tag') in calls
+def test_push_refs_tells_pushed_once(monkeypatch):
+    class RacingDummy(PushDummy):
+        def cmd(self, *a, **k):
+            super().cmd(*a, **k)
+            if len(self.calls) == 1:
+                raise RuntimeError("RbGit command failed with error: error: atomic push failed for ref refs/heads/b")
+
+    told = []
+    monkeypatch.setattr(push_mod, 'printer', SimpleNamespace(high_level=lambda msg, **k: told.append(msg), error=lambda *a, **k: None))
+    dummy = RacingDummy()
+    push_refs(dummy, 'remote', lambda snapshot: [('refs/heads/b', 'refs/heads/b', '')])
+    assert len(dummy.calls) == 2
+    assert told == ["Pushed to remote artifact-repo: refs/heads/b"]
+
+
+def test_push_artifact_races(temp_git_setup, tmp_path):
+    """ Against a real remote: Rejected as a whole when the tag moved since our snapshot, then planned again """
+    from git_recycle_bin.rbgit import create_rbgit
+    from managers import git_user_info
+
+    _, _, artifact_repo, _ = temp_git_setup
+    work = tmp_path / 'work'
+    work.mkdir()
+    rbgit = create_rbgit(src_tree_root=str(work), clean=True)
+    rbgit.add_remote_idempotent('bin', f'file://{artifact_repo}')
+    empty_tree = rbgit.cmd('mktree', input='').strip()
+    with git_user_info():
+        theirs, ours, newer = (rbgit.cmd('commit-tree', empty_tree, '-m', name).strip() for name in ('theirs', 'ours', 'newer'))
+    newer_meta = rbgit.cmd('hash-object', '-w', '--stdin', input='src-git-commit-time-commit: Wed, 21 Jun 2023 13:00:00 +0000\n').strip()
+    rbgit.cmd('push', 'bin', f'{theirs}:refs/tags/tag')
+    info = commit_info()
+    info.bin_sha_commit = ours
+    refs = ('refs/heads/b', 'refs/artifact/m', 'refs/artifact/n', 'refs/tags/tag')
+    for ref in refs:
+        rbgit.cmd('update-ref', ref, ours)
+
+    # Their tag has no meta-data, so ours would win. But another pusher tags a newer artifact before we push
+    snapshot = rbgit.ref_snapshot('bin')
+    rbgit.cmd('push', '--force', 'bin', f'{newer}:refs/tags/tag', f'{newer_meta}:refs/artifact/meta-for-commit/src/{newer}')
+    rbgit.ref_snapshots['bin'] = snapshot
+    grb.push_artifact(rbgit, 'bin', info, tag=True)
+
+    # Planned again, the tag stays at the newer artifact, and the rest is pushed
+    remote = {ref: sha for sha, ref in (line.split() for line in rbgit.cmd('ls-remote', 'bin').splitlines())}
+    assert [remote.get(ref) for ref in refs] == [ours, ours, ours, newer]
+
+    # Remotes without atomic pushes get the same push, without
+    subprocess.run(['git', 'config', 'receive.advertiseAtomic', 'false'], cwd=str(artifact_repo), check=True)
+    info.bin_branch_name = 'c'
+    rbgit.cmd('update-ref', 'refs/heads/c', ours)
+    grb.push_artifact(rbgit, 'bin', info, force_branch=True)
+    assert rbgit.ref_snapshot('bin').get('refs/heads/c') == ours
+    rbgit.cleanup()
+
+
+def test_previous_artifact():
+    prefix = 'refs/artifact/meta-for-name'
+    snapshot = RefSnapshot({
+        'refs/heads/x': 'a1', 'refs/heads/y': 'a2', 'refs/heads/z': 'a3',
+        f'{prefix}/other/{{obj}}/s2/a2': 'm2',
+        f'{prefix}/name/{{obj}}/s2/a3': 'm3',  # Same source commit, preferred by name
+        f'{prefix}/name/{{obj}}/s1/a1': 'm1',
+        f'{prefix}/name/{{doc}}/s3/a4': 'm4',  # Other tree-prefix
+        f'{prefix}/name/{{obj}}/s4/gone': 'm5',  # No branch or tag
+    })
+    info = commit_info(artifact_name='name', artifact_relpath_nca='obj')
+    info.bin_tag_name = None
+    assert grb.commands.push.previous_artifact(snapshot, info, ['s4', 's3', 's2', 's1']) == 'a3'
+    assert grb.commands.push.previous_artifact(snapshot, info, ['s1']) == 'a1'
+    assert grb.commands.push.previous_artifact(snapshot, info, ['s0']) is None
+
+    # The 'latest' tag goes first, unless the remote has our artifact already
+    info.bin_tag_name = 'tag'
+    snapshot.refs['refs/tags/tag'] = 'a2'
+    assert grb.commands.push.previous_artifact(snapshot, info, ['s1']) == 'a2'
+    info.bin_sha_commit = 'a1'
+    assert grb.commands.push.previous_artifact(snapshot, info, ['s1']) is None
+
+
+def test_push_against_delta_base(temp_git_setup, tmp_path, monkeypatch):
+    """ Against a real remote: Only files the previous artifact lacks are pushed """
+    import os
+    import git_recycle_bin.rbgit as rbgit_mod
+    from git_recycle_bin.rbgit import create_rbgit
+    from git_recycle_bin.telemetry import Telemetry
+    from managers import git_user_info
+
+    local, _, artifact_repo, _ = temp_git_setup
+    subprocess.run(['git', 'config', 'uploadpack.allowFilter', 'true'], cwd=str(artifact_repo), check=True)
+
+    def artifact(name, files):
+        work = tmp_path / name
+        (work / 'obj').mkdir(parents=True)
+        for file, content in files.items():
+            (work / 'obj' / file).write_bytes(content)
+        rbgit = create_rbgit(src_tree_root=str(work), clean=True)
+        rbgit.add_remote_idempotent('bin', f'file://{artifact_repo}')
+        with git_user_info():
+            commit = rbgit.cmd('commit-tree', rbgit.write_tree_of(str(work / 'obj')), '-m', name).strip()
+        return rbgit, commit
+
+    same, changed = os.urandom(200000), os.urandom(200000)
+    theirs, their_commit = artifact('theirs', {'same': same, 'changed': changed})
+    theirs.cmd('push', 'bin', f'{their_commit}:refs/tags/tag')
+    theirs.cleanup()
+
+    ours, our_commit = artifact('ours', {'same': same, 'changed': changed[:100000] + b'!' + changed[100001:], 'new': b'new\n'})
+    info = commit_info(artifact_name='name', artifact_relpath_nca='obj', src_tree_root=str(local))
+    info.bin_sha_commit = our_commit
+    assert grb.commands.push.fetch_delta_base(ours, 'bin', info) == their_commit
+    # No longer a partial clone, so no command fetches blobs it lacks from the remote
+    assert ours.cmd('config', '--default=', '--get', 'extensions.partialClone').strip() == ''
+    assert ours.cmd('config', '--get', 'core.repositoryformatversion').strip() == '0'
+
+    telemetry = Telemetry()
+    telemetry.enabled = True
+    monkeypatch.setattr(rbgit_mod, 'telemetry', telemetry)
+    ours.cmd('push', 'bin', f'{our_commit}:refs/heads/b', capture_output=False)
+    assert telemetry.commands['push']['objects'] == 5  # Commit, two trees, the new file and the changed one
+    assert 200000 < telemetry.commands['push']['bytes'] < 400000
+    assert 'packs: 1\n' in ours.cmd('count-objects', '-v')  # Their blobs were not fetched, as bases of deltas
+
+    # Remotes which can't fetch without blobs are not asked to
+    subprocess.run(['git', 'config', 'uploadpack.allowFilter', 'false'], cwd=str(artifact_repo), check=True)
+    info.bin_sha_commit = 'unpushed'
+    assert grb.commands.push.fetch_delta_base(ours, 'bin', info) is None
+    ours.cleanup()
 
 
 def test_remote_delete_expired_branches(monkeypatch):
@@ -100,11 +240,12 @@ def test_remote_delete_expired_branches(monkeypatch):
 
     class Dummy:
         def cmd(self, *a, **k):
-            if a[:3] == ('ls-remote', '--heads', 'remote'):
-                return '\n'.join(lines)
             calls.append(a)
             return ''
 
+        def ref_snapshot(self, remote):
+            return RefSnapshot.parse('\n'.join(lines))
+
     dummy = Dummy()
     grb.remote_delete_expired_branches(dummy, 'remote')
     assert ('push', 'remote', '--delete', 'refs/heads/artifact/expire/2000-01-01/00.00+0000/foo') in calls
@@ -118,21 +259,22 @@ def test_remote_flush_meta_for_commit(monkeypatch):
 
     class Dummy:
         def cmd(self, *a, **k):
-            if a[:4] == ('ls-remote', '--refs', 'remote', 'refs/artifact/meta-for-commit/*'):
-                return f'{sha1}\trefs/artifact/meta-for-commit/{sha1}\n{sha2}\trefs/artifact/meta-for-commit/{sha2}'
-            if a[:3] == ('ls-remote', '--heads', 'remote'):
-                return f'{sha2}\trefs/heads/main'
-            if a[:3] == ('ls-remote', '--tags', 'remote'):
-                return ''
             calls.append(a)
             return ''
 
+        def ref_snapshot(self, remote):
+            return RefSnapshot.parse(f'{sha2}\trefs/heads/main')
+
         def meta_for_commit_refs(self, remote):
             return [f'{sha1}\trefs/artifact/meta-for-commit/{sha1}']
 
+        def meta_for_name_refs(self, remote):
+            return [f'{sha1}\trefs/artifact/meta-for-name/n/{{p}}/{sha1}/{sha1}']
+
     dummy = Dummy()
     grb.remote_flush_meta_for_commit(dummy, 'remote')
-    assert ('push', 'remote', '--delete', 'refs/artifact/meta-for-commit/' + sha1) in calls
+    assert ('push', 'remote', '--delete', 'refs/artifact/meta-for-commit/' + sha1,
+            f'refs/artifact/meta-for-name/n/{{p}}/{sha1}/{sha1}') in calls
     assert all('refs/artifact/meta-for-commit/' + sha2 not in a for a in calls)
 
 
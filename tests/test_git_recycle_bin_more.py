@@ -15,24 +15,14 @@ def test_create_artifact_commit_sanitizes_name(tmp_path, monkeypatch):
     path.write_text('data')
 
     def fake_exec(cmd, **kwargs):
-        if cmd[:3] == ['git', 'rev-parse', 'HEAD']:
-            return 'sha'
-        if '--format=%B' in cmd:
-            return 'msg\n'
-        if '--format=%ad' in cmd or '--format=%cd' in cmd:
-            return 'Wed, 01 Jan 2020 00:00:00 +0000'
-        if cmd[:3] == ['git', 'rev-parse', '--abbrev-ref']:
-            return 'main'
+        if cmd[:2] == ['git', 'log']:
+            return 'sha\0Wed, 01 Jan 2020 00:00:00 +0000\0Wed, 01 Jan 2020 00:00:00 +0000\0msg\n'
         if cmd[:3] == ['git', 'config', '--get']:
             return 'https://example.com/repo.git'
         if cmd[:3] == ['git', 'rev-parse', '--show-toplevel']:
             return '/src/root'
         if cmd[:2] == ['git', 'status']:
-            return ''
-        if cmd and cmd[1] == 'for-each-ref':
-            return 'origin/main'
-        if cmd and cmd[0:2] == ['git', 'rev-list']:
-            return '0'
+            return '# branch.oid sha\n# branch.head main\n# branch.upstream origin/main\n# branch.ab +0 -0'
         return ''
 
     ns = grb.artifact_commit
@@ -56,6 +46,9 @@ def test_create_artifact_commit_sanitizes_name(tmp_path, monkeypatch):
         def add(self, p, force):
             self.calls.append(('add', p, force))
             return True
+        def write_tree_of(self, p, force, jobs):
+            self.calls.append(('write_tree_of', p, force))
+            return 'tree'
         def cmd(self, *a, input=None, capture_output=True):
             self.calls.append(('cmd', a))
             if a[:2] == ('rev-parse', 'HEAD'):
@@ -76,11 +69,13 @@ def test_create_artifact_commit_sanitizes_name(tmp_path, monkeypatch):
 def test_push_command(monkeypatch):
     calls = []
 
-    def fake_create(r, name, path, expire, add_ignored, src_remote, custom_trailers={}):
+    def fake_create(r, name, path, expire, add_ignored, src_remote, custom_trailers={}, hash_jobs=1):
         calls.append(('create', name, path, expire, add_ignored, src_remote, custom_trailers))
         return SimpleNamespace(
             bin_branch_name='b',
             bin_ref_only_metadata='m',
+            bin_sha_only_metadata='ms',
+            bin_commit_msg='msg',
             bin_tag_name='t',
             src_commits_ahead='',
             bin_sha_commit='sha',
@@ -89,9 +84,9 @@ def test_push_command(monkeypatch):
 
     ns = grb.commands.push
     monkeypatch.setattr(ns, 'create_artifact_commit', fake_create)
-    monkeypatch.setattr(ns, 'push_branch', lambda a, b, c, force: calls.append('push_branch'))
-    monkeypatch.setattr(ns, 'push_tag', lambda a, b, c, force: calls.append('push_tag'))
+    monkeypatch.setattr(ns, 'push_artifact', lambda a, b, c, force_branch, tag, force_tag: calls.append(('push_artifact', tag)))
     monkeypatch.setattr(ns, 'note_append_push', lambda a, b: calls.append('note'))
+    monkeypatch.setattr(ns, 'remote_index_add', lambda a, b, c: calls.append('index'))
     monkeypatch.setattr(ns, 'remote_delete_expired_branches', lambda c, d: calls.append('rm_expired'))
     monkeypatch.setattr(ns, 'remote_flush_meta_for_commit', lambda c, d: calls.append('flush_meta'))
     monkeypatch.setattr(ns, 'printer', SimpleNamespace(high_level=lambda *a, **k: None, detail=lambda *a, **k: None))
@@ -107,12 +102,101 @@ def test_push_command(monkeypatch):
             return ''
 
     args = SimpleNamespace(name='n', expire='e', add_ignored=False, src_remote_name='origin',
-                           push_tag=True, push_note=True, rm_expired=True, flush_meta=True,
-                           force_branch=False, force_tag=False,
+                           push_tag=True, push_note=True, index=True, rm_expired=True, flush_meta=True,
+                           force_branch=False, force_tag=False, chunk_size=0, hash_jobs=1, delta_base=False,
                            remote='r', trailers={})
 
     grb.push(DummyRb(), 'bin', '/p', args)
 
     assert ('add_remote', 'bin', 'r') in calls
-    for op in ['push_branch', 'push_tag', 'note']:
+    for op in [('push_artifact', True), 'index', 'note']:
         assert op in calls
+
+
+def test_parse_status_v2():
+    output = "\n".join([
+        "# branch.oid 0123abcd",
+        "# branch.head feature",
+        "# branch.upstream origin/feature",
+        "# branch.ab +2 -1",
+        "1 .M N... 100644 100644 100644 aaaa aaaa src/main.c",
+        "1 A. N... 000000 100644 100644 0000 bbbb new file.txt",
+        "2 R. N... 100644 100644 100644 cccc cccc R100 renamed.c\toriginal.c",
+        "u UU N... 100644 100644 100644 100644 dddd eeee ffff conflict.c",
+    ])
+    branch, changes, ahead, behind = grb.artifact_commit.parse_status_v2(output)
+    assert (branch, ahead, behind) == ("feature", "2", "1")
+    # As `git status --porcelain=1` has it
+    assert changes.splitlines() == [" M src/main.c", "A  new file.txt", "R  original.c -> renamed.c", "UU conflict.c"]
+
+    assert grb.artifact_commit.parse_status_v2("# branch.oid 0123abcd\n# branch.head (detached)") == ("HEAD", "", "?", "?")
+
+
+def test_src_snapshot(temp_git_setup):
+    import subprocess
+    local, _, _, _ = temp_git_setup
+    subprocess.run(['git', 'branch', '--set-upstream-to=origin/master'], cwd=local, check=True)
+    local.join("example.txt").write("changed")
+
+    src = grb.artifact_commit.src_snapshot('origin', cwd=str(local))
+    assert src.sha == subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=local, text=True).strip()
+    assert src.msg == "Initial commit"
+    assert src.tree_root == str(local)
+    assert src.repo_url.startswith("file://")
+    assert (src.branch, src.status, src.commits_ahead, src.commits_behind) == ("master", "M example.txt", "0", "0")
+
+
+@pytest.mark.parametrize("add_ignored", [False, True])
+@pytest.mark.parametrize("jobs", [1, 3])
+def test_commit_tree_matches_commit_via_index(tmp_path, add_ignored, jobs):
+    import os
+    import shutil
+    from git_recycle_bin.rbgit import create_rbgit
+    from managers import git_user_info
+
+    src = tmp_path / "src"
+    (src / "obj" / "deep" / "er").mkdir(parents=True)
+    (src / "obj" / "empty").mkdir()
+    (src / ".gitignore").write_text("*.o\n")
+    (src / "obj" / "a.txt").write_text("a\n")
+    (src / "obj" / "with space").write_text("s\n")
+    (src / "obj" / "deep" / "er" / "tool").write_text("#!/bin/sh\n")
+    (src / "obj" / "deep" / "er" / "tool").chmod(0o755)
+    (src / "obj" / "deep" / "x.o").write_text("ignored\n")
+    os.symlink("a.txt", src / "obj" / "link")
+    msg = "\n  title  \n\n\nbody\n\n"
+    dates = ("Wed, 01 Jan 2020 00:00:00 +0000", "Thu, 02 Jan 2020 00:00:00 +0000")
+
+    shas = []
+    for build in ("plumbing", "index"):
+        work = tmp_path / build
+        shutil.copytree(src, work, symlinks=True)
+        rbgit = create_rbgit(src_tree_root=str(work), clean=True)
+        binpath = str(work / "obj")
+        with git_user_info():
+            if build == "plumbing":
+                tree = rbgit.write_tree_of(binpath, force=add_ignored, jobs=jobs)
+                sha = grb.artifact_commit.commit_tree(rbgit, tree, "artifact", msg, *dates)
+                assert not os.path.exists(os.path.join(rbgit.rbgit_dir, "index"))
+                # Again is idempotent
+                assert grb.artifact_commit.commit_tree(rbgit, tree, "artifact", msg, *dates) == sha
+            else:
+                sha = grb.artifact_commit.commit_via_index(rbgit, binpath, "artifact", msg, add_ignored, *dates)
+        assert rbgit.cmd("rev-parse", "HEAD").strip() == sha
+        shas.append(sha)
+        rbgit.cleanup()
+    assert shas[0] == shas[1]
+
+
+def test_write_tree_of_defers_to_index(tmp_path):
+    import subprocess
+    from git_recycle_bin.rbgit import create_rbgit
+
+    (tmp_path / "obj" / "empty").mkdir(parents=True)
+    rbgit = create_rbgit(src_tree_root=str(tmp_path), clean=True)
+    assert rbgit.write_tree_of(str(tmp_path / "obj")) is None  # `add` tells there is nothing to commit
+
+    subprocess.run(["git", "init", "-q", str(tmp_path / "obj" / "repo")], check=True)
+    (tmp_path / "obj" / "repo" / "file").write_text("f\n")
+    assert rbgit.write_tree_of(str(tmp_path / "obj")) is None  # Only an index records embedded repos
+    rbgit.cleanup()
@@ -1,7 +1,12 @@
+import json
+import shutil
+import pytest
 from types import SimpleNamespace
 from copy import deepcopy
 import git_recycle_bin.commands.list as list_mod
-from git_recycle_bin.query import NameQuery, RelPathQuery
+from git_recycle_bin.rbgit import RefSnapshot
+from git_recycle_bin.query import NameQuery, RelPathQuery, JqQuery
+from git_recycle_bin.arg_parser import parse_args
 
 ### SETUP
 list_results = [
@@ -55,36 +60,239 @@ def test_remote_artifacts(monkeypatch):
     # patch util.exec to return known sha
     monkeypatch.setattr(list_mod, 'exec', lambda cmd: 'abcd')
 
-    def fake_cmd(*args, **kwargs):
-        if args[:3] == ('ls-remote', '--refs', 'remote'):
-            return as_ls_remote(list_results, args[3])
-        raise AssertionError('unexpected')
+    snapshot = RefSnapshot.parse(as_ls_remote(list_results, 'refs/artifact/meta-for-commit/'))
 
     msgs = as_messages(list_results)
 
-    def fake_fetch(remote, ref):
-        return msgs[ref]
+    fetches = []
+    def fake_fetch_batch(remote, refs, jobs=1):
+        fetches.append(refs)
+        return {ref: msgs[ref] for ref in refs}
 
-    dummy = SimpleNamespace(cmd=fake_cmd, fetch_cat_pretty=fake_fetch)
-    res = list_mod.remote_artifacts_unfiltered(dummy, 'remote')
+    dummy = SimpleNamespace(ref_snapshot=lambda remote: snapshot, fetch_cat_batch=fake_fetch_batch)
+    res = list(list_mod.remote_artifacts_unfiltered(dummy, 'remote'))
     assert res == list_results[:2]  # only first two have sha 'abcd'
 
-    res = list_mod.remote_artifacts_unfiltered(dummy, 'remote', sha='abcd')
+    res = list(list_mod.remote_artifacts_unfiltered(dummy, 'remote', sha='abcd'))
     assert res == list_results[:2]  # only first two have sha 'abcd'
 
-    res = list_mod.remote_artifacts_unfiltered(dummy, 'remote', all_shas=True)
+    fetches.clear()
+    res = list(list_mod.remote_artifacts_unfiltered(dummy, 'remote', all_shas=True))
     assert res == map_src_sha(list_results)
 
+    # Without a limit all meta-data is needed, so retrieved by one batched fetch
+    assert fetches == [['m1', 'm2', 'm3']]
+
+    # With one, by batched fetches of doubling size
+    fetches.clear()
+    list(list_mod.remote_artifacts_unfiltered(dummy, 'remote', all_shas=True, chunk=1))
+    assert fetches == [['m1'], ['m2', 'm3']]
+
 
 
 
 def test_filter_artifacts_by_name_and_path(monkeypatch):
-    filtered = list_mod.filter_artifacts(list_results, NameQuery('foo'))
+    filtered = list(list_mod.filter_artifacts(list_results, NameQuery('foo')))
     assert filtered == [list_results[0]]
 
     and_query = list_mod.AndQuery(NameQuery('foo'), RelPathQuery('path1'))
-    filtered = list_mod.filter_artifacts(list_results, and_query)
+    filtered = list(list_mod.filter_artifacts(list_results, and_query))
     assert filtered == [list_results[0]]
 
-    filtered = list_mod.filter_artifacts(list_results, RelPathQuery('path2'))
+    filtered = list(list_mod.filter_artifacts(list_results, RelPathQuery('path2')))
     assert filtered == [list_results[1]]
+
+
+def test_filter_artifacts_by_parsed_and_query():
+    args = parse_args(['list', 'remote', '--name', 'bar', '--relpath', 'path2'])
+    assert list(list_mod.filter_artifacts(list_results, args.query)) == [list_results[1]]
+
+
+@pytest.mark.skipif(shutil.which('jq') is None, reason="jq not installed")
+def test_filter_artifacts_by_jq():
+    query = JqQuery('.["artifact-name"] | startswith("ba")')
+    assert list(list_mod.filter_artifacts(list_results, query)) == list_results[1:]
+
+    and_query = list_mod.AndQuery(query, NameQuery('baz'))
+    assert list(list_mod.filter_artifacts(list_results, and_query)) == [list_results[2]]
+
+
+def test_print_artifacts_jq_errors(capsys, monkeypatch, tmp_path):
+    errors = []
+    monkeypatch.setattr(list_mod, 'printer', SimpleNamespace(error=lambda msg, **k: errors.append(msg)))
+    if shutil.which('jq'):
+        # An invalid query fails on the first artifact
+        assert list_mod.print_artifacts(list_mod.filter_artifacts(list_results, JqQuery('.['))) == 1
+        assert capsys.readouterr().out == ''
+
+    monkeypatch.setenv('PATH', str(tmp_path))
+    assert list_mod.print_artifacts(list_mod.filter_artifacts(list_results, JqQuery('.'))) == 1
+    assert errors and errors[-1].startswith('Error: Could not run jq')
+
+
+def test_remote_artifacts_prefilter_by_meta_for_name_refs():
+    src = 'abcd'
+    lines = [
+        f"m1 refs/artifact/meta-for-commit/{src}/sha1",
+        f"m2 refs/artifact/meta-for-commit/{src}/sha2",
+        f"m3 refs/artifact/meta-for-commit/{src}/sha3",
+        f"m1 refs/artifact/meta-for-name/foo/{{path1}}/{src}/sha1",
+        f"m2 refs/artifact/meta-for-name/bar/{{path2}}/{src}/sha2",
+        # sha3 was pushed without meta-for-name ref, so it can't be skipped
+    ]
+    snapshot = RefSnapshot.parse('\n'.join(lines))
+
+    msgs = as_messages(list_results)
+    fetches = []
+    def fake_fetch_batch(remote, refs, jobs=1):
+        fetches.append(refs)
+        return {ref: msgs[ref] for ref in refs}
+
+    dummy = SimpleNamespace(ref_snapshot=lambda remote: snapshot, fetch_cat_batch=fake_fetch_batch,
+                            fetch_refs=lambda remote, prefix: fetched.append(prefix) or prefix_snapshot(snapshot, prefix),
+                            cat_file_batch=lambda objs: {obj: msgs[obj] for obj in objs})
+    fetched = []
+    res = list(list_mod.remote_artifacts(dummy, 'remote', list_mod.AndQuery(NameQuery('foo'), RelPathQuery('path1')), sha=src))
+    assert res == [list_results[0]]
+    # Refs of the name were fetched with their meta-data. Only sha3, without meta-for-name ref, needs fetching
+    assert fetched == ['refs/artifact/meta-for-name/foo/']
+    assert fetches == [['m3']]
+
+    # Remotes without meta-for-name refs of the name may have it from older versions
+    fetches.clear()
+    res = list(list_mod.remote_artifacts(dummy, 'remote', NameQuery('baz'), sha=src))
+    assert res == [list_results[2]]
+    assert fetches == [['m3']]
+
+    # No name or path in query: meta-for-name refs can't help
+    fetches.clear()
+    list(list_mod.remote_artifacts(dummy, 'remote', RelPathQuery('path1'), sha=src))
+    assert fetches == [['m1', 'm2', 'm3']]
+
+
+def test_remote_artifacts_by_name_on_mixed_remote():
+    """ Artifacts of a name pushed by older versions, without meta-for-name ref, are listed too """
+    src = 'abcd'
+    snapshot = RefSnapshot.parse('\n'.join([
+        f"m1 refs/artifact/meta-for-commit/{src}/sha1",
+        f"m3 refs/artifact/meta-for-commit/{src}/sha3",
+        f"m1 refs/artifact/meta-for-name/foo/{{path1}}/{src}/sha1",
+    ]))
+    legacy = list_mod.ListResult(meta_sha='m3', artifact_sha='sha3', meta_data={'artifact-name': 'foo', 'src-git-relpath': 'path3'})
+    msgs = as_messages([list_results[0], legacy])
+    dummy = SimpleNamespace(ref_snapshot=lambda remote: snapshot,
+                            fetch_cat_batch=lambda remote, refs, jobs=1: {ref: msgs[ref] for ref in refs},
+                            fetch_refs=lambda remote, prefix: prefix_snapshot(snapshot, prefix),
+                            cat_file_batch=lambda objs: {obj: msgs[obj] for obj in objs})
+    res = list(list_mod.remote_artifacts(dummy, 'remote', NameQuery('foo'), sha=src))
+    assert res == [list_results[0], legacy]
+
+
+def prefix_snapshot(snapshot, prefix):
+    return RefSnapshot({ref: sha for sha, ref in snapshot.prefix(prefix)})
+
+
+def test_name_prefilter():
+    excluded = list_mod.name_prefilter(NameQuery('foo bar'))
+    assert not excluded('foo_bar', '{x}')
+    assert excluded('foo', '{x}')
+
+    excluded = list_mod.name_prefilter(list_mod.AndQuery(RelPathQuery('r'), list_mod.PathQuery('obj/doc')))
+    assert not excluded('any', '{obj_doc}')
+    assert excluded('any', '{obj}')
+
+    assert list_mod.name_prefilter(RelPathQuery('r')) is None
+
+
+def test_remote_artifacts_limit_stops_fetching():
+    src = 'abcd'
+    lines = [f"m{i} refs/artifact/meta-for-commit/{src}/sha{i}" for i in range(1, 4)]
+    snapshot = RefSnapshot.parse('\n'.join(lines))
+
+    msgs = as_messages(list_results)
+    fetches = []
+    def fake_fetch_batch(remote, refs, jobs=1):
+        fetches.append(refs)
+        return {ref: msgs[ref] for ref in refs}
+
+    dummy = SimpleNamespace(ref_snapshot=lambda remote: snapshot, fetch_cat_batch=fake_fetch_batch,
+                            fetch_refs=lambda remote, prefix: prefix_snapshot(snapshot, prefix))
+    res = list(list_mod.remote_artifacts(dummy, 'remote', None, sha=src, limit=1))
+    assert res == [list_results[0]]
+    assert fetches == [['m1']]
+
+    # Non-matching artifacts make the next, doubled, batch necessary
+    fetches.clear()
+    res = list(list_mod.remote_artifacts(dummy, 'remote', NameQuery('bar'), sha=src, limit=1))
+    assert res == [list_results[1]]
+    assert fetches == [['m1'], ['m2', 'm3']]
+
+
+def test_format_artifact():
+    assert list_mod.format_artifact(list_results[0]) == 'sha1'
+    assert json.loads(list_mod.format_artifact(list_results[0], 'jsonl')) == {
+        'meta_sha': 'm1',
+        'artifact_sha': 'sha1',
+        'meta_data': {'artifact-name': 'foo', 'src-git-relpath': 'path1'},
+    }
+    args = parse_args(['list', 'remote', '--limit', '1', '--format', 'jsonl'])
+    assert (args.limit, args.format) == (1, 'jsonl')
+
+
+@pytest.mark.parametrize('option', ['--limit', '--latest'])
+def test_limit_must_be_positive(option):
+    with pytest.raises(SystemExit):
+        parse_args(['list', 'remote', option, '-1'])
+    with pytest.raises(SystemExit):
+        parse_args(['list', 'remote', option, '0'])
+
+
+def sort_dummy(lines, fetches):
+    msgs = {
+        f'm{i}': f'artifact-name: a{i}\nsrc-git-commit-time-commit: Thu, 0{i} Jan 2024 00:00:00 +0000'
+        for i in range(1, 4)
+    }
+    def fake_fetch_batch(remote, refs, jobs=1):
+        fetches.append(refs)
+        return {ref: msgs[ref] for ref in refs}
+    snapshot = RefSnapshot.parse('\n'.join(lines))
+    return SimpleNamespace(ref_snapshot=lambda remote: snapshot, fetch_cat_batch=fake_fetch_batch)
+
+
+def test_remote_artifacts_latest_by_expiry():
+    src = 'abcd'
+    lines = [f"m{i} refs/artifact/meta-for-commit/{src}/sha{i}" for i in range(1, 4)] + [
+        "sha1 refs/heads/artifact/expire/2030-01-01/00.00+0000/r@abcd/{p}",
+        "sha2 refs/heads/artifact/expire/2031-01-01/00.00+0000/r@abcd/{p}",
+        # sha3 has expired and its branch is deleted
+    ]
+    fetches = []
+    dummy = sort_dummy(lines, fetches)
+
+    res = list(list_mod.remote_artifacts(dummy, 'remote', None, sha=src, limit=1, sort='expiry'))
+    assert [r.artifact_sha for r in res] == ['sha2']
+    assert fetches == [['m2']]  # Expiry is known from branch names, so others' meta-data isn't needed
+
+    res = list(list_mod.remote_artifacts(dummy, 'remote', None, sha=src, sort='expiry'))
+    assert [r.artifact_sha for r in res] == ['sha2', 'sha1', 'sha3']
+
+
+def test_remote_artifacts_latest_by_src_commit_time(monkeypatch):
+    src = 'abcd'
+    lines = [f"m{i} refs/artifact/meta-for-commit/{src}{i}/sha{i}" for i in range(1, 4)]
+    # Local source repo has the source commits of sha1 and sha3, with times unlike their meta-data
+    monkeypatch.setattr(list_mod, 'src_commit_times', lambda shas: {'abcd1': 5e9, 'abcd3': 1.0})
+    fetches = []
+    dummy = sort_dummy(lines, fetches)
+
+    res = list(list_mod.remote_artifacts(dummy, 'remote', None, all_shas=True, limit=2, sort='src-commit-time'))
+    assert [r.artifact_sha for r in res] == ['abcd1/sha1', 'abcd2/sha2']
+    assert fetches == [['m2'], ['m1']]  # m2 to learn its time, m1 as it made the top 2; m3 never
+
+
+def test_parse_latest():
+    args = parse_args(['list', 'remote', '--latest', '3'])
+    assert (args.sort, args.limit) == ('src-commit-time', 3)
+    args = parse_args(['list', 'remote', '--latest', '3', '--sort', 'expiry', '--limit', '2'])
+    assert (args.sort, args.limit) == ('expiry', 2)
+    assert parse_args(['list', 'remote']).sort is None
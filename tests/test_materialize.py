@@ -0,0 +1,245 @@
+import os
+import subprocess
+import threading
+
+import pytest
+
+import git_recycle_bin.materialize as materialize_mod
+from git_recycle_bin.materialize import BlobCache, StatCache, TreeEntry, Writer, materialize
+from git_recycle_bin.rbgit import create_rbgit
+from managers import git_user_info
+
+
+@pytest.fixture
+def artifact(tmp_path):
+    """ A bin repo with one artifact commit below out/, and an empty work tree to write it into """
+    src = tmp_path / 'src'
+    (src / 'out' / 'bin').mkdir(parents=True)
+    (src / 'out' / 'readme.txt').write_text('hello\n')
+    (src / 'out' / 'bin' / 'tool').write_text('#!/bin/sh\n')
+    (src / 'out' / 'bin' / 'tool').chmod(0o755)
+    (src / 'out' / 'big.dat').write_bytes(os.urandom(3000))
+    os.symlink('bin/tool', src / 'out' / 'link')
+    subprocess.run(['git', 'init', '-q'], cwd=src, check=True)
+    subprocess.run(['git', 'add', '.'], cwd=src, check=True)
+    with git_user_info():
+        subprocess.run(['git', 'commit', '-q', '-m', 'artifact'], cwd=src, check=True)
+    sha = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=src, text=True).strip()
+
+    work = tmp_path / 'work'
+    work.mkdir()
+    rbgit = create_rbgit(src_tree_root=str(work), clean=True)
+    rbgit.add_alternate(str(src / '.git' / 'objects'))
+    yield rbgit, sha, src, work
+    rbgit.cleanup()
+
+
+def test_materialize_writes_tree(artifact, monkeypatch):
+    rbgit, sha, src, work = artifact
+    monkeypatch.setattr(materialize_mod, 'SMALL_BLOB', 1000)  # Stream big.dat in chunks
+    monkeypatch.setattr(materialize_mod, 'CHUNK', 512)
+
+    assert materialize(rbgit, sha, 'out', workers=2) == 4
+    for name in ['readme.txt', 'bin/tool', 'big.dat']:
+        assert (work / 'out' / name).read_bytes() == (src / 'out' / name).read_bytes()
+    assert os.access(work / 'out' / 'bin' / 'tool', os.X_OK)
+    assert not os.access(work / 'out' / 'readme.txt', os.X_OK)
+    assert os.readlink(work / 'out' / 'link') == 'bin/tool'
+    assert sorted(os.listdir(work / 'out')) == ['big.dat', 'bin', 'link', 'readme.txt']  # No temporary files left
+
+    # Neither index nor HEAD involved
+    assert not os.path.exists(os.path.join(rbgit.rbgit_dir, 'index'))
+    with pytest.raises(RuntimeError):
+        rbgit.cmd('rev-parse', '--verify', 'HEAD')
+
+
+def test_materialize_from_subdirectory(artifact, monkeypatch):
+    rbgit, sha, _, work = artifact
+    (work / 'elsewhere').mkdir()
+    monkeypatch.chdir(work / 'elsewhere')  # Must not limit what is written, as git commands would by default
+    assert materialize(rbgit, sha, 'out') == 4
+    with pytest.raises(RuntimeError, match='no files'):
+        materialize(rbgit, sha, 'nothing')
+
+
+def test_materialize_selected_paths_and_overwrite(artifact):
+    rbgit, sha, _, work = artifact
+    (work / 'out').mkdir()
+    (work / 'out' / 'readme.txt').write_text('stale\n')
+
+    assert materialize(rbgit, sha, 'out', paths=['out/readme.txt']) == 1
+    assert os.listdir(work / 'out') == ['readme.txt']
+    assert (work / 'out' / 'readme.txt').read_text() == 'hello\n'
+
+
+def test_materialize_conflicts_need_force(artifact):
+    rbgit, sha, _, work = artifact
+    (work / 'out').mkdir()
+    (work / 'out' / 'bin').write_text('a file where a directory goes')
+    (work / 'out' / 'readme.txt').mkdir()
+
+    with pytest.raises(RuntimeError, match='--force'):
+        materialize(rbgit, sha, 'out', workers=1)
+    materialize(rbgit, sha, 'out', force=True)
+    assert (work / 'out' / 'bin' / 'tool').exists()
+    assert (work / 'out' / 'readme.txt').read_text() == 'hello\n'
+
+
+def test_writer_never_follows_symlinks(tmp_path):
+    outside = tmp_path / 'outside'
+    outside.mkdir()
+    work = tmp_path / 'work'
+    work.mkdir()
+    os.symlink(outside, work / 'dir')
+    entry = materialize_mod.TreeEntry('100644', 'x', 'dir/file')
+
+    with pytest.raises(RuntimeError, match='in the way'):
+        Writer(str(work), force=False).write(entry, [b'data'])
+    Writer(str(work), force=True).write(entry, [b'data'])
+    assert (work / 'dir' / 'file').read_bytes() == b'data'
+    assert os.listdir(outside) == []
+
+
+@pytest.mark.parametrize('path', ['../escape', 'a/../../escape', '/abs', 'a/.git/config', 'a//b'])
+def test_writer_refuses_unsafe_paths(tmp_path, path):
+    with pytest.raises(RuntimeError, match='unsafe'):
+        Writer(str(tmp_path), force=True).dest(path)
+
+
+def test_incremental_writes_only_changed(artifact, tmp_path):
+    rbgit, sha, src, work = artifact
+    cache = StatCache(str(tmp_path / 'cache'))
+
+    assert materialize(rbgit, sha, 'out', stat_cache=cache) == 4
+    assert materialize(rbgit, sha, 'out', stat_cache=cache) == 0  # All up to date
+
+    # Local edits, of content or mode, are noticed and undone. Untouched files are not rewritten
+    inode = os.stat(work / 'out' / 'big.dat').st_ino
+    (work / 'out' / 'readme.txt').write_text('edited\n')
+    (work / 'out' / 'bin' / 'tool').chmod(0o644)
+    assert materialize(rbgit, sha, 'out', stat_cache=cache) == 2
+    assert (work / 'out' / 'readme.txt').read_text() == 'hello\n'
+    assert os.access(work / 'out' / 'bin' / 'tool', os.X_OK)
+    assert os.stat(work / 'out' / 'big.dat').st_ino == inode
+
+    # Without a record, e.g. a fresh cache, files on disk are hashed instead of rewritten
+    assert materialize(rbgit, sha, 'out', stat_cache=StatCache(str(tmp_path / 'other'))) == 0
+
+
+def test_incremental_prune(artifact, tmp_path):
+    rbgit, sha, src, work = artifact
+    cache = StatCache(str(tmp_path / 'cache'))
+    materialize(rbgit, sha, 'out', stat_cache=cache)
+    (work / 'out' / 'theirs.txt').write_text('not ours\n')
+
+    # Next version of the artifact lacks bin/ and readme.txt
+    subprocess.run(['git', 'rm', '-q', '-r', 'out/bin', 'out/readme.txt'], cwd=src, check=True)
+    with git_user_info():
+        subprocess.run(['git', 'commit', '-q', '-m', 'next'], cwd=src, check=True)
+    next_sha = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=src, text=True).strip()
+    (work / 'out' / 'readme.txt').write_text('edited, so kept\n')
+
+    materialize(rbgit, next_sha, 'out', stat_cache=cache, prune=True)
+    assert sorted(os.listdir(work / 'out')) == ['big.dat', 'link', 'readme.txt', 'theirs.txt']
+
+
+def test_incremental_prune_with_include(artifact, tmp_path):
+    rbgit, sha, src, work = artifact
+    cache = StatCache(str(tmp_path / 'cache'))
+    materialize(rbgit, sha, 'out', stat_cache=cache)
+
+    # Next version lacks readme.txt, and only big.dat is included
+    subprocess.run(['git', 'rm', '-q', 'out/readme.txt'], cwd=src, check=True)
+    (src / 'out' / 'big.dat').write_bytes(os.urandom(3000))
+    subprocess.run(['git', 'add', 'out/big.dat'], cwd=src, check=True)
+    with git_user_info():
+        subprocess.run(['git', 'commit', '-q', '-m', 'next'], cwd=src, check=True)
+    next_sha = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=src, text=True).strip()
+
+    assert materialize(rbgit, next_sha, 'out', paths=['out/big.dat'], stat_cache=cache, prune=True) == 1
+    # Files the artifact still has are kept, though not included
+    assert sorted(os.listdir(work / 'out')) == ['big.dat', 'bin', 'link']
+    assert (work / 'out' / 'big.dat').read_bytes() == (src / 'out' / 'big.dat').read_bytes()
+
+    # And still recorded, so not hashed again, nor is the file just written
+    hashed = []
+    file_blob_sha = materialize_mod.file_blob_sha
+    materialize_mod.file_blob_sha = lambda path: hashed.append(path) or file_blob_sha(path)
+    try:
+        assert materialize(rbgit, next_sha, 'out', stat_cache=cache) == 0
+    finally:
+        materialize_mod.file_blob_sha = file_blob_sha
+    assert hashed == []
+
+
+def test_blob_cache_hardlinks_between_workspaces(artifact, tmp_path):
+    rbgit, sha, src, work = artifact
+    cache = BlobCache(str(tmp_path / 'cache'), max_bytes=1 << 30, link='hardlink')
+    materialize(rbgit, sha, 'out', blob_cache=cache)
+
+    # Another workspace gets the same files without reading any blob
+    other = tmp_path / 'other'
+    (other / '.rbgit').mkdir(parents=True)
+    rbgit_other = type(rbgit)(rbgit.printer, rbgit_dir=str(other / '.rbgit'), rbgit_work_tree=str(other))
+    rbgit_other.add_alternate(str(src / '.git' / 'objects'))
+    materialize_calls = []
+    original = materialize_mod.write_blobs
+    materialize_mod.write_blobs = lambda rbgit, writer, entries, workers: materialize_calls.append(entries)
+    try:
+        materialize(rbgit_other, sha, 'out', blob_cache=cache)
+    finally:
+        materialize_mod.write_blobs = original
+    assert [e.path for e in materialize_calls[0]] == ['out/link']  # Symlinks are not cached
+
+    for name in ['readme.txt', 'bin/tool', 'big.dat']:
+        assert os.stat(work / 'out' / name).st_ino == os.stat(other / 'out' / name).st_ino
+        assert not os.access(work / 'out' / name, os.W_OK) or os.geteuid() == 0  # Read-only, root can write anyway
+    assert os.access(other / 'out' / 'bin' / 'tool', os.X_OK)
+    assert (other / 'out' / 'readme.txt').read_text() == 'hello\n'
+
+
+def test_blob_cache_executable_variant_and_copy_fallback(tmp_path):
+    cache = BlobCache(str(tmp_path / 'cache'), max_bytes=1 << 30, link='reflink')
+    plain = TreeEntry('100644', 'ab' * 20, 'a')
+    cache.add(plain, [b'data'])
+    assert cache.has(plain.sha)
+
+    # Executable variant is made from the plain one
+    executable = TreeEntry('100755', plain.sha, 'b')
+    cached = cache.get(executable)
+    assert cached.endswith('.x') and os.access(cached, os.X_OK)
+
+    # Where reflinks are not supported, e.g. tmpfs, files are copied instead
+    (tmp_path / 'work').mkdir()
+    writer = Writer(str(tmp_path / 'work'), force=False, blob_cache=cache)
+    writer.write_cached(executable, cached)
+    dest = tmp_path / 'work' / 'b'
+    assert dest.read_bytes() == b'data' and os.access(dest, os.X_OK | os.W_OK)
+    assert os.stat(dest).st_ino != os.stat(cached).st_ino
+
+
+def test_blob_cache_evicts_oldest_unlinked(tmp_path):
+    cache = BlobCache(str(tmp_path / 'cache'), max_bytes=10)
+    entries = [TreeEntry('100644', f'{i:02x}' * 20, f'f{i}') for i in range(3)]
+    paths = [cache.add(entry, [b'x' * 8]) for entry in entries]
+    for i, path in enumerate(paths):
+        os.utime(path, (i, i))
+    os.link(paths[0], tmp_path / 'workspace-file')  # Oldest is still in use
+
+    cache.evict()
+    assert [cache.has(entry.sha) for entry in entries] == [True, False, True]
+
+
+def test_blob_cache_evicts_only_once_unlocked(tmp_path):
+    cache = BlobCache(str(tmp_path / 'cache'), max_bytes=0)
+    entry = TreeEntry('100644', 'ab' * 20, 'f')
+    cache.add(entry, [b'x'])
+
+    with cache.lock():  # Held by a download, from finding the blob cached until placing it
+        evictor = threading.Thread(target=cache.evict)
+        evictor.start()
+        evictor.join(0.2)
+        assert evictor.is_alive()
+        assert cache.get(entry)
+    evictor.join()
+    assert not cache.has(entry.sha)
@@ -0,0 +1,79 @@
+import os
+import time
+
+from git_recycle_bin.meta_cache import MetaCache, fetch_metas, default_cache_dir
+
+sha1 = 'a' * 40
+sha2 = 'b' * 40
+sha3 = 'c' * 40
+
+
+def test_default_cache_dir(monkeypatch):
+    monkeypatch.setenv('XDG_CACHE_HOME', '/xdg')
+    assert default_cache_dir() == '/xdg/git-recycle-bin'
+
+
+def test_put_get(tmp_path):
+    cache = MetaCache(str(tmp_path))
+    assert cache.get(sha1) is None
+    cache.put(sha1, {'content': 'x: y', 'meta_data': {'x': 'y'}})
+    assert cache.get(sha1) == {'content': 'x: y', 'meta_data': {'x': 'y'}}
+
+
+def test_only_full_shas_are_cached(tmp_path):
+    cache = MetaCache(str(tmp_path))
+    cache.put('refs/heads/main', {'content': '', 'meta_data': {}})
+    cache.put('abcd', {'content': '', 'meta_data': {}})
+    assert cache.get('refs/heads/main') is None
+    assert cache.get('abcd') is None
+    assert not os.path.exists(cache.cache_dir)
+
+
+def test_evict_least_recently_used(tmp_path):
+    cache = MetaCache(str(tmp_path), max_entries=2)
+    for i, sha in enumerate([sha1, sha2, sha3]):
+        cache.put(sha, {'content': sha, 'meta_data': {}})
+        past = time.time() - 100 + i
+        os.utime(cache._path(sha), (past, past))
+    cache.get(sha1)  # sha1 is now the most recently used
+    cache.evict()
+    assert cache.get(sha1) is not None
+    assert cache.get(sha2) is None
+    assert cache.get(sha3) is not None
+
+
+def test_evict_walks_only_when_count_exceeds_bound(tmp_path, monkeypatch):
+    import git_recycle_bin.meta_cache as meta_cache_mod
+    walks = []
+    evict_lru = meta_cache_mod.evict_lru
+    monkeypatch.setattr(meta_cache_mod, 'evict_lru', lambda d, m: walks.append(d) or evict_lru(d, m))
+
+    cache = MetaCache(str(tmp_path), max_entries=2)
+    cache.put(sha1, {'content': sha1, 'meta_data': {}})
+    cache.evict(added=1)  # Not counted yet, so walked
+    assert len(walks) == 1
+    cache.put(sha2, {'content': sha2, 'meta_data': {}})
+    cache.evict(added=1)
+    assert len(walks) == 1
+    cache.put(sha3, {'content': sha3, 'meta_data': {}})
+    cache.evict(added=1)
+    assert len(walks) == 2
+    assert sum(cache.get(sha) is not None for sha in (sha1, sha2, sha3)) == 2
+
+
+def test_fetch_metas_only_fetches_uncached(tmp_path):
+    fetched = []
+
+    class Dummy:
+        def fetch_cat_batch(self, remote, objs, jobs=1):
+            fetched.append(objs)
+            return {obj: f'artifact-name: {obj[:1]}' for obj in objs}
+
+    cache = MetaCache(str(tmp_path))
+    res = fetch_metas(Dummy(), 'remote', [sha1, sha2], cache)
+    assert res[sha1]['meta_data'] == {'artifact-name': 'a'}
+    assert fetched == [[sha1, sha2]]
+
+    res = fetch_metas(Dummy(), 'remote', [sha1, sha2, sha3], cache)
+    assert res[sha3] == {'content': 'artifact-name: c', 'meta_data': {'artifact-name': 'c'}}
+    assert fetched[-1] == [sha3]
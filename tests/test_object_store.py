@@ -0,0 +1,55 @@
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+from git_recycle_bin.rbgit import create_rbgit
+from git_recycle_bin.object_store import ObjectStore
+from managers import git_user_info
+
+
+def commit_in(repo) -> str:
+    with git_user_info():
+        subprocess.run(['git', 'commit', '--allow-empty', '-m', 'artifact'], cwd=repo, check=True)
+    return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=repo, text=True).strip()
+
+
+def test_fetch_only_missing(temp_git_setup, tmp_path):
+    local, remote, _, _ = temp_git_setup
+    sha = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=local, text=True).strip()
+    store = ObjectStore(str(tmp_path), str(remote))
+
+    assert store.missing([sha]) == [sha]
+    assert store.fetch([sha]) == [sha]
+    assert store.missing([sha]) == []
+    assert store.fetch([sha]) == []  # Nothing fetched the second time
+
+    # Same store, whatever the spelling of a local remote
+    assert ObjectStore(str(tmp_path), str(remote) + '/').path == store.path
+
+
+def test_link_shares_objects(temp_git_setup, tmp_path):
+    local, remote, _, _ = temp_git_setup
+    sha = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=local, text=True).strip()
+    store = ObjectStore(str(tmp_path), str(remote))
+    store.fetch([sha])
+
+    work = tmp_path / 'work'
+    work.mkdir()
+    rbgit = create_rbgit(src_tree_root=str(work), clean=True)
+    store.link(rbgit)
+    store.link(rbgit)  # idempotent
+    assert rbgit.cmd('cat-file', '-t', sha).strip() == 'commit'
+    rbgit.cleanup()
+
+
+def test_concurrent_fetches(temp_git_setup, tmp_path):
+    local, remote, _, _ = temp_git_setup
+    shas = [commit_in(local) for _ in range(4)]
+    subprocess.run(['git', 'push', 'origin', 'master'], cwd=local, check=True)
+    store = ObjectStore(str(tmp_path), str(remote))
+
+    with ThreadPoolExecutor(4) as pool:
+        fetched = list(pool.map(lambda sha: store.fetch([sha]), shas))
+    # Commits form a chain, so a fetch may bring ancestors another fetch asked for. None is fetched twice
+    fetched = [sha for shas_fetched in fetched for sha in shas_fetched]
+    assert sorted(fetched) == sorted(set(fetched))
+    assert store.missing(shas) == []
@@ -1,6 +1,12 @@
+import os
+import time
+import socket
+import subprocess
 import pytest
+from types import SimpleNamespace
 
-from git_recycle_bin.rbgit import RbGit
+from git_recycle_bin.rbgit import RbGit, RefSnapshot, create_rbgit
+from managers import git_user_info
 
 class DummyRbGit:
     def cmd(self, *args, **kwargs):
@@ -17,27 +23,107 @@ def test_tree_size_sum():
     assert size == 579
 
 
-def test_remote_already_has_ref():
-    class D:
-        def cmd(self, *args):
-            if args[0] == 'ls-remote':
-                return 'sha\tref' if args[-1] == 'ref' else ''
-            raise RuntimeError('bad')
+class SnapshotDummy:
+    """ Serves ls-remote from refs, counting how often it is asked """
+    def __init__(self, refs):
+        self.refs = refs
+        self.ls_remotes = 0
+        self.printer = SimpleNamespace(debug=lambda *a, **k: None)
+        self.ref_snapshots = {}
+        self.ref_snapshot_dir = None
+        self.ref_snapshot_ttl = 0
 
-    dummy = D()
+    def cmd(self, *args, **kwargs):
+        if args[:3] == ('ls-remote', '--refs', 'origin'):
+            self.ls_remotes += 1
+            return self.refs
+        raise RuntimeError('bad')
+
+    def ref_snapshot(self, remote):
+        return RbGit.ref_snapshot(self, remote)
+
+
+def test_remote_already_has_ref():
+    dummy = SnapshotDummy('sha\trefs/heads/ref\n')
     assert RbGit.remote_already_has_ref(dummy, 'origin', 'ref') is True
+    assert RbGit.remote_already_has_ref(dummy, 'origin', 'refs/heads/ref') is True
     assert RbGit.remote_already_has_ref(dummy, 'origin', 'missing') is False
+    assert RbGit.remote_already_has_ref(dummy, 'origin', 'ef') is False
+    assert dummy.ls_remotes == 1
 
 
 def test_fetch_current_tag_value():
-    class D:
-        def cmd(self, *args):
-            if args[:3] == ('ls-remote', '--tags', 'origin'):
-                return 'a1\trefs/tags/v1\nb2\trefs/tags/v2'
-            raise RuntimeError('bad')
-
-    dummy = D()
+    dummy = SnapshotDummy('a1\trefs/tags/v1\nb2\trefs/tags/v2\nc3\trefs/heads/v3')
     assert RbGit.fetch_current_tag_value(dummy, 'origin', 'v2') == 'b2'
+    assert RbGit.fetch_current_tag_value(dummy, 'origin', 'v3') is None
+    assert dummy.ls_remotes == 1
+
+
+def test_ref_snapshot_prefix():
+    snapshot = RefSnapshot.parse('a\trefs/heads/x\nb\trefs/tags/y\nc\trefs/heads/z\n')
+    assert snapshot.prefix('refs/heads/') == [('a', 'refs/heads/x'), ('c', 'refs/heads/z')]
+
+
+def test_ref_snapshot_invalidated_by_push(temp_git_setup):
+    local, _, artifact_remote, _ = temp_git_setup
+    rbgit = create_rbgit(str(local), clean=True)
+    rbgit.add_remote_idempotent("bin", str(artifact_remote))
+    with git_user_info():
+        rbgit.cmd("commit", "--allow-empty", "-m", "x")
+
+    assert not rbgit.remote_already_has_ref("bin", "master")
+    rbgit.cmd("push", "bin", "master")
+    assert rbgit.remote_already_has_ref("bin", "master")
+    rbgit.cleanup()
+
+
+def test_ref_snapshot_disk_cache(temp_git_setup, tmp_path):
+    local, _, artifact_remote, _ = temp_git_setup
+    rbgit = create_rbgit(str(local), clean=True)
+    rbgit.add_remote_idempotent("bin", str(artifact_remote))
+    rbgit.use_ref_snapshot_cache(str(tmp_path), ttl=60)
+    rbgit.ref_snapshot("bin")
+    assert len(list((tmp_path / "refs").iterdir())) == 1
+
+    # A later invocation needs no ls-remote
+    rbgit.ref_snapshots.clear()
+    cmd = rbgit.cmd
+    def no_ls_remote(*args, **kwargs):
+        assert args[0] != "ls-remote"
+        return cmd(*args, **kwargs)
+    rbgit.cmd = no_ls_remote
+    assert rbgit.ref_snapshot("bin").refs == {}
+
+    # Our own push makes the cached snapshot stale
+    rbgit.cmd = cmd
+    with git_user_info():
+        rbgit.cmd("commit", "--allow-empty", "-m", "x")
+    rbgit.cmd("push", "bin", "master")
+    assert list((tmp_path / "refs").iterdir()) == []
+    rbgit.cleanup()
+
+
+def test_fetch_refs(temp_git_setup, tmp_path):
+    _, _, artifact_remote, _ = temp_git_setup
+    work = tmp_path / "work"
+    work.mkdir()
+    rbgit = create_rbgit(str(work), clean=True)
+    rbgit.add_remote_idempotent("bin", f"file://{artifact_remote}")
+    blobs = {name: rbgit.cmd("hash-object", "-w", "--stdin", input=name).strip() for name in ("a", "b", "c")}
+    rbgit.cmd("push", "bin", f"{blobs['a']}:refs/artifact/x/a/1", f"{blobs['b']}:refs/artifact/x/b/2",
+              f"{blobs['c']}:refs/artifact/y/c")
+
+    fetcher = create_rbgit(str(tmp_path), clean=True)
+    fetcher.add_remote_idempotent("bin", f"file://{artifact_remote}")
+    snapshot = fetcher.fetch_refs("bin", "refs/artifact/x/")
+    assert snapshot.refs == {"refs/artifact/x/a/1": blobs["a"], "refs/artifact/x/b/2": blobs["b"]}
+    assert fetcher.cat_file_batch([blobs["a"], blobs["b"]]) == {blobs["a"]: "a", blobs["b"]: "b"}
+
+    # Refs gone from the remote are gone from later snapshots
+    rbgit.cmd("push", "bin", "--delete", "refs/artifact/x/a/1")
+    assert fetcher.fetch_refs("bin", "refs/artifact/x/").refs == {"refs/artifact/x/b/2": blobs["b"]}
+    rbgit.cleanup()
+    fetcher.cleanup()
 
 
 def test_fetch_cat_pretty():
@@ -54,10 +140,68 @@ def test_fetch_cat_pretty():
 
     dummy = D()
     res = RbGit.fetch_cat_pretty(dummy, 'origin', 'ref')
-    assert calls[0] == ('fetch', 'origin', 'ref')
+    assert calls[0] == ('fetch', '--no-tags', 'origin', 'ref')
     assert res == 'content'
 
 
+def test_fetch_cat_batch():
+    calls = []
+
+    class D:
+        def cmd(self, *args, **kwargs):
+            calls.append((args, kwargs))
+            if args[0] == 'fetch':
+                return ''
+            if args[:2] == ('cat-file', '--batch'):
+                return (
+                    b"aaaa blob 10\nname: \xc3\xa6\xc3\xb8\n"
+                    b"bbbb blob 11\nline1\nline2\n"
+                )
+            raise RuntimeError('bad')
+
+    dummy = D()
+    dummy.cat_file_batch = lambda objs: RbGit.cat_file_batch(dummy, objs)
+    dummy.fetch_batch = lambda remote, objs, jobs=1, batch_size=1000: RbGit.fetch_batch(dummy, remote, objs, jobs)
+    res = RbGit.fetch_cat_batch(dummy, 'origin', ['aaaa', 'bbbb', 'aaaa'])
+    assert res == {'aaaa': 'name: æø', 'bbbb': 'line1\nline2'}
+    assert calls[0][0] == ('fetch', '--no-tags', '--no-write-fetch-head', '--stdin', 'origin')
+    assert calls[0][1]['input'] == 'aaaa\nbbbb\n'
+    assert len(calls) == 2
+
+
+def test_fetch_cat_batch_jobs():
+    fetched = []
+
+    class D:
+        def cmd(self, *args, **kwargs):
+            if args[0] == 'fetch':
+                fetched.append(kwargs['input'])
+                return ''
+            return kwargs['input'].replace(b'\n', b' blob 1\nx\n')
+
+    dummy = D()
+    dummy.cat_file_batch = lambda objs: RbGit.cat_file_batch(dummy, objs)
+    dummy.fetch_batch = lambda remote, objs, jobs=1, batch_size=1000: RbGit.fetch_batch(dummy, remote, objs, jobs, batch_size=batch_size)
+    objs = ['aaaa', 'bbbb', 'cccc', 'dddd', 'eeee']
+    res = RbGit.fetch_cat_batch(dummy, 'origin', objs, jobs=2, batch_size=2)
+    # Fetches are of at most batch_size objects, however many jobs share them
+    assert sorted(fetched) == ['aaaa\nbbbb\n', 'cccc\ndddd\n', 'eeee\n']
+    assert list(res) == objs  # deterministic order, regardless of which fetch finished first
+
+    fetched.clear()
+    RbGit.fetch_cat_batch(dummy, 'origin', objs, jobs=1, batch_size=2)
+    assert fetched == ['aaaa\nbbbb\n', 'cccc\ndddd\n', 'eeee\n']
+
+
+def test_cat_file_batch_missing():
+    class D:
+        def cmd(self, *args, **kwargs):
+            return b"cccc missing\n"
+
+    with pytest.raises(RuntimeError):
+        RbGit.cat_file_batch(D(), ['cccc'])
+
+
 def test_add_no_changes(tmp_path):
     path = tmp_path / 'file'
     path.write_text('data')
@@ -137,3 +281,95 @@ def test_fetch_only_tags_and_set_tag():
     RbGit.set_tag(dummy, 'v1', 'sha')
     assert ('fetch', 'origin', 'refs/tags/*:refs/tags/*') in calls
     assert ('tag', '--force', 'v1', 'sha') in calls
+
+
+@pytest.fixture
+def git_daemon(tmp_path):
+    """ A `git daemon` serving a bare bin.git over git://, logging every request it serves """
+    exec_path = subprocess.check_output(['git', '--exec-path'], text=True).strip()
+    if not os.path.exists(os.path.join(exec_path, 'git-daemon')):
+        pytest.skip("git daemon not installed")
+    served = tmp_path / 'served'
+    subprocess.run(['git', 'init', '-q', '--bare', str(served / 'bin.git')], check=True)
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+    log = tmp_path / 'daemon.log'
+    with open(log, 'w') as log_file:
+        daemon = subprocess.Popen(['git', 'daemon', '--reuseaddr', '--verbose', '--export-all', '--enable=receive-pack',
+                                   f'--base-path={served}', '--listen=127.0.0.1', f'--port={port}'], stderr=log_file)
+    try:
+        for _ in range(100):
+            try:
+                socket.create_connection(('127.0.0.1', port)).close()
+                break
+            except OSError:
+                time.sleep(0.05)
+        yield f'git://127.0.0.1:{port}/bin.git', log
+    finally:
+        daemon.terminate()
+        daemon.wait()
+
+
+def test_remote_calls_against_git_daemon(git_daemon, tmp_path, monkeypatch):
+    """ Protocol v2 is negotiated, fetches by SHA skip the ref advertisement, and snapshots save round trips """
+    url, log = git_daemon
+
+    def requests():
+        return [line for line in log.read_text().splitlines() if 'Request ' in line]
+
+    work = tmp_path / 'work'
+    work.mkdir()
+    rbgit = create_rbgit(str(work), clean=True)
+    rbgit.add_remote_idempotent('bin', url)
+    blobs = [rbgit.cmd('hash-object', '-w', '--stdin', input=f'meta {i}').strip() for i in range(3)]
+    rbgit.cmd('push', 'bin', *[f'{blob}:refs/artifact/meta-for-commit/src/{i}' for i, blob in enumerate(blobs)])
+
+    trace = tmp_path / 'packets'
+    monkeypatch.setenv('GIT_TRACE_PACKET', str(trace))
+    reader = create_rbgit(str(tmp_path), clean=True)
+    reader.add_remote_idempotent('bin', url)
+    before = len(requests())
+    snapshot = reader.ref_snapshot('bin')
+    assert len(snapshot.prefix('refs/artifact/')) == 3
+    assert reader.ref_snapshot('bin') is snapshot  # Answered from memory
+    assert reader.fetch_cat_batch('bin', blobs) == {blob: f'meta {i}' for i, blob in enumerate(blobs)}
+    assert len(requests()) - before == 2  # One ls-remote, one fetch
+
+    packets = trace.read_text()
+    assert 'version 2' in packets
+    assert packets.count('command=ls-refs') == 1  # The fetch by SHA asked for no refs
+
+    # Refs asked for by prefix are filtered by the server
+    trace.write_text('')
+    reader.fetch_refs('bin', 'refs/artifact/meta-for-commit/')
+    assert 'ref-prefix refs/artifact/meta-for-commit/' in trace.read_text()
+    rbgit.cleanup()
+    reader.cleanup()
+
+
+def test_ssh_multiplex_session(temp_git_setup, monkeypatch):
+    local, _, _, _ = temp_git_setup
+    monkeypatch.delenv('GIT_SSH', raising=False)
+    monkeypatch.setenv('GIT_SSH_COMMAND', 'ssh -i "my key"')
+    rbgit = create_rbgit(str(local), clean=True)
+    with rbgit:
+        control_dir = rbgit.ssh_control_dir
+        assert rbgit.ssh_command.startswith('ssh -i "my key" -o ControlMaster=auto')
+        assert f'ControlPath={control_dir}/%C' in rbgit.ssh_command
+
+        # A master connection was made
+        open(os.path.join(control_dir, 'socket'), 'w').close()
+        ssh_calls = []
+        run = subprocess.run
+        monkeypatch.setattr(subprocess, 'run', lambda cmd, **kwargs: ssh_calls.append(cmd) if cmd[0] == 'ssh' else run(cmd, **kwargs))
+
+    assert ssh_calls == [['ssh', '-i', 'my key', '-o', f'ControlPath={control_dir}/socket', '-O', 'exit', '_']]
+    assert not os.path.exists(control_dir)
+
+
+def test_ssh_multiplex_skipped_for_other_ssh(temp_git_setup, monkeypatch):
+    local, _, _, _ = temp_git_setup
+    monkeypatch.setenv('GIT_SSH_COMMAND', 'plink -batch')
+    with create_rbgit(str(local), clean=True) as rbgit:
+        assert rbgit.ssh_command is None
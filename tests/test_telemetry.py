@@ -0,0 +1,77 @@
+import json
+import subprocess
+
+import git_recycle_bin.rbgit as rbgit_mod
+from git_recycle_bin.rbgit import create_rbgit
+from git_recycle_bin.telemetry import Telemetry, git_subcommand, parse_progress
+
+
+FETCH_PROGRESS = (
+    "remote: Enumerating objects: 8, done.        \n"
+    "remote: Counting objects:  50% (4/8)\rremote: Counting objects: 100% (8/8), done.        \n"
+    "remote: Total 8 (delta 1), reused 0 (delta 0), pack-reused 0        \n"
+    "Receiving objects:  12% (1/8)\rReceiving objects: 100% (8/8), 3.82 MiB | 30.77 MiB/s, done.\n"
+    "Resolving deltas: 100% (1/1), done.\n"
+    "From file:///tmp/remote\n"
+)
+PUSH_PROGRESS = (
+    "Writing objects: 100% (6/6), 405 bytes | 202.00 KiB/s, done.\n"
+    "Total 6 (delta 0), reused 0 (delta 0), pack-reused 0\n"
+)
+
+
+def test_parse_progress():
+    assert parse_progress(FETCH_PROGRESS) == (8, int(3.82 * (1 << 20)))
+    assert parse_progress(PUSH_PROGRESS) == (6, 405)
+    assert parse_progress("Everything up-to-date\n") == (0, 0)
+
+
+def test_git_subcommand():
+    assert git_subcommand(("fetch", "--no-tags", "origin")) == "fetch"
+    assert git_subcommand(("-c", "tar.tar.zst.command=zstd", "archive", "HEAD")) == "archive"
+
+
+def test_summary_and_report(tmp_path):
+    telemetry = Telemetry()
+    telemetry.enabled = True
+    with telemetry.phase("fetch"):
+        telemetry.record(("fetch", "origin"), 1.5, FETCH_PROGRESS)
+    with telemetry.phase("fetch"):
+        telemetry.record(("fetch", "origin"), 0.5, "")
+    telemetry.record(("cat-file", "--batch"), 0.25, FETCH_PROGRESS)  # Not a transfer, so progress is ignored
+
+    assert telemetry.instrument(("-c", "x=y", "push", "origin")) == ("-c", "x=y", "push", "--progress", "origin")
+    assert telemetry.instrument(("fetch", "origin")) == ("-c", "fetch.unpackLimit=1", "fetch", "--progress", "origin")
+    assert telemetry.instrument(("ls-tree", "HEAD")) == ("ls-tree", "HEAD")
+
+    path = tmp_path / "stats.json"
+    telemetry.report("download", str(path))
+    summary = json.loads(path.read_text())
+    assert list(summary["phases"]) == ["fetch"]
+    assert summary["git"] == {
+        "cat-file": {"calls": 1, "seconds": 0.25, "objects": 0, "bytes": 0},
+        "fetch": {"calls": 2, "seconds": 2.0, "objects": 8, "bytes": int(3.82 * (1 << 20))},
+    }
+
+
+def test_rbgit_reports_transfers(temp_git_setup, tmp_path, monkeypatch):
+    local, remote, _, _ = temp_git_setup
+    sha = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=local, text=True).strip()
+    telemetry = Telemetry()
+    telemetry.enabled = True
+    monkeypatch.setattr(rbgit_mod, 'telemetry', telemetry)
+
+    work = tmp_path / 'work'
+    work.mkdir()
+    rbgit = create_rbgit(src_tree_root=str(work), clean=True)
+    rbgit.cmd("fetch", "--no-tags", f"file://{remote}", sha)
+    assert telemetry.commands["fetch"]["objects"] == 3  # Commit, tree and blob
+    assert telemetry.commands["fetch"]["bytes"] > 0
+
+    # Pushes showing git's output as it comes are accounted too
+    bare = tmp_path / 'bare.git'
+    subprocess.run(['git', 'init', '-q', '--bare', str(bare)], check=True)
+    rbgit.cmd("push", f"file://{bare}", f"{sha}:refs/heads/x", capture_output=False)
+    assert telemetry.commands["push"]["objects"] == 3
+    assert telemetry.commands["push"]["bytes"] > 0
+    rbgit.cleanup()
@@ -10,6 +10,7 @@ from git_recycle_bin.utils.date import (
     DATE_FMT_GIT,
     DATE_FMT_EXPIRE,
     date_fuzzy2expiryformat,
+    date_expire_from_branch,
 )
 
 
@@ -98,3 +99,12 @@ def test_invalid_date():
         date_fuzzy2expiryformat("invalid")
     with pytest.raises(ValueError, match="invalid datetime input"):
         date_fuzzy2expiryformat("Mon, 32 Feb 1994 21:21:42 GMT")
+
+
+def test_date_expire_from_branch():
+    now = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone(datetime.timedelta(hours=2)))
+    expiry = date_expire_from_branch("refs/heads/artifact/expire/2024-07-20/14.17+0000/p.git@abc/{obj}", now)
+    assert expiry == datetime.datetime(2024, 7, 20, 14, 17, tzinfo=datetime.timezone.utc)
+    expiry = date_expire_from_branch("refs/heads/artifact/expire/2024-07-20/14.17/p.git@abc/{obj}", now)
+    assert expiry.utcoffset() == datetime.timedelta(hours=2)
+    assert date_expire_from_branch("refs/heads/artifact/expire/30d/p.git@abc/{obj}", now) is None
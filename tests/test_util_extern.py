@@ -1,11 +1,15 @@
+import shutil
 import subprocess
-from git_recycle_bin.utils.extern import exec, exec_nostderr
+import pytest
+from git_recycle_bin.utils.extern import exec, exec_nostderr, JqStream, JqError
+
+needs_jq = pytest.mark.skipif(shutil.which('jq') is None, reason="jq not installed")
 
 
 def test_exec_env(monkeypatch):
     called = {}
 
-    def fake_check_output(cmd, env=None, text=None, stderr=None, cwd=None):
+    def fake_check_output(cmd, env=None, text=None, stderr=None, cwd=None, input=None):
         called['cmd'] = cmd
         called['env'] = env
         called['stderr'] = stderr
@@ -29,3 +33,40 @@ def test_exec_nostderr(monkeypatch):
     monkeypatch.setattr(subprocess, 'check_output', fake_check_output)
     exec_nostderr(['echo'])
     assert called['stderr'] is subprocess.DEVNULL
+
+
+@needs_jq
+def test_jq_stream_one_process_many_inputs(monkeypatch):
+    popen = subprocess.Popen
+    spawned = []
+    def counting_popen(*args, **kwargs):
+        spawned.append(args[0])
+        return popen(*args, **kwargs)
+    monkeypatch.setattr(subprocess, 'Popen', counting_popen)
+
+    jq = JqStream('.name == "foo"')
+    assert [jq('{"name": "foo"}'), jq('{"name": "bar"}'), jq('{"name": "foo"}')] == [True, False, True]
+    jq.close()
+    assert len(spawned) == 1
+
+
+@needs_jq
+def test_jq_stream_select_and_errors():
+    jq = JqStream('select(.n + 1 > 2)')
+    assert jq('{"n": 2}') is True
+    assert jq('{"n": 0}') is False
+    assert jq('{"n": {}}') is False  # adding object and number fails; treated as no match
+    jq.close()
+
+
+@needs_jq
+def test_jq_stream_invalid_program():
+    jq = JqStream('.[')
+    with pytest.raises(JqError):
+        jq('{}')
+
+
+def test_jq_stream_missing_jq(monkeypatch, tmp_path):
+    monkeypatch.setenv('PATH', str(tmp_path))
+    with pytest.raises(JqError):
+        JqStream('.')
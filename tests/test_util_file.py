@@ -1,5 +1,8 @@
 import os
-from git_recycle_bin.utils.file import nca_path, rel_dir, classify_path
+
+import pytest
+
+from git_recycle_bin.utils.file import nca_path, rel_dir, classify_path, atomic_write
 
 
 def test_nca_and_rel(tmp_path):
@@ -16,3 +19,20 @@ def test_classify_path(tmp_path):
     assert classify_path(str(f)) == ('text/plain', None)
     assert classify_path(str(tmp_path)) == 'directory'
     assert classify_path(str(tmp_path / 'missing')) == 'unknown'
+
+
+def test_atomic_write(tmp_path):
+    path = tmp_path / 'dir' / 'file'
+    atomic_write(str(path), 'text')
+    assert path.read_text() == 'text'
+    atomic_write(str(path), [b'by', b'tes'], 0o444)
+    assert path.read_bytes() == b'bytes'
+    assert path.stat().st_mode & 0o777 == 0o444
+
+    def failing():
+        yield b'partial'
+        raise OSError('disk full')
+    with pytest.raises(OSError):
+        atomic_write(str(path), failing())
+    assert path.read_bytes() == b'bytes'
+    assert os.listdir(path.parent) == ['file']  # No temporary file left behind
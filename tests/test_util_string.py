@@ -3,6 +3,7 @@ from git_recycle_bin.utils.string import (
     remove_empty_lines,
     sanitize_slashes,
     sanitize_branch_name,
+    sanitize_ref_component,
     trim_all_lines,
     prefix_lines,
     string_trunc_ellipsis,
@@ -24,6 +25,14 @@ def test_sanitize_slashes():
     assert sanitize_slashes('foo/bar') == 'foo_bar'
 
 
+def test_sanitize_ref_component():
+    assert sanitize_ref_component('obj/doc/html') == 'obj_doc_html'
+    assert sanitize_ref_component('.hidden') == '_hidden'
+    assert sanitize_ref_component('x.lock') == 'x_lock'
+    assert sanitize_ref_component('a@{b') == 'a_{b'
+    assert sanitize_ref_component('') == '_'
+
+
 def test_sanitize_branch_name():
     assert sanitize_branch_name('foo bar') == 'foo_bar'
     assert sanitize_branch_name('/start') == '_start'